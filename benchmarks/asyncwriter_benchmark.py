@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Throughput of the synchronous writing of headers and reduced data versus
+the background writer (saxsctrl.hardware.io.asyncwriter.AsyncFileWriter).
+
+For every exposure the same set of files is written as by
+SubSystemFiles.writereduced() and writeradial(): a .param header, an .npz
+file with the corrected 2D intensity and error, and a crd_%d.txt radial
+average. The synchronous modes write the files directly (as before), or
+atomically with an fsync each. The asynchronous modes report both the time
+the caller is blocked (submit) and the total time until everything is on
+the disk (flush).
+
+Usage: python asyncwriter_benchmark.py [options]; see --help. Point --tmpdir
+to a network file system to see the effect of the latencies.
+"""
+from saxsctrl.hardware.io.asyncwriter import AsyncFileWriter, write_atomic
+import numpy as np
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+
+def header_writer(fsn):
+    def write(filename):
+        with open(filename, 'wt') as f:
+            for i in range(60):
+                f.write('Parameter%d:\t%g\n' % (i, fsn * 0.1 + i))
+    return write
+
+
+def exposure_writer(intensity, error):
+    def write(filename):
+        np.savez_compressed(filename, Intensity=intensity, Error=error)
+    return write
+
+
+def curve_writer(curve):
+    def write(filename):
+        np.savetxt(filename, curve)
+    return write
+
+
+def jobs(directory, fsn, intensity, error, curve):
+    return [(os.path.join(directory, 'crd_%05d.param' % fsn), header_writer(fsn)),
+            (os.path.join(directory, 'crd_%05d.npz' % fsn), exposure_writer(intensity, error)),
+            (os.path.join(directory, 'crd_%d.txt' % fsn), curve_writer(curve))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Background file writer benchmark')
+    parser.add_argument('--nexposures', type=int, default=200, help='Number of exposures to write')
+    parser.add_argument('--shape', default='619x487', help='Size of the 2D images (default: %(default)s)')
+    parser.add_argument('--tmpdir', default=None, help='Directory for the files (default: system temp)')
+    args = parser.parse_args()
+    shape = tuple(int(x) for x in args.shape.split('x'))
+    intensity = np.random.poisson(100, shape).astype(np.double)
+    error = np.sqrt(intensity)
+    curve = np.random.rand(400, 3)
+    tmpdir = tempfile.mkdtemp(prefix='saxsctrl_writebench_', dir=args.tmpdir)
+    try:
+        results = []
+
+        directory = os.path.join(tmpdir, 'sync')
+        os.mkdir(directory)
+        t0 = time.time()
+        for fsn in range(args.nexposures):
+            for filename, writer in jobs(directory, fsn, intensity, error, curve):
+                writer(filename)
+        results.append(('synchronous', time.time() - t0, None))
+
+        directory = os.path.join(tmpdir, 'syncatomic')
+        os.mkdir(directory)
+        t0 = time.time()
+        for fsn in range(args.nexposures):
+            for filename, writer in jobs(directory, fsn, intensity, error, curve):
+                write_atomic(filename, writer, fsync=True)
+        results.append(('synchronous, fsync', time.time() - t0, None))
+
+        for fsync in [False, True]:
+            directory = os.path.join(tmpdir, 'async%d' % fsync)
+            os.mkdir(directory)
+            asyncwriter = AsyncFileWriter(fsync=fsync)
+            asyncwriter.start()
+            t0 = time.time()
+            for fsn in range(args.nexposures):
+                asyncwriter.submit(jobs(directory, fsn, intensity, error, curve))
+            t1 = time.time()
+            asyncwriter.flush()
+            asyncwriter.shutdown()
+            results.append(('background' + ['', ', fsync'][fsync], time.time() - t0, t1 - t0))
+
+        print '%d exposures (3 files each, %dx%d images) in %s:' % (
+            args.nexposures, shape[0], shape[1], tmpdir)
+        for name, t, tsubmit in results:
+            line = '  %-20s: %7.1f exposures/sec' % (name, args.nexposures / t)
+            if tsubmit is not None:
+                line += ', caller blocked for %.2f ms/exposure' % (tsubmit * 1000. / args.nexposures)
+            print line
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
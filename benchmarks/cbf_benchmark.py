@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Micro-benchmark of CBF decoding: sastool.io.twodim.readcbf() versus
+saxsctrl.hardware.io.cbf.CBFReader.
+
+Real Pilatus 300k frames (487x619) can be given on the command line. If none
+are given, frames written by the Pilatus simulator are used. The decoded
+matrices are checked to be equal before timing.
+
+Usage: python cbf_benchmark.py [options] [file.cbf ...]; see --help.
+"""
+from saxsctrl.hardware.io.cbf import CBFReader
+from saxsctrl.hardware.simulators.pilatus import PilatusSimulator, write_cbf
+import sastool
+import numpy as np
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+
+def make_frames(dirname, nframes, exptime):
+    sim = PilatusSimulator(port=0, imgpath=dirname)
+    filenames = []
+    for i in range(nframes):
+        filenames.append(os.path.join(dirname, 'bench_%05d.cbf' % i))
+        write_cbf(filenames[-1], sim.synthetic_image(exptime),
+                  ['Detector: PILATUS 300K, S/N 3-0133',
+                   time.strftime('%Y-%m-%dT%H:%M:%S.000'),
+                   'Pixel_size 172e-6 m x 172e-6 m',
+                   'Exposure_time %.7f s' % exptime])
+    return filenames
+
+
+def timeit(func, filenames, repeat):
+    t = []
+    for i in range(repeat):
+        t0 = time.time()
+        for f in filenames:
+            func(f)
+        t.append((time.time() - t0) / len(filenames))
+    return min(t), np.mean(t)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CBF decoding benchmark')
+    parser.add_argument('filenames', nargs='*', help='CBF files')
+    parser.add_argument('--nframes', type=int, default=20,
+                        help='Number of simulated frames, if no files are given')
+    parser.add_argument('--exptime', type=float, default=10,
+                        help='Exposure time of the simulated frames (sec)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    tmpdir = None
+    filenames = args.filenames
+    try:
+        if not filenames:
+            tmpdir = tempfile.mkdtemp(prefix='saxsctrl_cbfbench_')
+            filenames = make_frames(tmpdir, args.nframes, args.exptime)
+        reader = CBFReader()
+        out = np.empty(619 * 487, np.double)
+        for f in filenames:
+            reference = sastool.io.twodim.readcbf(f, load_header=True)
+            data, header = reader.read(f)
+            if (reference[0] != data).any():
+                raise ValueError('Image data mismatch in file ' + f)
+            if reference[1] != dict(header):
+                print 'Warning: header mismatch in file %s: %s' % (f, ', '.join(str(x) for x in
+                    sorted(set(reference[1].items()) ^ set(dict(header).items()))))
+        cases = [('sastool readcbf (data + header)', lambda f: sastool.io.twodim.readcbf(f, load_header=True)),
+                 ('sastool readcbf (data only)',
+                  lambda f: sastool.io.twodim.readcbf(f)),
+                 ('CBFReader (data + header)',
+                  lambda f: dict(reader.read(f, out)[1])),
+                 ('CBFReader (data only, lazy header)', lambda f: reader.read(f, out))]
+        print '%d frames, best/mean of %d repetitions:' % (len(filenames), args.repeat)
+        for name, func in cases:
+            best, mean = timeit(func, filenames, args.repeat)
+            print '  %-36s: %7.3f / %7.3f ms per frame' % (name, best * 1000, mean * 1000)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
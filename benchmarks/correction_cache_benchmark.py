@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Per-frame cost of the geometry corrections (solid angle, angle-dependent
+self-absorption and air absorption) in the CorrectGeometry data reduction
+step, computing the correction matrices for every frame (as before) versus
+taking the combined matrix from the cache
+(saxsctrl.hardware.reduction.corrections.CorrectionMapCache).
+
+Usage: python correction_cache_benchmark.py [options]; see --help.
+"""
+from saxsctrl.hardware.reduction.corrections import CorrectionMapCache, correction_map
+from sastool.utils2d import corrections
+import numpy as np
+import argparse
+import time
+
+
+def errorprop_multiply(intensity, error, value, valueerror):
+    # what SASExposure.__imul__() does
+    return intensity * value, np.sqrt((intensity * valueerror) ** 2 + (error * value) ** 2)
+
+
+def geometry(shape, beampos, pixelsize, dist, ddist):
+    col, row = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
+    D = np.sqrt(((col - beampos[1]) * pixelsize) ** 2 + ((row - beampos[0]) * pixelsize) ** 2)
+    return np.arctan(D / dist), np.abs(D / (dist ** 2 + D ** 2) * ddist)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Geometry correction cache benchmark')
+    parser.add_argument('--nframes', type=int, default=50, help='Number of frames')
+    parser.add_argument('--shape', default='619x487', help='Size of the 2D images (default: %(default)s)')
+    args = parser.parse_args()
+    shape = tuple(int(x) for x in args.shape.split('x'))
+    intensity = np.random.poisson(100, shape).astype(np.double)
+    error = np.sqrt(intensity)
+    beampos, pixelsize, dist, ddist = (shape[0] / 2., shape[1] / 2.), 0.172, 1200., 0.5
+    transmission, mu = (0.4, 0.01), 1 / 88.349 / 1000. * 0.1 * 0.1
+
+    t0 = time.time()
+    for i in range(args.nframes):
+        tth, dtth = geometry(shape, beampos, pixelsize, dist, ddist)
+        I, E = intensity, error
+        for value, valueerror in [
+                corrections.solidangle_errorprop(tth, dtth, dist, ddist),
+                corrections.angledependentabsorption_errorprop(tth, dtth, transmission[0], transmission[1]),
+                corrections.angledependentairtransmission_errorprop(tth, dtth, mu, 0, dist, ddist)]:
+            I, E = errorprop_multiply(I, E, value, valueerror)
+    tbefore = (time.time() - t0) / args.nframes
+    reference = I, E
+
+    cache = CorrectionMapCache()
+    key = (shape, beampos, pixelsize, dist, ddist, True, transmission, mu)
+    t0 = time.time()
+    for i in range(args.nframes):
+        value, valueerror = cache.get(key, lambda: correction_map(
+            *(geometry(shape, beampos, pixelsize, dist, ddist) + (dist, ddist, True, transmission, mu))))
+        I, E = errorprop_multiply(intensity, error, value, valueerror)
+    tafter = (time.time() - t0) / args.nframes
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        deviation = max(np.nanmax(np.abs(I - reference[0]) / np.abs(reference[0])),
+                        np.nanmax(np.abs(E - reference[1]) / np.abs(reference[1])))
+    print '%d frames of %dx%d pixels:' % (args.nframes, shape[0], shape[1])
+    print '  computed for every frame: %7.2f ms/frame' % (tbefore * 1000)
+    print '  cached correction map   : %7.2f ms/frame (%d computed, %d from the cache)' % (
+        tafter * 1000, cache.misses, cache.hits)
+    print '  largest relative deviation: %g' % deviation
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""End-to-end throughput of the exposure pipeline.
+
+Local simulators of the Pilatus detector, the GeniX source and a TMCM351
+motor controller are started, and a Credo instance is created in a temporary
+directory and connected to them. Then SubSystemExposure.start(),
+SubSystemScan.execute(), SubSystemImaging.execute() and
+SubSystemTransmission.execute() are driven headless, and for each we record:
+
+    - frames per second (from the start until the last exposure-image signal)
+    - dead time between frames (time between consecutive CBF files minus the
+      exposure time)
+    - latency from the CBF file being written to the exposure-image signal
+    - per-stage timings, as reported by the exposure-timing signal: header
+      assembly, detector preparation and start, shutter operations, waiting
+      for the CBF file, header write and NeXus write.
+
+The results are written to a JSON file, for comparing releases.
+
+Usage: python exposure_benchmark.py [options]; see --help.
+"""
+import saxsctrl
+from saxsctrl.hardware.credo import Credo
+from saxsctrl.hardware.sample import SAXSSample
+from saxsctrl.hardware.simulators import PilatusSimulator, GenixSimulator, TMCMSimulator
+from gi.repository import GLib
+import numpy as np
+import pkg_resources
+import argparse
+import datetime
+import tempfile
+import shutil
+import json
+import time
+import os
+
+
+class Recorder(object):
+
+    """Collect the timestamps of exposure-image and exposure-timing signals
+    emitted by the Exposure subsystem."""
+
+    def __init__(self, sse):
+        self.sse = sse
+        self.images = []
+        self.timings = {}
+        self._conns = [sse.connect('exposure-image', self._on_image),
+                       sse.connect('exposure-timing', self._on_timing)]
+
+    def _on_image(self, sse, ex):
+        self.images.append((ex['FSN'], time.time()))
+
+    def _on_timing(self, sse, fsn, timings):
+        self.timings.setdefault(fsn, {}).update(timings)
+
+    def disconnect(self):
+        for c in self._conns:
+            self.sse.disconnect(c)
+        self._conns = []
+
+
+def stats(values):
+    values = np.array(values, dtype=np.double)
+    if not len(values):
+        return None
+    return {'n': len(values), 'mean': values.mean(), 'median': np.median(values),
+            'max': values.max(), 'min': values.min(), 'total': values.sum()}
+
+
+def summarize(recorder, t_start, t_end, exptime):
+    frametimes = dict(recorder.images)
+    cbftimes = sorted(recorder.timings[fsn]['cbf_file'][0]
+                      for fsn in recorder.timings if 'cbf_file' in recorder.timings[fsn])
+    stages = {}
+    for fsn in recorder.timings:
+        for stage, (start, end) in recorder.timings[fsn].items():
+            if stage != 'cbf_file':
+                stages.setdefault(stage, []).append(end - start)
+    latencies = [frametimes[fsn] - recorder.timings[fsn]['cbf_file'][0]
+                 for fsn in frametimes if 'cbf_file' in recorder.timings.get(fsn, {})]
+    if recorder.images:
+        t_last = max(t for fsn, t in recorder.images)
+    else:
+        t_last = t_end
+    return {'frames': len(recorder.images),
+            'wall_time': t_end - t_start,
+            'frames_per_second': len(recorder.images) / (t_last - t_start),
+            'dead_time': stats(np.diff(cbftimes) - exptime),
+            'cbf_to_signal_latency': stats(latencies),
+            'stages': dict((s, stats(stages[s])) for s in stages)}
+
+
+def run_until(flag, timeout):
+    t0 = time.time()
+    while not flag and time.time() - t0 < timeout:
+        GLib.main_context_default().iteration(False)
+        time.sleep(0.0005)
+    if not flag:
+        raise RuntimeError('Timeout in benchmark')
+
+
+def run(credo, name, starter, endobj, endsignal, exptime, timeout):
+    """Start a measurement by calling starter() and iterate the main loop until
+    `endsignal` of `endobj` is emitted."""
+    finished = []
+    conn = endobj.connect(endsignal, lambda *args: finished.append(args[1]))
+    recorder = Recorder(credo.subsystems['Exposure'])
+    t0 = time.time()
+    try:
+        starter()
+        run_until(finished, timeout)
+    finally:
+        endobj.disconnect(conn)
+        recorder.disconnect()
+    t1 = time.time()
+    result = summarize(recorder, t0, t1, exptime)
+    result['status'] = bool(finished[0])
+    print '%-12s: %4d frames in %7.2f sec, %6.2f frames/sec, mean dead time %s ms, mean latency %s ms' % (
+        name, result['frames'], result['wall_time'], result['frames_per_second'],
+        '%.1f' % (result['dead_time']['mean'] * 1000) if result[
+            'dead_time'] else '-',
+        '%.1f' % (result['cbf_to_signal_latency']['mean'] * 1000) if result['cbf_to_signal_latency'] else '-')
+    return result
+
+
+def setup_credo(args, rootdir):
+    os.chdir(rootdir)
+    common = {'latency': args.latency, 'jitter': args.jitter}
+    simulators = {'pilatus': PilatusSimulator(port=0, imgpath=os.path.join(rootdir, 'images'),
+                                              trimtime=0.1, **common),
+                  'genix': GenixSimulator(port=0, ht_rate=100, current_rate=5, **common),
+                  'tmcm351_a': TMCMSimulator(port=0, hwtype='TMCM351', **common)}
+    for axis in simulators['tmcm351_a'].axes:
+        # fast motors, we are not benchmarking motion
+        axis.params[154] = 0
+        axis.params[5] = 2047
+    os.mkdir('images')
+    credo = Credo(offline=True, createdirsifnotpresent=True)
+    sse = credo.subsystems['Equipments']
+    for name, sim in simulators.items():
+        host, port = sim.start()
+        sse.connect_equipment(name, host=host, port=port, offline=False)
+    sse.wait_for_idle('pilatus')
+    tmcm = sse.get('tmcm351_a')
+    for idx, motname in enumerate(['Sample_X', 'Sample_Y', 'BeamStop_Y']):
+        tmcm.add_motor(idx, motname, motname, softlimits=(-100, 100))
+    credo.subsystems['Samples'].add(SAXSSample('Empty beam'))
+    credo.subsystems['Samples'].add(
+        SAXSSample('Benchmark sample', positionx=1, positiony=1))
+    credo.subsystems['Samples'].set('Benchmark sample')
+    credo.subsystems['Exposure'].operate_shutter = True
+    return credo, simulators
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='End-to-end exposure throughput benchmark')
+    parser.add_argument('--exptime', type=float, default=0.1)
+    parser.add_argument('--dwelltime', type=float, default=0.003)
+    parser.add_argument('--nimages', type=int, default=20,
+                        help='Number of frames in the multi-image exposure')
+    parser.add_argument('--scanpoints', type=int, default=20,
+                        help='Number of points in the motor scan')
+    parser.add_argument('--imagingpoints', type=int, default=4,
+                        help='Number of points along each axis of the imaging')
+    parser.add_argument('--transmission-images', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Reply latency of the simulators (sec)')
+    parser.add_argument('--jitter', type=float, default=0.0005,
+                        help='Standard deviation of the reply latency (sec)')
+    parser.add_argument('--nexus', action='store_true',
+                        help='Write NeXus files in the multi-image exposure')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', default='exposure_benchmark.json')
+    parser.add_argument('--keep', action='store_true',
+                        help='Do not remove the temporary directory')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    rootdir = tempfile.mkdtemp(prefix='saxsctrl_benchmark_')
+    cwd = os.getcwd()
+    try:
+        credo, simulators = setup_credo(args, rootdir)
+        results = {}
+
+        sse = credo.subsystems['Exposure']
+
+        def start_exposure():
+            sse.exptime = args.exptime
+            sse.dwelltime = args.dwelltime
+            sse.nimages = args.nimages
+            sse.start(write_nexus=args.nexus)
+        results['exposure'] = run(credo, 'exposure', start_exposure, sse, 'exposure-end',
+                                  args.exptime, args.timeout)
+
+        sss = credo.subsystems['Scan']
+        sss.devicename = 'Motor:Sample_X'
+        sss.value_begin = 0
+        sss.value_end = 10
+        sss.nstep = args.scanpoints
+        sss.countingtime = args.exptime
+        sss.autoreturn = False
+        results['scan'] = run(credo, 'scan', sss.execute,
+                              sss, 'scan-end', args.exptime, args.timeout)
+
+        ssi = credo.subsystems['Imaging']
+        ssi.devicename1 = 'Motor:Sample_X'
+        ssi.devicename2 = 'Motor:Sample_Y'
+        ssi.value_begin1 = ssi.value_begin2 = 0
+        ssi.value_end1 = ssi.value_end2 = 1
+        ssi.nstep1 = ssi.nstep2 = args.imagingpoints
+        ssi.countingtime = args.exptime
+        ssi.autoreturn = False
+        results['imaging'] = run(credo, 'imaging', ssi.execute,
+                                 ssi, 'imaging-end', args.exptime, args.timeout)
+
+        sst = credo.subsystems['Transmission']
+        sst.samplename = 'Benchmark sample'
+        sst.countingtime = args.exptime
+        sst.nimages = args.transmission_images
+        sst.iterations = 1
+        results['transmission'] = run(credo, 'transmission', sst.execute,
+                                      sst, 'end', args.exptime, args.timeout)
+
+        try:
+            version = pkg_resources.get_distribution('saxsctrl').version
+        except pkg_resources.DistributionNotFound:
+            version = None
+        with open(output, 'wt') as f:
+            json.dump({'version': version,
+                       'date': datetime.datetime.now().isoformat(),
+                       'parameters': vars(args),
+                       'results': results}, f, indent=2, sort_keys=True)
+        print 'Results written to ' + output
+        credo.subsystems['Equipments'].disconnect_from_all()
+        for sim in simulators.values():
+            sim.stop()
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(rootdir, ignore_errors=True)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Per-frame time and peak memory of the intensity corrections of the data
+reduction chain: applied step by step with SASExposure arithmetic (as the
+reduction steps do) versus the fused single-pass kernel
+(saxsctrl.hardware.reduction.kernel.FusedCorrection).
+
+The operations are those of the default chain for a sample: division by the
+monitor and the transmission, background subtraction, the (cached)
+geometry correction matrix, division by the thickness and the absolute
+intensity factor. Each mode runs in a separate process, whose peak resident
+memory above the baseline (input data loaded) is reported.
+
+Usage: python fused_kernel_benchmark.py [options]; see --help.
+"""
+from saxsctrl.hardware.reduction.kernel import FusedCorrection, numexpr
+import sastool
+import numpy as np
+import multiprocessing
+import argparse
+import resource
+import time
+
+
+def make_data(shape):
+    np.random.seed(0)
+    intensity = np.random.poisson(100, shape).astype(np.double)
+    background = np.random.poisson(10, shape).astype(np.double) / 300.
+    geometry = 1 + np.random.rand(*shape)
+    return {'intensity': intensity, 'error': np.sqrt(intensity),
+            'background': background, 'backgrounderror': np.sqrt(background / 300.),
+            'geometry': geometry, 'geometryerror': geometry * 1e-3}
+
+
+def operations(data):
+    return [('div', 300., 0.01), ('div', 0.4, 0.005),
+            ('sub', data['background'], data['backgrounderror']),
+            ('mul', data['geometry'], data['geometryerror']),
+            ('div', 0.1, 0.001), ('mul', 3.2e-5, 1e-7)]
+
+
+def stepwise(data):
+    exposure = sastool.classes.SASExposure({'Intensity': data['intensity'], 'Error': data['error']})
+    for op, value, error in operations(data):
+        if op == 'sub':
+            exposure -= sastool.classes.SASExposure({'Intensity': value, 'Error': error})
+        elif op == 'div':
+            exposure /= sastool.ErrorValue(value, error)
+        else:
+            exposure *= sastool.ErrorValue(value, error)
+    return exposure
+
+
+def fused(data):
+    exposure = sastool.classes.SASExposure({'Intensity': data['intensity'], 'Error': data['error']})
+    kernel = FusedCorrection()
+    for op, value, error in operations(data):
+        if op == 'sub':
+            kernel.sub(value, error, exposure)
+        else:
+            getattr(kernel, op)(value, error)
+    kernel.apply(exposure)
+    return exposure
+
+
+def measure(mode, shape, nframes, results):
+    data = make_data(shape)
+    function = {'stepwise': stepwise, 'fused': fused}[mode]
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function(data)  # warm-up, not timed
+    t0 = time.time()
+    for i in range(nframes):
+        exposure = function(data)
+    t = (time.time() - t0) / nframes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    results.put((mode, t, peak, exposure.Intensity, exposure.Error))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fused correction kernel benchmark')
+    parser.add_argument('--nframes', type=int, default=50, help='Number of frames')
+    parser.add_argument('--shape', default='619x487', help='Size of the 2D images (default: %(default)s)')
+    args = parser.parse_args()
+    shape = tuple(int(x) for x in args.shape.split('x'))
+    results = {}
+    for mode in ['stepwise', 'fused']:
+        # a fresh process for each mode, for the peak memory
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=measure, args=(mode, shape, args.nframes, queue))
+        p.start()
+        result = queue.get()
+        p.join()
+        results[mode] = result[1:]
+    print '%d frames of %dx%d pixels (fused kernel with %s):' % (
+        args.nframes, shape[0], shape[1], ['numpy', 'numexpr'][numexpr is not None])
+    for mode in ['stepwise', 'fused']:
+        t, peak, I, E = results[mode]
+        print '  %-8s: %7.2f ms/frame, peak memory +%.1f MB' % (mode, t * 1000, peak / 1024.)
+    I0, E0 = results['stepwise'][2:]
+    I1, E1 = results['fused'][2:]
+    print '  largest relative deviation: intensity %g, error %g' % (
+        np.nanmax(np.abs(I1 - I0) / np.abs(I0)), np.nanmax(np.abs(E1 - E0) / np.abs(E0)))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Compare the shared I/O reactor with the per-instrument polling collector
+threads of Instrument_TCP.
+
+A local TCP server is started for each simulated instrument, which sends
+time-stamped asynchronous messages at random intervals. We measure the latency
+between sending a message and its arrival in interpret_message(), and the CPU
+time consumed by the process while the instruments are connected.
+
+Usage: python io_reactor_benchmark.py [ninstruments] [duration] [rate]
+"""
+import saxsctrl
+from saxsctrl.hardware.instruments.instrument import Instrument_TCP
+from gi.repository import GLib
+import numpy as np
+import socket
+import threading
+import random
+import time
+import os
+import sys
+
+
+class BenchmarkInstrument(Instrument_TCP):
+    _mesgseparator = '\n'
+
+    def __init__(self, name):
+        Instrument_TCP.__init__(self, name, offline=False)
+        self.latencies = []
+
+    def interpret_message(self, message, command=None):
+        self.latencies.append(time.time() - float(message))
+
+    def _update_instrumentproperties(self, propertyname=None):
+        pass
+
+
+def message_server(sock, stopswitch, rate):
+    conn, addr = sock.accept()
+    while not stopswitch.wait(random.expovariate(rate)):
+        conn.sendall('%.6f\n' % time.time())
+    conn.close()
+
+
+def run(io_reactor, ninstruments, duration, rate):
+    stopswitch = threading.Event()
+    instruments = []
+    servers = []
+    for i in range(ninstruments):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        s.listen(1)
+        t = threading.Thread(
+            target=message_server, args=(s, stopswitch, rate))
+        t.daemon = True
+        t.start()
+        servers.append((s, t))
+        ins = BenchmarkInstrument('bench%d' % i)
+        ins.io_reactor = io_reactor
+        ins.host, ins.port = s.getsockname()
+        ins.connect_to_controller()
+        instruments.append(ins)
+    t0 = time.time()
+    cpu0 = sum(os.times()[:2])
+    while time.time() - t0 < duration:
+        GLib.main_context_default().iteration(False)
+        time.sleep(0.0005)
+    cpu = sum(os.times()[:2]) - cpu0
+    wall = time.time() - t0
+    for ins in instruments:
+        ins.disconnect_from_controller()
+    stopswitch.set()
+    for s, t in servers:
+        t.join()
+        s.close()
+    lat = np.array(sum([ins.latencies for ins in instruments], [])) * 1000
+    return {'mode': ['collector threads', 'reactor'][io_reactor],
+            'messages': len(lat),
+            'latency_mean_ms': lat.mean(),
+            'latency_median_ms': np.median(lat),
+            'latency_max_ms': lat.max(),
+            'cpu_percent': 100 * cpu / wall}
+
+
+if __name__ == '__main__':
+    ninstruments = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rate = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    print '%d instruments, %.1f sec, %.1f messages/sec/instrument' % (ninstruments, duration, rate)
+    for io_reactor in [False, True]:
+        res = run(io_reactor, ninstruments, duration, rate)
+        print ('%(mode)20s: %(messages)6d messages, latency mean %(latency_mean_ms)8.3f ms, '
+               'median %(latency_median_ms)8.3f ms, max %(latency_max_ms)8.3f ms, CPU %(cpu_percent)5.1f %%') % res
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Scaling of the parallel data reduction
+(SubSystemDataReduction.reduce_batch()) with the number of worker processes.
+
+The exposures of an FSN range of an existing SAXSCtrl root folder are
+reduced first by the serial reduction chain (SubSystemDataReduction.reduce()),
+then in batches with 1, 2, ... N worker processes. The reduction settings are
+those saved in the state file of the root folder. The throughput is reported
+for each run, and the corrected 2D intensities and errors written by each
+parallel run are compared bit-by-bit to those of the serial run.
+
+The reduced files in the eval2d and eval1d folders of the root folder are
+overwritten.
+
+Usage: python parallel_reduction_benchmark.py rootpath first last [options];
+see --help.
+"""
+from saxsctrl.hardware.credo import Credo
+from saxsctrl.hardware.io.sharding import find_shards
+from gi.repository import GLib
+import numpy as np
+import multiprocessing
+import argparse
+import time
+import os
+
+
+def run_until(counter, target, timeout):
+    t0 = time.time()
+    while counter[0] < target and time.time() - t0 < timeout:
+        GLib.main_context_default().iteration(False)
+        time.sleep(0.0005)
+    if counter[0] < target:
+        raise RuntimeError('Timeout in benchmark')
+
+
+def reduce(credo, fsns, nworkers, timeout):
+    """Reduce `fsns` serially (if nworkers is None) or in parallel, and wait
+    until all of them are done and written. Returns the wall time."""
+    ssdr = credo.subsystems['DataReduction']
+    done = [0]
+    conn = ssdr.connect('done', lambda ssdr, fsn, header: done.__setitem__(0, done[0] + 1))
+    t0 = time.time()
+    try:
+        if nworkers is None:
+            for fsn in fsns:
+                ssdr.reduce(fsn, True)
+        else:
+            ssdr.reduce_batch(fsns, True, nworkers)
+        run_until(done, len(fsns), timeout)
+        credo.subsystems['Files'].flush()
+    finally:
+        ssdr.disconnect(conn)
+    t = time.time() - t0
+    # let the batch finish cleanly before the next one
+    t1 = time.time()
+    while ssdr._batch is not None and time.time() - t1 < timeout:
+        GLib.main_context_default().iteration(False)
+        time.sleep(0.0005)
+    return t
+
+
+def reduced_data(credo, fsns):
+    ssf = credo.subsystems['Files']
+    prefix = credo.subsystems['DataReduction'].filebegin
+    dirs = [ssf.eval2dpath] + find_shards(ssf.eval2dpath)
+    data = {}
+    for fsn in fsns:
+        path = ssf.locate(prefix, fsn, 'npz', dirs)
+        if path is None:
+            continue
+        with np.load(path) as f:
+            data[fsn] = dict((name, f[name].copy()) for name in ['Intensity', 'Error'])
+    return data
+
+
+def identical(a, b):
+    # bitwise comparison, NaNs included
+    return (a.shape == b.shape) and (a.dtype == b.dtype) and (a.tostring() == b.tostring())
+
+
+def compare(reference, data):
+    mismatches = [fsn for fsn in reference
+                  if fsn not in data or not all(identical(reference[fsn][name], data[fsn][name])
+                                                for name in reference[fsn])]
+    mismatches.extend(fsn for fsn in data if fsn not in reference)
+    return sorted(mismatches)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel data reduction scaling benchmark')
+    parser.add_argument('rootpath', help='SAXSCtrl root folder with measured data')
+    parser.add_argument('first', type=int, help='First FSN')
+    parser.add_argument('last', type=int, help='Last FSN')
+    parser.add_argument('--maxworkers', type=int, default=multiprocessing.cpu_count(),
+                        help='Largest number of worker processes (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=3600)
+    args = parser.parse_args()
+    os.chdir(args.rootpath)
+    credo = Credo(offline=True, createdirsifnotpresent=True)
+    fsns = range(args.first, args.last + 1)
+    t = reduce(credo, fsns, None, args.timeout)
+    reference = reduced_data(credo, fsns)
+    print '%d exposures, %d reduced by the serial chain.' % (len(fsns), len(reference))
+    print '  %-10s: %7.2f exposures/sec' % ('serial', len(fsns) / t)
+    tone = None
+    for nworkers in range(1, args.maxworkers + 1):
+        t = reduce(credo, fsns, nworkers, args.timeout)
+        if tone is None:
+            tone = t
+        mismatches = compare(reference, reduced_data(credo, fsns))
+        print '  %2d workers: %7.2f exposures/sec, speedup %5.2f, %s' % (
+            nworkers, len(fsns) / t, tone / t,
+            ['identical to serial', 'DIFFERENT from serial: ' +
+             ', '.join(str(fsn) for fsn in mismatches)][bool(mismatches)])
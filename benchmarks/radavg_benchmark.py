@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Radial averaging of Pilatus 300k sized frames: sastool's per-exposure
+averaging (radint_fullq_errorprop(), as called by
+SASExposure.radial_average()) versus the precomputed binning of
+saxsctrl.hardware.reduction.radavg.RadialAverager.
+
+The frames are random, with a beam stop masked out. The time needed to
+build the averager (once for a geometry and mask) is reported separately,
+and the results are compared.
+
+Usage: python radavg_benchmark.py [options]; see --help.
+"""
+from saxsctrl.hardware.reduction.radavg import RadialAverager, pixel_q
+from sastool.utils2d.integrate import radint_fullq_errorprop
+import numpy as np
+import argparse
+import time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Radial averaging benchmark')
+    parser.add_argument('--nframes', type=int, default=50, help='Number of frames')
+    parser.add_argument('--shape', default='619x487', help='Size of the 2D images (default: %(default)s)')
+    args = parser.parse_args()
+    shape = tuple(int(x) for x in args.shape.split('x'))
+    # wavelength, its error, distance, its error, pixel size, beam position
+    geometry = (0.15418, 0.0001, 1200., 0.5, 0.172, 0.172, shape[0] * 0.45, shape[1] * 0.55)
+    mask = np.zeros(shape, np.uint8)  # nonzero is masked
+    mask[int(geometry[6]) - 15:int(geometry[6]) + 15, int(geometry[7]) - 15:int(geometry[7]) + 15] = 1
+    mask[:, 195:212] = 1  # gap between the modules
+    frames = []
+    for i in range(min(args.nframes, 10)):
+        intensity = np.random.poisson(100, shape).astype(np.double)
+        frames.append((intensity, np.sqrt(intensity)))
+
+    t0 = time.time()
+    q, dq = pixel_q(shape, *geometry)
+    qvalid = q[mask == 0]
+    qbins = np.linspace(qvalid.min(), qvalid.max(), int(np.sqrt(shape[0] ** 2 + shape[1] ** 2) / 2))
+    averager = RadialAverager(q, dq, mask == 0, qbins)
+    tbuild = time.time() - t0
+
+    t0 = time.time()
+    for i in range(args.nframes):
+        intensity, error = frames[i % len(frames)]
+        reference = radint_fullq_errorprop(intensity, error, geometry[0], geometry[1], geometry[2],
+                                           geometry[3], geometry[4], geometry[5], geometry[6], 0,
+                                           geometry[7], 0, mask, qbins, errorpropagation=3,
+                                           abscissa_errorpropagation=3)
+    tsastool = (time.time() - t0) / args.nframes
+
+    t0 = time.time()
+    for i in range(args.nframes):
+        intensity, error = frames[i % len(frames)]
+        result = averager.average(intensity, error)
+    tengine = (time.time() - t0) / args.nframes
+
+    # the last frame by both: q, dq, intensity, error, area
+    deviation = max(np.nanmax(np.abs(a - b) / np.maximum(np.abs(b), 1e-300))
+                    for a, b in zip(result, reference[:5]))
+    print '%d frames of %dx%d pixels, %d q-bins:' % (args.nframes, shape[0], shape[1], len(qbins))
+    print '  sastool radint_fullq_errorprop: %7.2f ms/frame' % (tsastool * 1000)
+    print '  RadialAverager                : %7.2f ms/frame (%.1f ms to build), speedup %.1fx' % (
+        tengine * 1000, tbuild * 1000, tsastool / tengine)
+    print '  largest relative deviation: %g' % deviation
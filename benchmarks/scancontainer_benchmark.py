@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Write throughput and disk usage of the per-frame NeXus files versus a
+single per-scan HDF5 container (saxsctrl.hardware.io.scancontainer).
+
+The per-frame mode mimics SubSystemFiles.create_nexus_template() and
+SubSystemExposure.update_nexusfile(): for every frame a new file is created
+with the NeXus group hierarchy, then the gzip-compressed image and error
+matrix are written into it. The container mode appends the same frames and
+a few per-frame scalars to the extendable datasets of one file, in SWMR mode
+if supported. Frames are made by the Pilatus simulator.
+
+Usage: python scancontainer_benchmark.py [options]; see --help.
+"""
+from saxsctrl.hardware.io.scancontainer import ScanContainer, swmr_supported
+from saxsctrl.hardware.simulators.pilatus import PilatusSimulator
+import numpy as np
+import argparse
+import tempfile
+import shutil
+import h5py
+import time
+import os
+
+GROUPS = [('entry', 'NXentry'), ('entry/operator', 'NXuser'), ('entry/proposer', 'NXuser'),
+          ('entry/sample', 'NXsample'), ('entry/monitor', 'NXmonitor'),
+          ('entry/instrument', 'NXinstrument'), ('entry/instrument/beam_stop', 'NXbeam_stop'),
+          ('entry/instrument/collimator', 'NXcollimator'), ('entry/instrument/motors', 'NXcollection'),
+          ('entry/instrument/monochromator', 'NXmonochromator'), ('entry/instrument/source', 'NXsource'),
+          ('entry/instrument/sensors', 'NXcollection'), ('entry/instrument/detector', 'NXdetector'),
+          ('entry/data', 'NXdata')]
+
+
+def write_frame_file(filename, data, scalars):
+    with h5py.File(filename, 'w') as f:
+        for name, nxclass in GROUPS:
+            f.create_group(name).attrs['NX_class'] = nxclass
+        for name in scalars:
+            f['entry/instrument/motors'][name.replace('/', '_')] = scalars[name]
+    with h5py.File(filename, 'r+') as f:
+        detector = f['entry/instrument/detector']
+        detector.create_dataset('data', data=data, compression='gzip')
+        err = data.copy()
+        idx = err > 0
+        err[idx] = err[idx] ** 0.5
+        err[~idx] = np.nan
+        detector.create_dataset('data_error', data=err, compression='gzip')
+        f['entry/data/data'] = detector['data']
+        f['entry/data/errors'] = detector['data_error']
+
+
+def disk_usage(filenames):
+    return sum(os.stat(f).st_size for f in filenames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-scan HDF5 container benchmark')
+    parser.add_argument('--nframes', type=int, default=100, help='Number of frames in the scan')
+    parser.add_argument('--exptime', type=float, default=1, help='Exposure time of the simulated frames (sec)')
+    parser.add_argument('--nmotors', type=int, default=20, help='Number of per-frame motor positions')
+    parser.add_argument('--tmpdir', default=None, help='Directory for the files (default: system temp)')
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp(prefix='saxsctrl_scanbench_', dir=args.tmpdir)
+    try:
+        sim = PilatusSimulator(port=0, imgpath=tmpdir)
+        frames = [sim.synthetic_image(args.exptime).astype(np.double) for i in range(min(args.nframes, 10))]
+        scalarnames = ['FSN', 'Monitor'] + ['motors/motor%d' % i for i in range(args.nmotors)]
+
+        t0 = time.time()
+        filenames = []
+        for i in range(args.nframes):
+            filenames.append(os.path.join(tmpdir, 'crd_%05d.nx5' % i))
+            write_frame_file(filenames[-1], frames[i % len(frames)],
+                             dict((n, i) for n in scalarnames))
+        t_frames = time.time() - t0
+        size_frames = disk_usage(filenames)
+
+        t0 = time.time()
+        container = ScanContainer(os.path.join(tmpdir, 'scan_00001.nx5'),
+                                  frames[0].shape, scalarnames)
+        for i in range(args.nframes):
+            container.append(frames[i % len(frames)], None, dict((n, i) for n in scalarnames))
+        container.close()
+        t_container = time.time() - t0
+        size_container = disk_usage([container.filename])
+
+        print '%d frames of %dx%d pixels, SWMR %s:' % (
+            args.nframes, frames[0].shape[0], frames[0].shape[1],
+            ['not supported', 'supported'][swmr_supported()])
+        for name, t, size, nfiles in [('per-frame NeXus files', t_frames, size_frames, len(filenames)),
+                                      ('per-scan container', t_container, size_container, 1)]:
+            print '  %-22s: %7.1f frames/sec, %8.2f MB in %d file(s)' % (
+                name, args.nframes / t, size / 1048576., nfiles)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Throughput of sequential vs. batched TMCL command execution.
+
+A simulated TMCM6110 controller is started on a local TCP port. It answers
+each 9-byte command after a configurable delay, mimicking the RS232 line
+behind ser2net. We then read all axis parameters of all motors with one execute()
+call per parameter, and with TMCMModule.execute_batch().
+
+Usage: python tmcl_batch_benchmark.py [reply_delay_ms] [repeats]
+"""
+import saxsctrl
+from saxsctrl.hardware.instruments.tmcl_motor import TMCM6110
+from saxsctrl.hardware.simulators import TMCMSimulator
+import time
+import sys
+
+
+if __name__ == '__main__':
+    delay = float(sys.argv[1]) / 1000. if len(sys.argv) > 1 else 0.002
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    sim = TMCMSimulator(port=0, hwtype='TMCM6110', latency=delay)
+    address = sim.start()
+    tmcm = TMCM6110('benchmark', offline=False)
+    tmcm.configfile = ''
+    tmcm.host, tmcm.port = address
+    tmcm.connect_to_controller()
+    motors = [tmcm.add_motor(i, 'MOT_%d' % i) for i in range(tmcm.n_axes)]
+    commands = [(6, p.axisparameter_idx, m.mot_idx)
+                for m in motors for p in tmcm.motor_params if p.axisparameter_idx is not None]
+    print '%d GAP commands per repeat, %.1f ms reply delay, %d repeats' % (len(commands), delay * 1000, repeats)
+    t0 = time.time()
+    for i in range(repeats):
+        for c in commands:
+            tmcm.execute(*c)
+    t_seq = time.time() - t0
+    print 'sequential: %8.1f commands/sec' % (len(commands) * repeats / t_seq)
+    for batch_size in [1, 4, 16, 64]:
+        tmcm.batch_size = batch_size
+        t0 = time.time()
+        for i in range(repeats):
+            tmcm.execute_batch(commands)
+        t_batch = time.time() - t0
+        print 'batch size %3d: %8.1f commands/sec (%.2fx)' % (batch_size, len(commands) * repeats / t_batch, t_seq / t_batch)
+    monitored = ['Current_speed', 'Current_load', 'Current_position',
+                 'Left_limit_status', 'Right_limit_status']
+    t0 = time.time()
+    for i in range(repeats):
+        for m in motors:
+            for name in monitored:
+                m.get_parameter(name, raw=True, force_refresh=True)
+    t_seq = time.time() - t0
+    t0 = time.time()
+    for i in range(repeats):
+        for m in motors:
+            m.get_parameters(monitored, raw=True, force_refresh=True)
+    t_batch = time.time() - t0
+    print 'motor monitor poll: %.2f ms sequential, %.2f ms batched' % (t_seq / repeats / len(motors) * 1000, t_batch / repeats / len(motors) * 1000)
+    tmcm.disconnect_from_controller()
+    sim.stop()
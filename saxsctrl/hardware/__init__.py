@@ -1,7 +1,8 @@
-__all__ = ['credo', 'instruments', 'sample', 'subsystems', 'virtualpointdetector']
+__all__ = ['credo', 'instruments', 'sample', 'subsystems', 'virtualpointdetector', 'simulators']
 
 import credo
 import sample
 import instruments
 import subsystems
 import virtualpointdetector
+import simulators
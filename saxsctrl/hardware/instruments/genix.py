@@ -143,6 +143,8 @@ class Genix(Instrument_ModbusTCP):
         name='overridden', type=bool, refreshinterval=1, timeout=1)
     faultstatus = InstrumentProperty(
         name='faultstatus', type=int, refreshinterval=1, timeout=1)
+    _snapshot_parameters = [('HT', 'ht', 5), ('Current', 'current', 5),
+                            ('TubeTime', 'tubetime', 60), ('Status', 'faultstatus', 5)]
 
     def __init__(self, name='source', offline=True):
         if self._OWG_nosave_props is None:
@@ -1,4 +1,4 @@
-from .instrument import Instrument_TCP, InstrumentError, InstrumentProperty, InstrumentPropertyCategory
+from .instrument import Instrument_TCP, InstrumentError, InstrumentProperty, InstrumentPropertyCategory, SeparatorFraming
 import logging
 from gi.repository import GLib
 from ...utils import objwithgui
@@ -16,6 +16,7 @@ class HaakePhoenixError(InstrumentError):
 
 class HaakePhoenix(Instrument_TCP):
     __gtype_name__ = 'SAXSCtrl_Instrument_HaakePhoenix'
+    _framing = SeparatorFraming('\r', keep_separator=True)
     setpoint = InstrumentProperty(
         name='setpoint', type=float, timeout=1, refreshinterval=1)
     temperature = InstrumentProperty(
@@ -48,6 +49,10 @@ class HaakePhoenix(Instrument_TCP):
         name='external_pt100_fault', type=bool, timeout=1, refreshinterval=1)
     iscooling = InstrumentProperty(
         name='iscooling', type=bool, timeout=1, refreshinterval=1)
+    _snapshot_parameters = [('Temperature', 'temperature', 5),
+                            ('TemperatureController', 'version', 7200),
+                            ('TemperatureSetpoint', 'setpoint', 5),
+                            ('PumpPower', 'pumppower', 5)]
     _stateflags = ['temperaturecontrol', 'externalcontrol', 'mainrelay_fault', 'overtemperature_fault',
                    'liquidlevel_fault', 'motor_overload_fault', 'external_connection_fault',
                    'cooling_fault', 'internal_pt100_fault', 'external_pt100_fault']
@@ -7,6 +7,10 @@ import weakref
 import re
 import multiprocessing
 import select
+import errno
+import fcntl
+import Queue
+import struct
 import modbus_tk.modbus_tcp
 import modbus_tk.defines
 import os
@@ -90,6 +94,7 @@ class InstrumentProperty(object):
                 obj._threadsafe_emit('instrumentproperty-error', self.name)
             elif self.is_warning(value) or (category == InstrumentPropertyCategory.WARNING):
                 obj._threadsafe_emit('instrumentproperty-warning', self.name)
+        obj._feed_snapshot(self.name)
         return True
 
     def is_error(self, value):
@@ -116,6 +121,61 @@ class InstrumentProperty(object):
                 return InstrumentPropertyCategory.NORMAL
 
 
+class InstrumentSnapshot(object):
+
+    """The latest known values of the current parameters of an instrument
+    (see Instrument.get_current_parameters()), for assembling headers without
+    communicating with the instrument.
+
+    Each field has a timestamp and a staleness bound: the maximal age (in
+    seconds) after which it has to be refreshed. Updating and reading are
+    thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # field name -> (value, timestamp, maxage)
+        self._fields = {}
+        # the time of the last update, None if never updated. An instrument
+        # may have no parameters at all (e.g. a TMCM without motors).
+        self.updated = None
+
+    def update(self, values, maxage, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            for key in values:
+                self._fields[key] = (values[key], timestamp, maxage)
+            self.updated = timestamp
+
+    def clear(self):
+        with self._lock:
+            self._fields = {}
+            self.updated = None
+
+    def __len__(self):
+        return len(self._fields)
+
+    def get(self, now=None):
+        """Return a dictionary of the field values and the list of the stale
+        fields."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            fields = self._fields.items()
+        return (dict((key, f[0]) for key, f in fields),
+                [key for key, f in fields if now - f[1] > f[2]])
+
+    def get_stale(self, margin=0, now=None):
+        """Return the names of the fields which are older than their
+        staleness bound minus `margin` seconds."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            fields = self._fields.items()
+        return [key for key, f in fields if now - f[1] > f[2] - margin]
+
+
 class Instrument(objwithgui.ObjWithGUI):
     __gsignals__ = {'controller-error': (GObject.SignalFlags.RUN_FIRST, None, (object,)),  # the instrument should emit this if a communication error occurs. The parameter is usually a string describing what went wrong.
                     # emitted when a successful connection to the instrument is
@@ -152,9 +212,22 @@ class Instrument(objwithgui.ObjWithGUI):
         type=int, minimum=0, default=3, blurb='Number of times reconnection is attempted after a sudden connection breakage')
     _enable_instrumentproperty_signals = None
     _logging_parameters = []
+    # the fields of get_current_parameters() which mirror instrument
+    # properties: (field name, instrument property name, max. age in sec). If
+    # empty, the snapshot is refreshed by calling get_current_parameters().
+    _snapshot_parameters = []
+    _snapshot_maxage = 5
+    # if get_current_parameters() only reads cached values, without
+    # communication: then it is used instead of the snapshot.
+    _current_parameters_cached = False
+    _snapshot_refresh_pending = False
 
     def __init__(self, name=None, offline=True):
         self._instrumentproperties = {}
+        self.snapshot = InstrumentSnapshot()
+        self._snapshot_index = {}
+        for key, propname, maxage in self._snapshot_parameters:
+            self._snapshot_index.setdefault(propname, []).append((key, maxage))
         if name is None:
             name = 'Unnamed instrument'
         self._name = name
@@ -231,6 +304,17 @@ class Instrument(objwithgui.ObjWithGUI):
             value = None
         return (value, self._instrumentproperties[propertyname][1], self._instrumentproperties[propertyname][2])
 
+    def get_cached_property(self, propertyname):
+        """Return the last known value of an instrument property without
+        communicating with the instrument, or None if it is unknown."""
+        try:
+            value, timestamp, category = self._instrumentproperties[propertyname]
+        except KeyError:
+            return None
+        if category == InstrumentPropertyCategory.UNKNOWN:
+            return None
+        return value
+
     def _update_instrumentproperties(self, propertyname=None):
         raise NotImplementedError
 
@@ -241,6 +325,54 @@ class Instrument(objwithgui.ObjWithGUI):
         for ip in self._get_instrumentproperties():
             self._instrumentproperties[ip] = (
                 None, 0, InstrumentPropertyCategory.UNKNOWN)
+        self.snapshot.clear()
+
+    def _feed_snapshot(self, propertyname):
+        if propertyname not in self._snapshot_index:
+            return
+        value, timestamp, category = self._instrumentproperties[propertyname]
+        if category == InstrumentPropertyCategory.UNKNOWN:
+            value = None
+        for key, maxage in self._snapshot_index[propertyname]:
+            self.snapshot.update({key: value}, maxage, timestamp)
+
+    def refresh_snapshot(self, margin=0):
+        """Refresh the fields of the snapshot which are (or in `margin`
+        seconds will be) stale. This communicates with the instrument, so it
+        should be called from a background thread."""
+        if self._current_parameters_cached:
+            # not used, see Equipments.get_snapshot().
+            return
+        if not self._snapshot_parameters:
+            updated = self.snapshot.updated
+            if ((updated is None) or (time.time() - updated > self._snapshot_maxage - margin) or
+                    self.snapshot.get_stale(margin)):
+                # get_current_parameters() may emit signals (e.g. when motor
+                # parameters are reloaded): it is called from the main loop.
+                if not self._snapshot_refresh_pending:
+                    self._snapshot_refresh_pending = True
+                    GLib.idle_add(self._refresh_snapshot_idle)
+            return
+        known = self.snapshot.get()[0]
+        stale = set(self.snapshot.get_stale(margin))
+        toupdate = set(propname for key, propname, maxage in self._snapshot_parameters
+                       if key in stale or key not in known)
+        if len(toupdate) > 1:
+            self._update_instrumentproperties(None)
+        elif toupdate:
+            self._update_instrumentproperties(toupdate.pop())
+
+    def _refresh_snapshot_idle(self):
+        try:
+            if self.connected():
+                self.snapshot.update(
+                    self.get_current_parameters(), self._snapshot_maxage)
+        except Exception:
+            logger.warning('Error while refreshing the state snapshot of %s: %s' % (
+                self._get_classname(), traceback.format_exc()))
+        finally:
+            self._snapshot_refresh_pending = False
+        return False
 
     def _restart_logger(self):
         self._stop_logger()
@@ -602,6 +734,159 @@ class Instrument_ModbusTCP(Instrument):
             self.host = address
 
 
+class MessageFraming(object):
+
+    """Defines how a stream of bytes received from an instrument is cut into
+    messages. Subclasses implement message_length(), which gets the receive
+    buffer (a bytearray) and the number of valid bytes in it, and returns the
+    length of the first complete message or None if more bytes are needed."""
+
+    def message_length(self, buf, nbytes):
+        raise NotImplementedError
+
+    def strip(self, message):
+        """Remove the framing information (separators, length prefixes) from
+        a complete message."""
+        return message
+
+    def resync(self, buf, nbytes):
+        """The number of bytes at the beginning of the buffer which cannot
+        start a valid message and have to be dropped, e.g. after a
+        misalignment of the stream."""
+        return 0
+
+
+class FixedLengthFraming(MessageFraming):
+
+    """Every message has the same length, e.g. 9 bytes for TMCL replies. If
+    "validate" is given, it is called with each candidate message (a
+    string), and the stream is shifted byte by byte until it returns True,
+    e.g. on a checksum error."""
+
+    def __init__(self, length, validate=None):
+        self.length = length
+        self.validate = validate
+
+    def message_length(self, buf, nbytes):
+        if nbytes >= self.length:
+            return self.length
+        return None
+
+    def resync(self, buf, nbytes):
+        if self.validate is None:
+            return 0
+        skip = 0
+        while (nbytes - skip >= self.length and
+               not self.validate(str(buf[skip:skip + self.length]))):
+            skip += 1
+        return skip
+
+
+class SeparatorFraming(MessageFraming):
+
+    """Messages are terminated by a separator string (e.g. '\\x18' for the
+    Pilatus camserver or CR for the Haake Phoenix circulator)."""
+
+    def __init__(self, separator, keep_separator=False):
+        self.separator = separator
+        self.keep_separator = keep_separator
+
+    def message_length(self, buf, nbytes):
+        idx = buf.find(self.separator, 0, nbytes)
+        if idx < 0:
+            return None
+        return idx + len(self.separator)
+
+    def strip(self, message):
+        if self.keep_separator:
+            return message
+        return message[:-len(self.separator)]
+
+
+class LengthPrefixedFraming(MessageFraming):
+
+    """Messages start with a binary length field, described by the struct
+    format string "prefixformat". If "includes_prefix" is True, the length
+    counts the prefix as well."""
+
+    def __init__(self, prefixformat='>H', includes_prefix=False, keep_prefix=False):
+        self.prefixformat = prefixformat
+        self.prefixlength = struct.calcsize(prefixformat)
+        self.includes_prefix = includes_prefix
+        self.keep_prefix = keep_prefix
+
+    def message_length(self, buf, nbytes):
+        if nbytes < self.prefixlength:
+            return None
+        length = struct.unpack_from(self.prefixformat, buffer(buf), 0)[0]
+        if not self.includes_prefix:
+            length += self.prefixlength
+        if nbytes >= length:
+            return length
+        return None
+
+    def strip(self, message):
+        if self.keep_prefix:
+            return message
+        return message[self.prefixlength:]
+
+
+class ReceiveBuffer(object):
+
+    """Preallocated receive buffer: recv_into() writes directly into it through
+    a memoryview, complete messages are cut from its beginning according to a
+    MessageFraming instance."""
+
+    def __init__(self, size=1024):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._nbytes = 0
+
+    def __len__(self):
+        return self._nbytes
+
+    def recv_from(self, sock):
+        if self._nbytes == len(self._buf):
+            # grow the buffer. The memoryview must be released first.
+            self._view = None
+            self._buf.extend(bytearray(len(self._buf)))
+            self._view = memoryview(self._buf)
+        nread = sock.recv_into(self._view[self._nbytes:])
+        self._nbytes += nread
+        return nread
+
+    def startswith(self, prefix):
+        return self._view[:len(prefix)].tobytes() == prefix
+
+    def pop_message(self, framing):
+        skip = framing.resync(self._buf, self._nbytes)
+        if skip:
+            logger.warning('Discarding %d bytes to resynchronize: ' % skip +
+                           self._view[:skip].tobytes().encode('hex'))
+            self._drop(skip)
+        length = framing.message_length(self._buf, self._nbytes)
+        if length is None:
+            return None
+        message = self._view[:length].tobytes()
+        self._drop(length)
+        return framing.strip(message)
+
+    def _drop(self, length):
+        self._buf[:self._nbytes - length] = self._buf[length:self._nbytes]
+        self._nbytes -= length
+
+    def pop_all_messages(self, framing):
+        messages = []
+        while True:
+            m = self.pop_message(framing)
+            if m is None:
+                return messages
+            messages.append(m)
+
+    def clear(self):
+        self._nbytes = 0
+
+
 class Instrument_TCP(Instrument):
     host = GObject.property(type=str, default='', blurb='Host name')
     port = GObject.property(
@@ -613,12 +898,21 @@ class Instrument_TCP(Instrument):
     _mesgseparator = None
     collector_sleep = GObject.property(
         type=float, minimum=0, default=0.1, blurb='Sleeping time for collector thread.')
+    io_reactor = GObject.property(
+        type=bool, default=True, blurb='Use the shared I/O reactor instead of a polling collector thread')
     _commands = None
+    # an instance of MessageFraming. If None, the end of a message is detected
+    # by the socket going quiet for timeout2 seconds.
+    _framing = None
 
     def __init__(self, name=None, offline=True):
         self._socket = None
         self._socketlock = multiprocessing.Lock()
-        self._inqueue = multiprocessing.queues.Queue()
+        self._inqueue = Queue.Queue()
+        self._rxbuffer = ReceiveBuffer()
+        self._socketfd = None
+        self._reactor = None
+        self._collector = None
         Instrument.__init__(self, name, offline)
 
     def connect_to_controller(self):
@@ -644,14 +938,9 @@ class Instrument_TCP(Instrument):
                     'Cannot establish TCP connection to instrument.')
             self._socket.settimeout(self.timeout)
             self._socket.setblocking(False)
+            self._rxbuffer.clear()
         try:
-            logger.debug(
-                'Starting up reply collector thread for socket %s:%d' % (self.host, self.port))
-            GLib.idle_add(self._check_inqueue)
-            self._collector = CommunicationCollector_TCP(
-                self._socket, self, self._inqueue, self._socketlock, self.collector_sleep, mesgseparator=self._mesgseparator)
-            self._collector.daemon = True
-            self._collector.start()
+            self._start_receiver()
             logger.debug('Running post-connect.')
             self._post_connect()
             logger.debug('Post-connect finished successfully.')
@@ -660,15 +949,8 @@ class Instrument_TCP(Instrument):
         except InstrumentError as ex:
             logger.debug(
                 'InstrumentError exception during post-socket-setup initialization: ' + traceback.format_exc())
-            if hasattr(self, '_collector'):
-                logger.debug('Stopping collector thread')
-                self._collector.kill.set()
-                try:
-                    self._collector.join()
-                except RuntimeError:
-                    pass
-                logger.debug('Collector thread stopped.')
             with self._socketlock:
+                self._stop_receiver()
                 if self._socket is not None:
                     self._socket.close()
                     self._socket = None
@@ -681,6 +963,39 @@ class Instrument_TCP(Instrument):
     def connected(self):
         return self._socket is not None
 
+    def _start_receiver(self):
+        """Start listening for asynchronous messages: either register our socket
+        to the shared I/O reactor or start a dedicated collector thread."""
+        if self.io_reactor:
+            logger.debug('Registering socket %s:%d to the I/O reactor' %
+                         (self.host, self.port))
+            self._socketfd = self._socket.fileno()
+            self._reactor = CommunicationReactor.get_instance()
+            self._reactor.register(self._socketfd, self._socket, self)
+        else:
+            logger.debug(
+                'Starting up reply collector thread for socket %s:%d' % (self.host, self.port))
+            GLib.idle_add(self._check_inqueue)
+            self._collector = CommunicationCollector_TCP(
+                self._socket, self, self._inqueue, self._socketlock, self.collector_sleep, mesgseparator=self._mesgseparator)
+            self._collector.daemon = True
+            self._collector.start()
+
+    def _stop_receiver(self):
+        """Counterpart of _start_receiver(). Must be called with the socket lock held."""
+        if self._reactor is not None:
+            self._reactor.unregister(self._socketfd)
+            self._reactor = None
+        if self._collector is not None:
+            logger.debug('Stopping collector thread')
+            self._collector.kill.set()
+            try:
+                self._collector.join()
+            except RuntimeError:
+                pass
+            self._collector = None
+            logger.debug('Collector thread stopped.')
+
     def disconnect_from_controller(self, status=True, reconnect=False):
         try:
             self._pre_disconnect(status)
@@ -689,13 +1004,9 @@ class Instrument_TCP(Instrument):
         logger.debug('Disconnecting.')
         self._stop_logger()
         with self._socketlock:
-            self._collector.kill.set()
-            try:
-                self._collector.join()
-            except RuntimeError:
-                pass
             if not self.connected():
                 return
+            self._stop_receiver()
             try:
                 self._socket.close()
             except socket.error:
@@ -710,6 +1021,8 @@ class Instrument_TCP(Instrument):
                                      self.reconnect_to_controller_after_error, self.reconnect_attempts_number)
 
     def _read_from_socket(self, timeout=None):
+        if self._framing is not None:
+            return self._read_framed(timeout)
         message = None
         try:
             if timeout is None:
@@ -789,39 +1102,183 @@ class Instrument_TCP(Instrument):
                      len(message) + ' hex: ' + ''.join('%x' % ord(c) for c in message))
         return message
 
+    def _read_framed(self, timeout=None):
+        """Read the next complete message, as defined by self._framing. Return
+        as soon as the message is complete."""
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        try:
+            while True:
+                message = self._rxbuffer.pop_message(self._framing)
+                if message is not None:
+                    return message
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    rlist, wlist, xlist = select.select(
+                        [self._socket], [], [self._socket], remaining)
+                else:
+                    rlist = xlist = []
+                if xlist:
+                    raise ConnectionBrokenError('socket is exceptional')
+                if not rlist:
+                    if len(self._rxbuffer):
+                        logger.warning('Discarding incomplete message: ' +
+                                       self._rxbuffer._view[:len(self._rxbuffer)].tobytes().encode('hex'))
+                        self._rxbuffer.clear()
+                    raise InstrumentError('Timeout while reading reply')
+                if not self._rxbuffer.recv_from(self._socket):
+                    raise ConnectionBrokenError(
+                        'empty string read from socket: other end hung up.')
+                if self._rxbuffer.startswith('\0\0\0'):
+                    self._rxbuffer.clear()
+                    raise ConnectionBrokenError(
+                        'reading only null bytes from socket: probably we are talking to ser2net with no device attached to the serial port.')
+        except ConnectionBrokenError as cbe:
+            logger.warning(
+                'Connection to instrument broken. Trying to reconnect. Error was: ' + traceback.format_exc())
+            GLib.idle_add(
+                lambda: (self.disconnect_from_controller(False, reconnect=True) and False))
+            raise cbe
+        except socket.error as se:
+            raise InstrumentError(
+                'Communication Error: ' + traceback.format_exc())
+
+    def _read_available(self):
+        """Read whatever is waiting on the socket without blocking and return the
+        list of complete messages. Called by the I/O reactor with the socket lock
+        held."""
+        try:
+            if self._framing is not None:
+                if not self._rxbuffer.recv_from(self._socket):
+                    raise ConnectionBrokenError(
+                        'Empty message received, the other end of the connection broke.')
+                return self._rxbuffer.pop_all_messages(self._framing)
+            data = self._socket.recv(CommunicationReactor.recvbufsize)
+        except socket.timeout:
+            return []
+        except socket.error as se:
+            if se.args and se.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise ConnectionBrokenError(
+                'Socket error: ' + traceback.format_exc())
+        if not data:
+            raise ConnectionBrokenError(
+                'Empty message received, the other end of the connection broke.')
+        if self._mesgseparator is not None:
+            # skip empty parts, e.g. when the message ends in a separator.
+            return [m for m in data.split(self._mesgseparator) if m]
+        return [data]
+
     def send_and_receive(self, command, blocking=True):
-        with self._socketlock:
+        try:
+            with self._socketlock:
+                return self._send_and_receive(command, blocking)
+        finally:
+            self._resume_reactor()
+
+    def _resume_reactor(self):
+        reactor = self._reactor
+        if reactor is not None:
+            # the reactor might have parked our socket while we were
+            # holding the lock.
+            reactor.resume(self._socketfd)
+
+    def _send_and_receive(self, command, blocking):
+        try:
+            self._socket.sendall(command)
+            if not blocking:
+                return None
+            if isinstance(blocking, float):
+                message = self._read_from_socket(blocking)
+            else:
+                message = self._read_from_socket(None)
+        except socket.error as err:
+            raise InstrumentError(
+                'TCP socket I/O error: ' + traceback.format_exc())
+        if self._framing is not None:
+            return self._select_reply(command, message)
+        if (self._mesgseparator is not None) and message.endswith(self._mesgseparator):
+            message = message[:-len(self._mesgseparator)]
+        if (self._mesgseparator is not None) and self._mesgseparator in message:
+            # if multiple messages received, only keep the first one which matches the current command,
+            # if the list of the available commands (self._commands) is
+            # defined (is not None)
             try:
-                self._socket.sendall(command)
-                if not blocking:
-                    return None
-                if isinstance(blocking, float):
-                    message = self._read_from_socket(blocking)
-                else:
-                    message = self._read_from_socket(None)
-            except socket.error as err:
-                raise InstrumentError(
-                    'TCP socket I/O error: ' + traceback.format_exc())
-            if (self._mesgseparator is not None) and message.endswith(self._mesgseparator):
-                message = message[:-len(self._mesgseparator)]
-            if (self._mesgseparator is not None) and self._mesgseparator in message:
-                # if multiple messages received, only keep the first one which matches the current command,
-                # if the list of the available commands (self._commands) is
-                # defined (is not None)
+                cmd = self._get_command(command)
+                mymessage = [
+                    m for m in message.split(self._mesgseparator) if cmd.match(m) is not None][0]
+                othermessages = [
+                    m for m in message.split(self._mesgseparator) if m != mymessage]
+            except (TypeError, IndexError, AttributeError):
+                mymessage = message.split(self._mesgseparator)[0]
+                othermessages = message.split(self._mesgseparator)[1:]
+            for m in othermessages:
+                self._enqueue_message(m)
+            return mymessage
+        else:
+            return message
+
+    def send_and_receive_multi(self, command, nreplies):
+        """Send "command" (which may contain several instrument commands
+        concatenated) and read "nreplies" replies in one go. Only for
+        instruments with a message framing. Returns the list of replies in the
+        order of arrival."""
+        if self._framing is None:
+            raise InstrumentError(
+                'Pipelined communication needs a message framing.')
+        try:
+            with self._socketlock:
                 try:
-                    cmd = self._get_command(command)
-                    mymessage = [
-                        m for m in message.split(self._mesgseparator) if cmd.match(m) is not None][0]
-                    othermessages = [
-                        m for m in message.split(self._mesgseparator) if m != mymessage]
-                except (TypeError, IndexError, AttributeError):
-                    mymessage = message.split(self._mesgseparator)[0]
-                    othermessages = message.split(self._mesgseparator)[1:]
-                for m in othermessages:
-                    self._inqueue.put(m)
-                return mymessage
-            else:
-                return message
+                    self._socket.sendall(command)
+                    return [self._read_framed(None) for i in range(nreplies)]
+                except socket.error as err:
+                    raise InstrumentError(
+                        'TCP socket I/O error: ' + traceback.format_exc())
+        finally:
+            self._resume_reactor()
+
+    def flush_input(self):
+        """Throw away everything received but not yet read, e.g. replies to an
+        earlier pipelined transaction which timed out."""
+        try:
+            with self._socketlock:
+                self._rxbuffer.clear()
+                if self._socket is None:
+                    return
+                while select.select([self._socket], [], [], 0)[0]:
+                    if not self._socket.recv(CommunicationReactor.recvbufsize):
+                        break
+        except socket.error:
+            pass
+        finally:
+            self._resume_reactor()
+
+    def _select_reply(self, command, message):
+        """Find the reply to "command" among "message" and the messages
+        received in the same burst. If self._commands is defined, further
+        messages are waited for, as long as they keep coming within timeout2.
+        Messages not belonging to the command are queued as asynchronous ones."""
+        messages = [message] + \
+            self._rxbuffer.pop_all_messages(self._framing)
+        cmd = self._get_command(command)
+        mymessage = None
+        while cmd is not None:
+            try:
+                mymessage = [m for m in messages if cmd.match(m) is not None][0]
+                break
+            except IndexError:
+                pass
+            try:
+                messages.append(self._read_framed(self.timeout2))
+            except InstrumentError:
+                break
+        if mymessage is None:
+            mymessage = messages[0]
+        messages.remove(mymessage)
+        for m in messages:
+            self._enqueue_message(m)
+        return mymessage
 
     def _get_command(self, command):
         try:
@@ -829,6 +1286,20 @@ class Instrument_TCP(Instrument):
         except (AttributeError, IndexError):
             return None
 
+    def _enqueue_message(self, mesg):
+        """Queue an asynchronous message for processing in the main loop."""
+        self._inqueue.put(mesg)
+        if self._reactor is not None:
+            GLib.idle_add(self._dispatch_inqueue)
+
+    def _dispatch_inqueue(self):
+        while True:
+            try:
+                mesg = self._inqueue.get_nowait()
+            except Queue.Empty:
+                return False
+            self.interpret_message(mesg, None)
+
     def _check_inqueue(self):
         try:
             mesg = self._inqueue.get_nowait()
@@ -886,6 +1357,168 @@ class CommunicationCollector_TCP(CommunicationCollector):
         return message
 
 
+class CommunicationReactor(threading.Thread):
+
+    """A single thread serving the sockets of all connected Instrument_TCP
+    instances. It sleeps in epoll (or poll, where epoll is not available) until
+    data arrives on one of the registered sockets, then hands the data over to
+    the owning instrument, which queues the messages for interpret_message().
+
+    If the socket lock of an instrument is held by a synchronous transaction
+    (send_and_receive()), the reply belongs to that transaction: the socket is
+    "parked", i.e. removed from the poll set, until resume() is called after
+    the lock has been released.
+
+    Use get_instance() instead of instantiating this class.
+    """
+    _instance = None
+    _instancelock = threading.Lock()
+    recvbufsize = 4096
+
+    def __init__(self):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._eventmask = select.EPOLLIN | select.EPOLLPRI
+            self._errormask = select.EPOLLERR | select.EPOLLHUP
+        else:
+            self._poller = select.poll()
+            self._eventmask = select.POLLIN | select.POLLPRI
+            self._errormask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        # self-pipe for waking up the poller when the poll set changes.
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(
+                fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poller.register(self._wakeup_read, self._eventmask)
+        self._lock = threading.Lock()
+        self._sockets = {}
+        self._parked = set()
+        self.kill = threading.Event()
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instancelock:
+            if cls._instance is None or not cls._instance.is_alive():
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def register(self, fd, sock, instrument):
+        with self._lock:
+            self._sockets[fd] = (sock, weakref.ref(instrument))
+            self._parked.discard(fd)
+            self._poller.register(fd, self._eventmask)
+        self._wakeup()
+
+    def unregister(self, fd):
+        with self._lock:
+            if self._sockets.pop(fd, None) is None:
+                return
+            if fd in self._parked:
+                self._parked.remove(fd)
+            else:
+                self._unregister_fd(fd)
+        self._wakeup()
+
+    def park(self, fd):
+        with self._lock:
+            if (fd in self._sockets) and (fd not in self._parked):
+                self._unregister_fd(fd)
+                self._parked.add(fd)
+
+    def resume(self, fd):
+        with self._lock:
+            if fd not in self._parked:
+                return
+            self._parked.remove(fd)
+            self._poller.register(fd, self._eventmask)
+        self._wakeup()
+
+    def stop(self):
+        self.kill.set()
+        self._wakeup()
+
+    def _unregister_fd(self, fd):
+        try:
+            self._poller.unregister(fd)
+        except (KeyError, IOError, ValueError):
+            pass
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, '\0')
+        except OSError as ose:
+            # the pipe is full, so the poller will wake up anyway.
+            if ose.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read, 1024):
+                pass
+        except OSError as ose:
+            if ose.errno != errno.EAGAIN:
+                raise
+
+    def run(self):
+        logger.debug('Communication reactor thread starting.')
+        while not self.kill.is_set():
+            try:
+                events = self._poller.poll()
+            except (IOError, select.error) as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wakeup_read:
+                    self._drain_wakeup()
+                else:
+                    self._handle_event(fd, event)
+        logger.debug('Communication reactor thread ending.')
+
+    def _handle_event(self, fd, event):
+        with self._lock:
+            try:
+                sock, instrument = self._sockets[fd]
+            except KeyError:
+                # unregistered in the meantime.
+                return
+        instrument = instrument()
+        if instrument is None:
+            self.unregister(fd)
+            return
+        if not instrument._socketlock.acquire(False):
+            # a synchronous transaction is going on, which will read the data.
+            self.park(fd)
+            if instrument._socketlock.acquire(False):
+                # the transaction has finished before we could park the
+                # socket: resume() might have been missed.
+                instrument._socketlock.release()
+                self.resume(fd)
+            return
+        try:
+            if (event & self._errormask) and not (event & self._eventmask):
+                raise ConnectionBrokenError('Socket in exceptional state')
+            # the data might have been consumed by a synchronous transaction
+            # between poll() and acquiring the lock. Do not block on recv().
+            if not select.select([sock], [], [], 0)[0]:
+                return
+            messages = instrument._read_available()
+        except ConnectionBrokenError:
+            logger.warning(
+                'Communication error in CommunicationReactor: shutting down socket. Error: %s' % traceback.format_exc())
+            self.unregister(fd)
+            GLib.idle_add(
+                lambda: (instrument.disconnect_from_controller(False, reconnect=True) and False))
+            return
+        finally:
+            instrument._socketlock.release()
+        for m in messages:
+            instrument._enqueue_message(m)
+
+
 class CommandReply(object):
 
     """This class implements a reply to a command. Each command can have multiple replies.
@@ -1,4 +1,4 @@
-from .instrument import Instrument_TCP, InstrumentError, InstrumentStatus, Command, CommandReply, InstrumentProperty, InstrumentPropertyCategory, InstrumentPropertyUnknown
+from .instrument import Instrument_TCP, InstrumentError, InstrumentStatus, Command, CommandReply, InstrumentProperty, InstrumentPropertyCategory, InstrumentPropertyUnknown, SeparatorFraming
 import dateutil.parser
 import logging
 import datetime
@@ -184,6 +184,7 @@ class Pilatus(Instrument_TCP):
             'default-gain'] = {objwithgui.OWG_Hint_Type.ChoicesList: ['lowG', 'midG', 'highG']}
         Instrument_TCP.__init__(self, name, offline)
         self._mesgseparator = '\x18'
+        self._framing = SeparatorFraming(self._mesgseparator)
         self.timeout = 1
         self._status_lock = threading.RLock()
         self._exposure_starttime = None
@@ -414,7 +415,7 @@ class Pilatus(Instrument_TCP):
         else:
             # maybe this is not the message for us: queue it back
             if putback_if_no_match:
-                self._inqueue.put(message)
+                self._enqueue_message(message)
             else:
                 raise PilatusError(
                     'Cannot match message, putback disabled: ' + message)
@@ -4,11 +4,12 @@ import multiprocessing.queues
 import weakref
 import ConfigParser
 import numbers
+import traceback
 from gi.repository import GObject
 from gi.repository import GLib
 import nxs
 
-from .instrument import Instrument_TCP, InstrumentError, InstrumentStatus, ConnectionBrokenError
+from .instrument import Instrument_TCP, InstrumentError, InstrumentStatus, ConnectionBrokenError, FixedLengthFraming
 from test.test_zipfile64 import OtherTests
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -18,6 +19,10 @@ class MotorError(InstrumentError):
     pass
 
 
+def _checksum_ok(message):
+    return sum(ord(x) for x in message[:-1]) % 256 == ord(message[-1])
+
+
 class TMCMModuleStatus(InstrumentStatus):
     Moving = 'moving'
     Queued = 'queued'
@@ -42,8 +47,14 @@ class TMCMModule(Instrument_TCP):
         type=int, minimum=1, default=3, blurb='Number of retries on communication failure')
     savesettings_delay = GObject.property(
         type=float, minimum=0, default=0.5, blurb='Delay for saving settings')
+    batch_size = GObject.property(
+        type=int, minimum=1, default=16, blurb='Maximum number of TMCL commands sent back-to-back')
     _motor_counter = 1
     _max_motors_in_motion = 1
+    # the motor positions are kept up to date by the motor reports.
+    _current_parameters_cached = True
+    # set while a version query (136) is being answered
+    _version_query_pending = False
 
     def __init__(self, name='motordriver', offline=True):
         self.motors = {}
@@ -51,6 +62,8 @@ class TMCMModule(Instrument_TCP):
         self.f_clk = 16000000
         self._adjust_hwtype()
         Instrument_TCP.__init__(self, name, offline)
+        # TMCL replies are always 9 bytes long.
+        self._framing = FixedLengthFraming(9, self._reply_ok)
         self.timeout = 0.1
         self.timeout2 = 0.1
         self.recvbufsize = 8
@@ -109,6 +122,10 @@ class TMCMModule(Instrument_TCP):
                 return
             cp = ConfigParser.ConfigParser()
             cp.read(filename)
+            if self.connected():
+                # read the positions of all motors in a single round trip.
+                self.reload_motor_parameters(
+                    list(self.motors.values()), ['Current_position'])
             for m in self.motors:
                 self.motors[m].save_to_configparser(cp)
             with open(filename, 'w') as f:
@@ -140,6 +157,11 @@ class TMCMModule(Instrument_TCP):
     def do_communication(self, cmd):
         raise NotImplementedError
 
+    def _reply_ok(self, message):
+        # the reply to the version query (136) may come without a checksum,
+        # but only if one has been sent.
+        return _checksum_ok(message) or (self._version_query_pending and ord(message[3]) == 136)
+
     def interpret_message(self, message, command=None):
         if command is None:
             logger.warning(
@@ -177,14 +199,17 @@ class TMCMModule(Instrument_TCP):
                 'Status not OK! TMCM response: ' + ''.join('%x' % ord(m) for m in message))
         return value
 
+    def _build_command(self, instruction, type_=0, mot_bank=0, value=0):
+        cmd = (1, instruction, type_, mot_bank) + \
+            struct.unpack('4B', struct.pack('>i', int(value)))
+        cmd = cmd + (sum(cmd) % 256,)
+        logger.debug(
+            'About to send TMCL command: ' + ''.join(('%02x' % x) for x in cmd))
+        return ''.join(chr(x) for x in cmd)
+
     def execute(self, instruction, type_=0, mot_bank=0, value=0):
         if instruction is not None:
-            cmd = (1, instruction, type_, mot_bank) + \
-                struct.unpack('4B', struct.pack('>i', int(value)))
-            cmd = cmd + (sum(cmd) % 256,)
-            logger.debug(
-                'About to send TMCL command: ' + ''.join(('%02x' % x) for x in cmd))
-            cmd = ''.join(chr(x) for x in cmd)
+            cmd = self._build_command(instruction, type_, mot_bank, value)
         else:
             cmd = None
         logger.debug(
@@ -192,20 +217,28 @@ class TMCMModule(Instrument_TCP):
         # self.send_recv_retries-1 to 0.
         for i in reversed(range(self.send_recv_retries)):
             try:
-                result = self.send_and_receive(cmd, True)
+                self._version_query_pending = (instruction == 136)
+                try:
+                    result = self.send_and_receive(cmd, True)
+                finally:
+                    self._version_query_pending = False
                 value = self.interpret_message(result, instruction)
                 break
             except MotorError as exc:
+                # a late reply to the failed command may still be coming.
+                self.flush_input()
                 if not i:  # all retries exhausted
                     raise exc
                 logger.warning(
                     'Communication error; retrying (%d retries left): ' % i + traceback.format_exc())
             except (ConnectionBrokenError, InstrumentError) as exc:
+                self.flush_input()
                 logger.error('Connection of instrument %s broken: ' %
                              self._get_classname() + traceback.format_exc())
                 raise MotorError(
                     'Connection broken: ' + traceback.format_exc())
             except Exception as exc:
+                self.flush_input()
                 logger.error('Instrument error on module %s: ' %
                              self.hwtype + traceback.format_exc())
                 raise MotorError('Instrument error: ' + traceback.format_exc())
@@ -216,6 +249,76 @@ class TMCMModule(Instrument_TCP):
         # command.
         return value
 
+    def execute_batch(self, commands):
+        """Execute several TMCL commands, sending them back-to-back without
+        waiting for the replies in between. "commands" is a list of tuples
+        (instruction, type_, mot_bank, value), where trailing elements can be
+        omitted, as in execute(). At most "batch_size" commands are in flight
+        at the same time. The replies are matched to the commands by their
+        position, module address and command byte. TMCL replies do not repeat
+        the type and the motor bank, so each chunk is closed by a version
+        query: if its reply is not the last one, the replies are misaligned
+        and the chunk is retried. Returns the list of the reply values.
+
+        A failed batch is retried as a whole, so only use this with commands
+        which can be safely repeated (e.g. GAP, SAP).
+        """
+        commands = [(tuple(c) + (0, 0, 0))[:4] for c in commands]
+        values = []
+        for start in range(0, len(commands), self.batch_size):
+            chunk = commands[start:start + self.batch_size] + [(136, 1, 0, 0)]
+            mesg = ''.join(self._build_command(*c) for c in chunk)
+            # self.send_recv_retries-1 to 0.
+            for i in reversed(range(self.send_recv_retries)):
+                try:
+                    # each chunk ends with a version query
+                    self._version_query_pending = True
+                    try:
+                        replies = self.send_and_receive_multi(mesg, len(chunk))
+                    finally:
+                        self._version_query_pending = False
+                    for r in replies:
+                        if ord(r[1]) != 1:
+                            raise MotorError(
+                                'Invalid reply from TMCM module: wrong module address.')
+                    values.extend([self.interpret_message(r, c[0])
+                                   for r, c in zip(replies, chunk)][:-1])
+                    break
+                except MotorError as exc:
+                    # replies to the failed batch may still be coming.
+                    self.flush_input()
+                    if not i:  # all retries exhausted
+                        raise exc
+                    logger.warning(
+                        'Communication error in batch; retrying (%d retries left): ' % i + traceback.format_exc())
+                except (ConnectionBrokenError, InstrumentError) as exc:
+                    self.flush_input()
+                    logger.error('Connection of instrument %s broken: ' %
+                                 self._get_classname() + traceback.format_exc())
+                    raise MotorError(
+                        'Connection broken: ' + traceback.format_exc())
+                except Exception as exc:
+                    self.flush_input()
+                    logger.error('Instrument error on module %s: ' %
+                                 self.hwtype + traceback.format_exc())
+                    raise MotorError(
+                        'Instrument error: ' + traceback.format_exc())
+        return values
+
+    def reload_motor_parameters(self, motors, paramnames=None):
+        """Reload axis parameters of several motors in one batch."""
+        if paramnames is None:
+            params = [p for p in self.motor_params
+                      if p.axisparameter_idx is not None]
+        else:
+            params = [p for p in self.motor_params
+                      if (p.name in paramnames) and (p.axisparameter_idx is not None)]
+        values = self.execute_batch(
+            [(6, p.axisparameter_idx, m.mot_idx) for m in motors for p in params])
+        for i, m in enumerate(motors):
+            m._update_stateparams(
+                zip(params, values[i * len(params):(i + 1) * len(params)]))
+
     def get_version(self):
         ver = self.execute(136, 1)
         if ver / 0x10000 == 0x015f:
@@ -564,6 +667,26 @@ class StepperMotor(GObject.GObject):
                 self.reload_parameters(missing_dep)
             return motpar.to_phys(self._stateparams[name], self._stateparams)
 
+    def get_parameters(self, names, raw=False, force_refresh=False):
+        """Get the values of several parameters, reading all of them (and the
+        missing ones they depend on) from the controller in a single batch.
+        Unlike get_parameter(), force_refresh only applies to the requested
+        parameters, not to their dependencies."""
+        motpars = [[m for m in self.driver().motor_params if m.name == name][0]
+                   for name in names]
+        toreload = [n for n in names
+                    if (n not in self._stateparams) or force_refresh]
+        if not raw:
+            for motpar in motpars:
+                toreload.extend([p for p in motpar.depends
+                                 if (p not in self._stateparams) and (p not in toreload)])
+        if toreload:
+            self.reload_parameters(toreload)
+        if raw:
+            return [self._stateparams[name] for name in names]
+        return [motpar.to_phys(self._stateparams[motpar.name], self._stateparams)
+                for motpar in motpars]
+
     def set_parameter(self, name, value, raw=False):
         logger.debug('Motor ' + self.alias + ' set_parameter: ' + name)
         motpar = [m for m in self.driver().motor_params if m.name == name][0]
@@ -665,9 +788,10 @@ class StepperMotor(GObject.GObject):
             except KeyError:
                 pass
 
-    def check_limits(self):
-        newlims = (self.get_parameter('Left_limit_status', force_refresh=True),
-                   self.get_parameter('Right_limit_status', force_refresh=True))
+    def check_limits(self, newlims=None):
+        if newlims is None:
+            newlims = tuple(self.get_parameters(
+                ['Left_limit_status', 'Right_limit_status'], force_refresh=True))
         if self._limitdata is None or self._limitdata != newlims:
             self._limitdata = newlims
             self.emit('motor-limit', *self._limitdata)
@@ -689,12 +813,11 @@ class StepperMotor(GObject.GObject):
 
     def motor_monitor(self):
         try:
-            speed = self.get_parameter('Current_speed', force_refresh=True)
-            load = self.get_parameter('Current_load', force_refresh=True)
-            pos = self.get_parameter('Current_position', force_refresh=True)
+            speed, load, pos, left, right = self.get_parameters(
+                ['Current_speed', 'Current_load', 'Current_position', 'Left_limit_status', 'Right_limit_status'], force_refresh=True)
             if (pos < self.get_parameter('soft_left')) or (pos > self.get_parameter('soft_right')):
                 self.stop()
-            self.check_limits()
+            self.check_limits((left, right))
             self.emit('motor-report', pos, speed, load)
             if speed != 0:
                 return True
@@ -759,17 +882,29 @@ class StepperMotor(GObject.GObject):
                 self.name, 'Settings_changed_timeout')
 
     def reload_parameters(self, paramname=None):
-        if paramname is not None:
+        """Reload a parameter (if "paramname" is a string), a list of
+        parameters or all parameters (if None) from the controller, in a single
+        batch."""
+        if paramname is None:
+            params = self.driver().motor_params
+        elif isinstance(paramname, basestring):
             params = [
                 p for p in self.driver().motor_params if p.name == paramname]
         else:
-            params = self.driver().motor_params
+            params = [
+                p for p in self.driver().motor_params if p.name in paramname]
+        params = [p for p in params if p.axisparameter_idx is not None]
+        if not params:
+            return
+        values = self.driver().execute_batch(
+            [(6, par.axisparameter_idx, self.mot_idx) for par in params])
+        self._update_stateparams(zip(params, values))
+
+    def _update_stateparams(self, newvalues):
+        """Update the cached parameters from a list of (MotorParameter, raw
+        value) tuples. Emit settings-changed if anything changed."""
         changed = False
-        for par in params:
-            if par.axisparameter_idx is None:
-                continue
-            newval = self.driver().execute(
-                6, par.axisparameter_idx, self.mot_idx)
+        for par, newval in newvalues:
             if (par.name not in self._stateparams) or (newval != self._stateparams[par.name]):
                 self._stateparams[par.name] = newval
                 changed = True
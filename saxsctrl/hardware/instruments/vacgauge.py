@@ -1,4 +1,4 @@
-from .instrument import Instrument_TCP, InstrumentError, ConnectionBrokenError, InstrumentProperty, InstrumentPropertyCategory
+from .instrument import Instrument_TCP, InstrumentError, ConnectionBrokenError, InstrumentProperty, InstrumentPropertyCategory, SeparatorFraming
 import logging
 from gi.repository import GObject
 from gi.repository import GLib
@@ -13,6 +13,7 @@ class VacuumGaugeError(InstrumentError):
 
 
 class VacuumGauge(Instrument_TCP):
+    _framing = SeparatorFraming('\r', keep_separator=True)
     send_recv_retries = GObject.property(
         type=int, minimum=1, default=3, blurb='Number of retries on communication failure')
     pressure = InstrumentProperty(
@@ -0,0 +1,27 @@
+__all__ = ['filewatcher', 'framebuffer', 'cbf', 'fsnindex', 'headercatalog', 'sharding', 'scancontainer', 'nexuswriter', 'asyncwriter', 'specindex', 'archive', 'curvestore']
+
+import filewatcher
+import framebuffer
+import cbf
+import fsnindex
+import headercatalog
+import sharding
+import scancontainer
+import nexuswriter
+import asyncwriter
+import specindex
+import archive
+import curvestore
+
+from filewatcher import *
+from framebuffer import *
+from cbf import *
+from fsnindex import *
+from headercatalog import *
+from sharding import *
+from scancontainer import *
+from nexuswriter import *
+from asyncwriter import *
+from specindex import *
+from archive import *
+from curvestore import *
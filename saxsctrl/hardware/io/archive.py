@@ -0,0 +1,290 @@
+import threading
+import argparse
+import hashlib
+import sqlite3
+import logging
+import errno
+import os
+
+import h5py
+import numpy as np
+
+from .fsnindex import FSNIndex
+from .sharding import find_shards
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['ArchiveError', 'ARCHIVED_SUBDIRS', 'collect', 'pack', 'verify', 'extract',
+           'ArchiveIndex']
+
+# subfolders of the root folder packed into the archives
+ARCHIVED_SUBDIRS = ['images', 'param', 'param_override', 'eval2d', 'eval1d']
+
+
+class ArchiveError(StandardError):
+    pass
+
+
+def _checksum(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def collect(rootpath, prefix, fsnmin, fsnmax, subdirs=ARCHIVED_SUBDIRS):
+    """List the files with `prefix` and FSN between `fsnmin` and `fsnmax`
+    (inclusive) in the `subdirs` of `rootpath` and in their shard
+    directories. Returns a list of (subdir, full path, fsn) tuples."""
+    files = []
+    for subdir in subdirs:
+        basedir = os.path.realpath(os.path.join(rootpath, subdir))
+        if not os.path.isdir(basedir):
+            continue
+        for directory in [basedir] + find_shards(basedir):
+            for name in sorted(os.listdir(directory)):
+                m = FSNIndex.filename_re.match(name)
+                if (m is None) or (m.group('prefix') != prefix):
+                    continue
+                fsn = int(m.group('fsn'))
+                path = os.path.join(directory, name)
+                if fsnmin <= fsn <= fsnmax and os.path.isfile(path):
+                    files.append((subdir, path, fsn))
+    return files
+
+
+def _store(group, name, data, compression, **attrs):
+    dataset = group.create_dataset(
+        name, data=np.frombuffer(data, np.uint8), chunks=True if data else None,
+        compression=compression if data else None)
+    dataset.attrs['sha1'] = _checksum(data)
+    for key in attrs:
+        dataset.attrs[key] = attrs[key]
+    return dataset
+
+
+def pack(rootpath, archivename, prefix, fsnmin, fsnmax, remove=False, compression='gzip'):
+    """Pack the files of the exposures with `prefix` and FSNs from `fsnmin`
+    to `fsnmax` (scattering images, raw and reduced headers, reduced 2D data
+    and 1D curves, see collect()) into the HDF5 file `archivename`.
+
+    Every file is stored byte-for-byte as a chunked, compressed uint8
+    dataset /files/<subdir>/<file name>, with its SHA-1 checksum, FSN and
+    modification time as attributes. The mask files referred to by the
+    packed headers are stored in /masks, but never removed. The archive is
+    verified after it has been written: if `remove` is True and the
+    checksums of all stored files match those of the originals, the
+    originals are deleted, together with the shard directories left empty.
+
+    Returns the number of exposures (FSNs) packed.
+    """
+    if os.path.exists(archivename):
+        raise ArchiveError('Archive %s already exists.' % archivename)
+    files = collect(rootpath, prefix, fsnmin, fsnmax)
+    if not files:
+        raise ArchiveError('No files to pack with prefix %s between FSNs %d and %d.' %
+                           (prefix, fsnmin, fsnmax))
+    checksums = {}
+    headertexts = []
+    with h5py.File(archivename, 'w') as f:
+        f.attrs['prefix'] = prefix
+        f.attrs['fsnmin'] = fsnmin
+        f.attrs['fsnmax'] = fsnmax
+        for subdir, path, fsn in files:
+            group = f.require_group('files/' + subdir)
+            name = os.path.basename(path)
+            if name in group:
+                # the same file in a shard directory and in the flat layout
+                logger.warning('Skipping duplicate file %s.' % path)
+                continue
+            with open(path, 'rb') as datafile:
+                data = datafile.read()
+            _store(group, name, data, compression, fsn=fsn, mtime=os.stat(path).st_mtime)
+            checksums[(subdir, name)] = (_checksum(data), path)
+            if name.endswith('.param'):
+                headertexts.append(data)
+        maskdir = os.path.join(rootpath, 'mask')
+        if os.path.isdir(maskdir):
+            masks = f.require_group('masks')
+            for name in sorted(os.listdir(maskdir)):
+                root = os.path.splitext(name)[0]
+                if any(root in text for text in headertexts):
+                    with open(os.path.join(maskdir, name), 'rb') as maskfile:
+                        _store(masks, name, maskfile.read(), compression)
+    bad = verify(archivename, dict((key, checksums[key][0]) for key in checksums))
+    if bad:
+        raise ArchiveError('Verification of archive %s failed for: %s' % (archivename, ', '.join(bad)))
+    if remove:
+        for checksum, path in checksums.itervalues():
+            os.unlink(path)
+        for subdir in ARCHIVED_SUBDIRS:
+            for shard in find_shards(os.path.join(rootpath, subdir)):
+                if not os.listdir(shard):
+                    os.rmdir(shard)
+                    if not os.listdir(os.path.dirname(shard)):
+                        os.rmdir(os.path.dirname(shard))
+    return len(set(fsn for subdir, path, fsn in files))
+
+
+def verify(archivename, checksums=None):
+    """Check the stored files of an archive against their checksums: the
+    ones in `checksums`, a dict of (subdir, file name) -> SHA-1 hex digest,
+    or if None, the ones stored in the archive. Returns the list of the bad
+    or missing files."""
+    bad = []
+    with h5py.File(archivename, 'r') as f:
+        if checksums is None:
+            checksums = {}
+            for subdir in f.get('files', {}):
+                for name, dataset in f['files'][subdir].iteritems():
+                    checksums[(subdir, name)] = dataset.attrs['sha1']
+        for (subdir, name), checksum in sorted(checksums.iteritems()):
+            try:
+                data = f['files'][subdir][name][()].tostring()
+            except KeyError:
+                bad.append(subdir + '/' + name)
+                continue
+            if _checksum(data) != checksum:
+                bad.append(subdir + '/' + name)
+    return bad
+
+
+def extract(archivename, subdir, name, destination):
+    """Write the file `name` from `subdir` of the archive (or a mask file if
+    `subdir` is 'masks') to the directory `destination`. Returns the full
+    path of the written file."""
+    with h5py.File(archivename, 'r') as f:
+        if subdir == 'masks':
+            dataset = f['masks'][name]
+        else:
+            dataset = f['files'][subdir][name]
+        data = dataset[()].tostring()
+        checksum = dataset.attrs['sha1']
+    if _checksum(data) != checksum:
+        raise ArchiveError('Checksum mismatch for %s/%s in archive %s' % (subdir, name, archivename))
+    try:
+        os.makedirs(destination)
+    except OSError as ose:
+        if ose.errno != errno.EEXIST:
+            raise
+    path = os.path.join(destination, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+class ArchiveIndex(object):
+
+    """Index of the files packed into the archives of a directory, stored
+    in an sqlite database. Archives are only read when they are new or
+    modified since they were indexed. The methods can be called from any
+    thread.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(dbfile, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS archives '
+                             '(archive TEXT PRIMARY KEY, mtime REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files '
+                             '(archive TEXT, subdir TEXT, name TEXT, prefix TEXT, fsn INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_prefix_fsn '
+                             'ON files (prefix, fsn)')
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def sync(self, directory):
+        """Make the index cover exactly the archives (*.h5) in `directory`."""
+        try:
+            archives = [os.path.join(directory, a) for a in os.listdir(directory) if a.endswith('.h5')]
+        except OSError:
+            archives = []
+        with self._lock:
+            known = dict(self._db.execute('SELECT archive, mtime FROM archives'))
+            with self._db:
+                for a in set(known) - set(archives):
+                    self._db.execute('DELETE FROM files WHERE archive=?', (a,))
+                    self._db.execute('DELETE FROM archives WHERE archive=?', (a,))
+            for a in archives:
+                mtime = os.stat(a).st_mtime
+                if known.get(a) != mtime:
+                    self._add(a, mtime)
+
+    def _add(self, archive, mtime):
+        rows = []
+        try:
+            with h5py.File(archive, 'r') as f:
+                for subdir in f.get('files', {}):
+                    for name, dataset in f['files'][subdir].iteritems():
+                        m = FSNIndex.filename_re.match(name)
+                        rows.append((archive, subdir, name, m.group('prefix'), int(dataset.attrs['fsn'])))
+        except (IOError, KeyError, AttributeError):
+            logger.warning('Cannot index archive %s: not a SAXSCtrl archive?' % archive)
+            return
+        logger.info('Indexed archive %s (%d files).' % (archive, len(rows)))
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM files WHERE archive=?', (archive,))
+                self._db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', rows)
+                self._db.execute('INSERT OR REPLACE INTO archives VALUES (?, ?)', (archive, mtime))
+
+    def find(self, prefix, fsn):
+        """The archived files with `prefix` and `fsn`, as a list of (archive,
+        subdir, file name) tuples."""
+        with self._lock:
+            return self._db.execute('SELECT archive, subdir, name FROM files WHERE prefix=? AND fsn=?',
+                                    (prefix, fsn)).fetchall()
+
+    def max_fsn(self, prefix):
+        """The highest archived FSN with `prefix`, or None if there is none."""
+        with self._lock:
+            return self._db.execute('SELECT MAX(fsn) FROM files WHERE prefix=?', (prefix,)).fetchone()[0]
+
+    def min_fsn(self, prefix):
+        """The lowest archived FSN with `prefix`, or None if there is none."""
+        with self._lock:
+            return self._db.execute('SELECT MIN(fsn) FROM files WHERE prefix=?', (prefix,)).fetchone()[0]
+
+    def is_taken(self, prefix, fsn):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM files WHERE prefix=? AND fsn=? LIMIT 1',
+                                    (prefix, fsn)).fetchone() is not None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pack the files of an FSN range of a SAXSCtrl root folder into an HDF5 archive '
+        'in the "archive" subfolder. The files are read back from the archive transparently by '
+        'the data reduction.')
+    parser.add_argument('rootpath', help='SAXSCtrl root folder')
+    parser.add_argument('first', type=int, help='First FSN')
+    parser.add_argument('last', type=int, help='Last FSN')
+    parser.add_argument('--prefix', default='crd', help='File name prefix (default: %(default)s)')
+    parser.add_argument('--archive', default=None,
+                        help='Archive file name (default: <rootpath>/archive/<prefix>_<first>-<last>.h5)')
+    parser.add_argument('--remove', action='store_true',
+                        help='Remove the original files after the archive has been verified')
+    parser.add_argument('--compression', default='gzip', help='HDF5 compression filter (default: %(default)s)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Only verify the checksums of the files in an existing archive')
+    args = parser.parse_args()
+    logging.basicConfig()
+    archivename = args.archive
+    if archivename is None:
+        archivedir = os.path.join(args.rootpath, 'archive')
+        if not os.path.isdir(archivedir):
+            os.mkdir(archivedir)
+        archivename = os.path.join(archivedir, '%s_%d-%d.h5' % (args.prefix, args.first, args.last))
+    if args.verify:
+        bad = verify(archivename)
+        print '%s: %s' % (archivename, ['OK', 'bad files: ' + ', '.join(bad)][bool(bad)])
+    else:
+        print '%s: %d exposures packed%s.' % (
+            archivename, pack(args.rootpath, archivename, args.prefix, args.first, args.last,
+                              args.remove, args.compression),
+            ['', ', originals removed'][args.remove])
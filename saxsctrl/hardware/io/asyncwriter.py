@@ -0,0 +1,173 @@
+import itertools
+import threading
+import traceback
+import logging
+import Queue
+import os
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['AsyncFileWriter', 'temporary_name', 'write_atomic']
+
+_counter = itertools.count()
+
+
+def temporary_name(filename):
+    """A unique temporary file name in the directory of `filename`. The
+    extension is kept (the sastool I/O plugins are selected by it), and the
+    name starts with a dot, so it does not look like a data file."""
+    dirname, basename = os.path.split(filename)
+    root, ext = os.path.splitext(basename)
+    return os.path.join(dirname, '.%s.%d.%d.tmp%s' % (root, os.getpid(), next(_counter), ext))
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def write_atomic(filename, writer, fsync=False):
+    """Call `writer` with a temporary file name, then rename the written file
+    to `filename`. Readers see either the old or the complete new file."""
+    tmpname = temporary_name(filename)
+    try:
+        writer(tmpname)
+        if fsync:
+            _fsync_path(tmpname)
+        os.rename(tmpname, filename)
+    except:
+        _remove(tmpname)
+        raise
+
+
+class AsyncFileWriter(object):
+
+    """Write files in a background thread.
+
+    submit() queues a job: a list of (filename, writer) pairs, where writer
+    is a callable writing the file to the name it is called with. Each file
+    is written to a temporary file (see temporary_name()), which is renamed
+    to its final name atomically when done. The jobs waiting in the queue
+    (at most `batchsize`) are committed together: all files are written
+    first, then fsync-ed if `fsync` is True, then renamed, and finally each
+    directory involved is fsync-ed once.
+
+    The callback of a job is called from the writer thread with the list of
+    file names and None on success, or the formatted traceback of the first
+    error. Files of a failed job are not renamed, their temporary files are
+    removed.
+
+    The job queue is bounded (`maxjobs`): if the writer lags behind,
+    submit() blocks.
+    """
+
+    def __init__(self, maxjobs=256, batchsize=32, fsync=True):
+        self._queue = Queue.Queue(maxjobs)
+        self._thread = None
+        self.batchsize = batchsize
+        self.fsync = fsync
+
+    def is_running(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """Write the queued jobs, then stop the writer thread."""
+        if self._thread is None:
+            return
+        if self._thread.is_alive():
+            self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, files, callback=None):
+        self._queue.put((list(files), callback))
+
+    def flush(self):
+        """Wait until all jobs submitted so far have been committed."""
+        if self.is_running():
+            self._queue.join()
+
+    def _worker(self):
+        while True:
+            batch = [self._queue.get()]
+            while (batch[-1] is not None) and (len(batch) < self.batchsize):
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self._commit([job for job in batch if job is not None])
+            except Exception:
+                logger.error('Error in the file writer thread: ' +
+                             traceback.format_exc())
+            for job in batch:
+                self._queue.task_done()
+            if batch[-1] is None:
+                break
+
+    def _commit(self, jobs):
+        results = []
+        for files, callback in jobs:
+            tmpnames = []
+            error = None
+            try:
+                for filename, writer in files:
+                    tmpnames.append(temporary_name(filename))
+                    writer(tmpnames[-1])
+                if self.fsync:
+                    for tmpname in tmpnames:
+                        _fsync_path(tmpname)
+            except Exception:
+                error = traceback.format_exc()
+                for tmpname in tmpnames:
+                    _remove(tmpname)
+            results.append([files, tmpnames, callback, error])
+        directories = set()
+        for result in results:
+            files, tmpnames, callback, error = result
+            if error is not None:
+                continue
+            try:
+                for (filename, writer), tmpname in zip(files, tmpnames):
+                    os.rename(tmpname, filename)
+                    directories.add(os.path.dirname(os.path.abspath(filename)))
+            except OSError:
+                result[3] = traceback.format_exc()
+                for tmpname in tmpnames:
+                    _remove(tmpname)
+        if self.fsync:
+            for directory in directories:
+                try:
+                    _fsync_path(directory)
+                except OSError:
+                    logger.warning('Cannot fsync directory %s: %s' % (
+                        directory, traceback.format_exc()))
+        for files, tmpnames, callback, error in results:
+            if error is not None:
+                logger.error('Error while writing %s: %s' % (
+                    ', '.join(f for f, w in files), error))
+            if callback is None:
+                continue
+            try:
+                callback([f for f, w in files], error)
+            except Exception:
+                logger.error('Error in the callback of the file writer: ' +
+                             traceback.format_exc())
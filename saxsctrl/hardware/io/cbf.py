@@ -0,0 +1,277 @@
+import collections
+import dateutil.parser
+import numpy as np
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['CBFError', 'CBFHeader', 'CBFReader', 'byte_offset_decompress', 'readcbf']
+
+CBF_BINARY_START = '\x0c\x1a\x04\xd5'
+
+_PILATUS_VALUE_RE = re.compile(
+    r'^(?P<number>-?(\d+(.\d+)?(e-?\d+)?))\s+(?P<unit>m|s|counts|eV)$')
+_PILATUS_LINE_RE = re.compile(
+    r'^(?P<label>[a-zA-Z0-9,_\.\-!\?\ ]*?)\s+(?P<number>-?(\d+(.\d+)?(e-?\d+)?))\s+(?P<unit>m|s|counts|eV)$')
+_BINARY_PARAMETER_RE = re.compile(
+    r'^\s*(X-Binary-Size|X-Binary-Size-Fastest-Dimension|X-Binary-Size-Second-Dimension|'
+    r'X-Binary-Element-Type|conversions)\s*[:=]\s*"?([^"\r\n]*)"?\s*$', re.MULTILINE)
+
+
+class CBFError(StandardError):
+    pass
+
+
+def _parse_header(text):
+    """Parse the text part of a Pilatus mini-CBF file. The keys and values are
+    the same as those of sastool.io.twodim.readcbf()."""
+    header = {}
+    readingmode = None
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line or line == ';':
+            continue
+        elif line.startswith('_array_data.header_convention'):
+            header['CBF_header_convention'] = line[
+                len('_array_data.header_convention'):].strip().replace('"', '')
+        elif line.startswith('_array_data.header_contents'):
+            readingmode = 'PilatusHeader'
+        elif line.startswith('_array_data.data'):
+            readingmode = 'CIFHeader'
+        elif readingmode == 'PilatusHeader':
+            if not line.startswith('#'):
+                continue
+            line = line[1:].strip()
+            try:
+                header['CBF_Date'] = dateutil.parser.parse(line)
+                header['Date'] = header['CBF_Date']
+                continue
+            except (ValueError, TypeError, OverflowError):
+                pass
+            treated = False
+            for sep in (':', '='):
+                if line.count(sep) == 1:
+                    name, value = tuple(x.strip() for x in line.split(sep, 1))
+                    m = _PILATUS_VALUE_RE.match(value)
+                    if m is not None:
+                        value = float(m.group('number'))
+                    header[name] = value
+                    treated = True
+                    break
+            if treated:
+                continue
+            if line.startswith('Pixel_size'):
+                header['XPixel'], header['YPixel'] = tuple(
+                    [float(a.strip().split(' ')[0]) * 1000 for a in line[len('Pixel_size'):].split('x')])
+            else:
+                m = _PILATUS_LINE_RE.match(line)
+                if m is not None:
+                    if m.group('unit') == 'counts':
+                        header[m.group('label')] = int(m.group('number'))
+                    else:
+                        header[m.group('label')] = float(m.group('number'))
+                    if 'sensor' in m.group('label') and 'thickness' in m.group('label'):
+                        header[m.group('label')] *= 1e6
+        elif readingmode == 'CIFHeader':
+            for sep in (':', '='):
+                if line.count(sep) == 1:
+                    label, content = tuple(x.strip()
+                                           for x in line.split(sep, 1))
+                    content = content.replace('"', '')
+                    try:
+                        content = int(content)
+                    except ValueError:
+                        pass
+                    header['CBF_' + label] = content
+    return header
+
+
+class CBFHeader(collections.Mapping):
+
+    """Header of a CBF file, parsed only when first accessed."""
+
+    def __init__(self, text):
+        self._text = text
+        self._header = None
+
+    def _parsed(self):
+        if self._header is None:
+            self._header = _parse_header(self._text)
+            self._text = None
+        return self._header
+
+    def __getitem__(self, key):
+        return self._parsed()[key]
+
+    def __iter__(self):
+        return iter(self._parsed())
+
+    def __len__(self):
+        return len(self._parsed())
+
+    def __repr__(self):
+        return 'CBFHeader(' + repr(self._parsed()) + ')'
+
+
+def _gather(raw, positions, size):
+    """Little-endian signed integers of `size` (2 or 4) bytes, starting at
+    `positions` in the uint8 array `raw`."""
+    positions = np.minimum(positions, len(raw) - size)
+    value = np.zeros(len(positions), np.uint32)
+    for k in range(size):
+        value |= raw[positions + k].astype(np.uint32) << (8 * k)
+    if size == 2:
+        return value.astype(np.uint16).view(np.int16)
+    return value.view(np.int32)
+
+
+def byte_offset_decompress(stream, npixels, out=None, scratch=None):
+    """Decompress `npixels` values from a CBF byte-offset compressed stream
+    (a string, bytearray or uint8 array).
+
+    Every byte is taken as a one-byte delta, then the escaped (two- or
+    four-byte) deltas are decoded and their trailing bytes dropped, all with
+    vectorized numpy operations, and the deltas are summed up with a
+    cumulative sum.
+
+    The result is written into the flat array `out` if given. `scratch` can
+    be a tuple of an int32 and a bool array, each at least as long as the
+    stream, which are then used for the intermediate results. Otherwise new
+    arrays are allocated.
+    """
+    if isinstance(stream, np.ndarray):
+        raw = stream.view(np.uint8)
+    else:
+        raw = np.frombuffer(stream, dtype=np.uint8)
+    nbytes = len(raw)
+    if scratch is None:
+        scratch = (np.empty(nbytes, np.int32), np.empty(nbytes, np.bool_))
+    values, keep = scratch[0][:nbytes], scratch[1][:nbytes]
+    values[:] = raw.view(np.int8)
+    np.equal(raw, 0x80, keep)
+    candidates = np.flatnonzero(keep)
+    keep[:] = True
+    if len(candidates):
+        # decode every 0x80 byte as if it started an escape sequence.
+        delta = _gather(raw, candidates + 1, 2).astype(np.int32)
+        islong = delta == -32768
+        delta[islong] = _gather(raw, candidates[islong] + 3, 4)
+        ends = candidates + np.where(islong, 7, 3)
+        # some of the 0x80 bytes can be inside the escape sequence started by
+        # a previous one. The first one is surely an escape: the others are
+        # genuine if not covered by a previous genuine escape sequence.
+        genuine = np.ones(len(candidates), np.bool_)
+        while True:
+            reach = np.maximum.accumulate(np.where(genuine, ends, 0))
+            newgenuine = np.ones_like(genuine)
+            newgenuine[1:] = reach[:-1] <= candidates[1:]
+            if (newgenuine == genuine).all():
+                break
+            genuine = newgenuine
+        candidates = candidates[genuine]
+        delta = delta[genuine]
+        islong = islong[genuine]
+        if (delta[islong] == -2147483648).any():
+            raise CBFError('64-bit deltas are not supported')
+        values[candidates] = delta
+        for k in (1, 2):
+            keep[candidates + k] = False
+        for k in (3, 4, 5, 6):
+            keep[candidates[islong] + k] = False
+    if out is None:
+        out = np.empty(npixels, np.double)
+    ndeltas = np.count_nonzero(keep)
+    if ndeltas < npixels:
+        raise CBFError('Too few values in the byte-offset stream: %d instead of %d' % (
+            ndeltas, npixels))
+    np.compress(keep, values, out=values[:ndeltas])
+    np.cumsum(values[:npixels], dtype=out.dtype, out=out)
+    return out
+
+
+class CBFReader(object):
+
+    """Reader of Pilatus "x-CBF_BYTE_OFFSET" compressed mini-CBF files.
+
+    The file contents and the intermediate results of the decompression are
+    stored in buffers kept between calls, so reading a series of images of
+    the same size does not allocate new memory, apart from the returned array
+    (which can also be supplied by the caller).
+    """
+
+    def __init__(self):
+        self._filebuffer = bytearray()
+        self._scratch = (np.empty(0, np.int32), np.empty(0, np.bool_))
+
+    def _read_file(self, filename):
+        with open(filename, 'rb') as f:
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(0)
+            if len(self._filebuffer) < size:
+                self._filebuffer = bytearray(size)
+            view = memoryview(self._filebuffer)[:size]
+            nread = 0
+            while nread < size:
+                n = f.readinto(view[nread:])
+                if not n:
+                    break
+                nread += n
+        return nread
+
+    def read(self, filename, out=None, load_header=True):
+        """Read the image in `filename`. Return the intensity matrix (the rows
+        in the order of the file, the same as sastool.io.twodim.readcbf()
+        without `for_nexus`) and the header (a CBFHeader instance, or None if
+        `load_header` is False).
+
+        `out` can be a preallocated double array of the right shape, or of at
+        least the right size, in which case a view of it is returned.
+        """
+        size = self._read_file(filename)
+        datastart = self._filebuffer.find(CBF_BINARY_START, 0, size)
+        if datastart < 0:
+            raise CBFError('Binary section not found in file ' + filename)
+        text = str(self._filebuffer[:datastart])
+        datastart += len(CBF_BINARY_START)
+        params = dict(_BINARY_PARAMETER_RE.findall(
+            text[text.find('_array_data.data'):]))
+        try:
+            if params['conversions'] != 'x-CBF_BYTE_OFFSET':
+                raise CBFError('Unsupported compression in CBF file %s: %s' %
+                               (filename, params['conversions']))
+            if params['X-Binary-Element-Type'] != 'signed 32-bit integer':
+                raise CBFError('Unsupported element type in CBF file %s: %s' %
+                               (filename, params['X-Binary-Element-Type']))
+            nbytes = int(params['X-Binary-Size'])
+            shape = (int(params['X-Binary-Size-Second-Dimension']),
+                     int(params['X-Binary-Size-Fastest-Dimension']))
+        except KeyError as ke:
+            raise CBFError('Missing binary parameter %s in CBF file %s' %
+                           (ke.args[0], filename))
+        if datastart + nbytes > size:
+            raise CBFError('Truncated CBF file: ' + filename)
+        npixels = shape[0] * shape[1]
+        if len(self._scratch[0]) < nbytes:
+            self._scratch = (
+                np.empty(nbytes, np.int32), np.empty(nbytes, np.bool_))
+        if out is None:
+            out = np.empty(shape, np.double)
+        elif out.size < npixels or not out.flags.c_contiguous:
+            raise CBFError(
+                'Output array too small or not contiguous for CBF file ' + filename)
+        out = out.reshape(-1)[:npixels]
+        byte_offset_decompress(np.frombuffer(self._filebuffer, np.uint8, nbytes, datastart),
+                               npixels, out, self._scratch)
+        if load_header:
+            header = CBFHeader(text)
+        else:
+            header = None
+        return out.reshape(shape), header
+
+
+def readcbf(filename, out=None, load_header=True):
+    """Read a Pilatus mini-CBF file. See CBFReader.read()."""
+    return CBFReader().read(filename, out, load_header)
@@ -0,0 +1,161 @@
+import threading
+import logging
+import h5py
+import numpy as np
+
+from .headercatalog import CATALOG_FIELDS, HeaderCatalog
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['CurveStore', 'CURVE_COLUMNS']
+
+CURVE_COLUMNS = ['q', 'Intensity', 'Error', 'qError']
+
+_POINT_DTYPE = np.dtype([(column, np.double) for column in CURVE_COLUMNS])
+_INDEX_DTYPE = np.dtype([('prefix', h5py.special_dtype(vlen=str)),
+                         ('start', np.int64), ('length', np.int64)] +
+                        [(column, {str: h5py.special_dtype(vlen=str), int: np.int64,
+                                   float: np.double}[type_])
+                         for field, column, type_ in CATALOG_FIELDS])
+
+
+class CurveStore(object):
+
+    """Consolidated store of the radially averaged curves in a single HDF5
+    file, keyed by file name prefix and FSN.
+
+    The points of all curves are concatenated in the extendable, chunked
+    compound dataset /points (with the fields in CURVE_COLUMNS). The
+    compound dataset /index has one row per curve: prefix, start and length
+    of the curve in /points, and the header fields of the header catalog
+    (see CATALOG_FIELDS). The points are written before the index row, so
+    an interrupted append leaves at most unreferenced points, or an
+    incomplete last index row which is dropped by the next append. Curves
+    are only appended: if an exposure is reduced again, the latest curve is
+    used.
+
+    read() loads each requested curve by reading its own slice of /points.
+    The methods can be called from any thread.
+    """
+
+    def __init__(self, filename, compression='gzip'):
+        self.filename = filename
+        self.compression = compression
+        self._lock = threading.Lock()
+
+    def _create(self, f):
+        f.create_dataset('points', (0,), _POINT_DTYPE, maxshape=(None,), chunks=(4096,),
+                         compression=self.compression)
+        f.create_dataset('index', (0,), _INDEX_DTYPE, maxshape=(None,), chunks=(256,))
+
+    def _check(self, f):
+        # drop the index rows of interrupted appends: returns the number of
+        # valid rows.
+        index = f['index']
+        npoints = f['points'].shape[0]
+        n = index.shape[0]
+        while n and not (0 < index[n - 1]['length'] and
+                         index[n - 1]['start'] + index[n - 1]['length'] <= npoints):
+            n -= 1
+        if n < index.shape[0]:
+            logger.warning('Dropping %d incomplete row(s) of the index of curve store %s.' %
+                           (index.shape[0] - n, self.filename))
+            index.resize((n,))
+        return n
+
+    def append(self, prefix, curve, header):
+        """Append a curve (a SASCurve or a structured array with the fields in
+        CURVE_COLUMNS; missing ones are stored as NaN) with the metadata from
+        its header. `prefix` is the file name prefix of the exposure."""
+        data = np.array(curve)
+        if not len(data):
+            return
+        points = np.empty(len(data), _POINT_DTYPE)
+        for column in CURVE_COLUMNS:
+            if column in data.dtype.names:
+                points[column] = data[column]
+            else:
+                points[column] = np.nan
+        row = np.zeros(1, _INDEX_DTYPE)
+        row['prefix'] = prefix
+        row['length'] = len(data)
+        for (field, column, type_), value in zip(CATALOG_FIELDS, HeaderCatalog.record(header)):
+            if value is None:
+                value = {str: '', int: -1, float: np.nan}[type_]
+            row[column] = value
+        with self._lock:
+            with h5py.File(self.filename, 'a') as f:
+                if 'index' not in f:
+                    self._create(f)
+                n = self._check(f)
+                start = f['points'].shape[0]
+                f['points'].resize((start + len(points),))
+                f['points'][start:] = points
+                row['start'] = start
+                f['index'].resize((n + 1,))
+                f['index'][n] = row[0]
+
+    def _latest(self, index, prefix, fsns):
+        # the row of the last curve of each FSN with `prefix`
+        rows = {}
+        for row, (p, fsn) in enumerate(zip(index['prefix'], index['fsn'])):
+            if p == prefix:
+                rows[int(fsn)] = row
+        if fsns is None:
+            return rows
+        return dict((fsn, rows[fsn]) for fsn in fsns if fsn in rows)
+
+    def _open(self):
+        # the store for reading, or None if there is nothing stored yet.
+        try:
+            f = h5py.File(self.filename, 'r')
+        except IOError:
+            return None
+        if 'index' not in f:
+            f.close()
+            return None
+        return f
+
+    def fsns(self, prefix):
+        return sorted(self.metadata(prefix))
+
+    def metadata(self, prefix, fsns=None):
+        """The metadata of the curves of `fsns` (default: all) with `prefix`,
+        as a dict of FSN -> dict of the header catalog columns."""
+        with self._lock:
+            f = self._open()
+            if f is None:
+                return {}
+            with f:
+                index = f['index'][()]
+        rows = self._latest(index, prefix, fsns)
+        columns = [column for field, column, type_ in CATALOG_FIELDS]
+        return dict((fsn, dict((column, index[row][column]) for column in columns))
+                    for fsn, row in rows.iteritems())
+
+    def select(self, prefix, title=None, fsnmin=None, fsnmax=None):
+        """The FSNs of the stored curves with `prefix` of sample `title`,
+        between `fsnmin` and `fsnmax`."""
+        return sorted(fsn for fsn, meta in self.metadata(prefix).iteritems()
+                      if (title is None or meta['title'] == title) and
+                      (fsnmin is None or fsn >= fsnmin) and
+                      (fsnmax is None or fsn <= fsnmax))
+
+    def read(self, prefix, fsns=None):
+        """Load the curves of `fsns` (default: all) with `prefix`. Returns a
+        dict of FSN -> structured array with the fields in CURVE_COLUMNS."""
+        result = {}
+        with self._lock:
+            f = self._open()
+            if f is None:
+                return {}
+            with f:
+                index = f['index'][()]
+                rows = self._latest(index, prefix, fsns)
+                points = f['points']
+                # in the order of the file
+                for fsn, row in sorted(rows.iteritems(), key=lambda x: index[x[1]]['start']):
+                    start = index[row]['start']
+                    result[fsn] = points[start:start + index[row]['length']]
+        return result
@@ -0,0 +1,203 @@
+import collections
+import ctypes
+import ctypes.util
+import logging
+import select
+import struct
+import time
+import os
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['FileArrivalWatcher', 'is_network_filesystem']
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'ncpfs',
+                       'fuse.sshfs', 'ceph', 'glusterfs', 'lustre', '9p')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _libc.inotify_init1
+            _libc.inotify_add_watch
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+
+def is_network_filesystem(path):
+    """Check if `path` is on a network filesystem, where inotify does not
+    see the changes made by other hosts."""
+    path = os.path.realpath(path)
+    best = ('', None)
+    try:
+        with open('/proc/mounts', 'rt') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mountpoint = fields[1].decode('string_escape')
+                if ((path == mountpoint or path.startswith(mountpoint.rstrip('/') + '/')) and
+                        len(mountpoint) > len(best[0])):
+                    best = (mountpoint, fields[2])
+    except IOError:
+        return False
+    return best[1] in NETWORK_FILESYSTEMS
+
+
+class FileArrivalWatcher(object):
+
+    """Detect the arrival of complete files in a directory.
+
+    On Linux, inotify is used and a file is reported the moment the writer
+    closes it (IN_CLOSE_WRITE) or moves it into the directory. If inotify is
+    not available or the directory is on a network filesystem, the directory
+    is polled every `pollinterval` seconds and a file is considered complete
+    when its size and modification time did not change for `settletime`
+    seconds. Set `polling` to force either method.
+
+    The watcher is not thread- or fork-safe: create one in each process.
+    """
+
+    def __init__(self, path, pollinterval=0.01, settletime=0.05, polling=None, maxremembered=10000):
+        self.path = path
+        self.pollinterval = pollinterval
+        self.settletime = settletime
+        self.maxremembered = maxremembered
+        self._fd = None
+        # file name -> time of arrival
+        self._arrived = collections.OrderedDict()
+        # file name -> ((size, mtime), time when first seen so)
+        self._polled = {}
+        if polling is None:
+            polling = is_network_filesystem(path)
+        if not polling:
+            try:
+                self._start_inotify()
+            except OSError:
+                logger.warning('Cannot watch %s with inotify, falling back to polling: %s' % (
+                    path, os.strerror(ctypes.get_errno())))
+        self._started = time.time()
+        self.stats = {'arrived': 0, 'waited': 0, 'timeouts': 0, 'waittime': 0.}
+
+    @property
+    def polling(self):
+        return self._fd is None
+
+    def _start_inotify(self):
+        libc = _get_libc()
+        if not libc:
+            raise OSError('inotify is not available')
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        if libc.inotify_add_watch(fd, self.path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch')
+        self._fd = fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+    def _remember(self, name, t):
+        if name not in self._arrived:
+            self.stats['arrived'] += 1
+        self._arrived[name] = t
+        while len(self._arrived) > self.maxremembered:
+            self._arrived.popitem(last=False)
+
+    def _read_events(self, timeout):
+        """Wait at most `timeout` seconds for inotify events and register the
+        arrived files."""
+        if not select.select([self._fd], [], [], max(timeout, 0))[0]:
+            return
+        t = time.time()
+        try:
+            buf = os.read(self._fd, 65536)
+        except OSError:
+            return
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning(
+                    'Inotify event queue overflow while watching ' + self.path)
+            elif name:
+                self._remember(name, t)
+
+    def _poll(self, name):
+        try:
+            os.stat(self.path)  # refresh the attribute cache on NFS
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            return False
+        state = (st.st_size, st.st_mtime)
+        now = time.time()
+        if name not in self._polled or self._polled[name][0] != state:
+            self._polled[name] = (state, now)
+        elif st.st_size > 0 and now - self._polled[name][1] >= self.settletime:
+            del self._polled[name]
+            self._remember(name, now)
+            return True
+        return False
+
+    def arrival_time(self, name):
+        """Return the time when file `name` was seen complete, or None."""
+        return self._arrived.get(name)
+
+    def wait_for(self, name, timeout, stopswitch=None, checkinterval=0.05):
+        """Wait for the file `name` in the watched directory to become
+        complete.
+
+        Returns the full path and the time of arrival, or None if it did not
+        arrive in `timeout` seconds or if `stopswitch` (an Event) got set.
+        """
+        t0 = time.time()
+        self.stats['waited'] += 1
+        try:
+            if self._fd is not None:
+                self._read_events(0)
+                if name not in self._arrived:
+                    try:
+                        mtime = os.stat(os.path.join(self.path, name)).st_mtime
+                    except OSError:
+                        pass
+                    else:
+                        if mtime < self._started:
+                            # written before we started watching.
+                            self._remember(name, self._started)
+            while name not in self._arrived:
+                if stopswitch is not None and stopswitch.is_set():
+                    return None
+                remaining = timeout - (time.time() - t0)
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    return None
+                if self._fd is not None:
+                    self._read_events(min(remaining, checkinterval))
+                elif not self._poll(name):
+                    time.sleep(min(remaining, self.pollinterval))
+            return os.path.join(self.path, name), self._arrived.pop(name)
+        finally:
+            self.stats['waittime'] += time.time() - t0
@@ -0,0 +1,130 @@
+import multiprocessing.sharedctypes
+import cPickle as pickle
+import numpy as np
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['FrameRingBuffer', 'FrameRingBufferError']
+
+SLOT_FREE = 0
+SLOT_READY = 1
+
+# fields of the per-slot metadata
+_META_STATE = 0
+_META_ROWS = 1
+_META_COLUMNS = 2
+_META_HEADERLENGTH = 3
+_META_TAG = 4
+_META_FIELDS = 5
+
+
+class FrameRingBufferError(StandardError):
+    pass
+
+
+class FrameRingBuffer(object):
+
+    """Ring buffer of detector frames in shared memory.
+
+    Each of the `nslots` slots holds an intensity and an error matrix of at
+    most `maxpixels` pixels and a pickled header dictionary of at most
+    `maxheader` bytes. The buffer has to be created before forking the
+    processes which use it.
+
+    A writer process fills a slot with write(), which waits until the slot is
+    free. The reader gets numpy views of the slot contents with read() and
+    gives the slot back with release(). The views are only valid until then:
+    copy the data if it has to be kept. Frames can be tagged with an integer
+    (e.g. the FSN), to avoid releasing a slot which has been reused since.
+    """
+
+    def __init__(self, nslots=8, maxpixels=619 * 487, maxheader=65536):
+        self.nslots = nslots
+        self.maxpixels = maxpixels
+        self.maxheader = maxheader
+        self._data = multiprocessing.sharedctypes.RawArray(
+            'd', nslots * 2 * maxpixels)
+        self._headers = multiprocessing.sharedctypes.RawArray(
+            'c', nslots * maxheader)
+        self._meta = multiprocessing.sharedctypes.RawArray(
+            'l', nslots * _META_FIELDS)
+
+    def _check_slot(self, slot):
+        if slot < 0 or slot >= self.nslots:
+            raise FrameRingBufferError('Invalid slot: %d' % slot)
+
+    def _arrays(self, slot, shape):
+        size = shape[0] * shape[1]
+        data = np.frombuffer(self._data, dtype=np.double)
+        offset = slot * 2 * self.maxpixels
+        return (data[offset:offset + size].reshape(shape),
+                data[offset + self.maxpixels:offset + self.maxpixels + size].reshape(shape))
+
+    def _headerbuffer(self, slot):
+        return np.frombuffer(self._headers, dtype=np.uint8)[slot * self.maxheader:(slot + 1) * self.maxheader]
+
+    def fits(self, shape):
+        return len(shape) == 2 and shape[0] * shape[1] <= self.maxpixels
+
+    def is_free(self, slot):
+        self._check_slot(slot)
+        return self._meta[slot * _META_FIELDS + _META_STATE] == SLOT_FREE
+
+    def write(self, slot, intensity, header, error=None, tag=0, stopswitch=None, pollinterval=0.001):
+        """Write a frame into `slot`, waiting until it is free. If `error` is
+        None, the square root of the intensity is used. Returns False if the
+        frame does not fit or if `stopswitch` was set while waiting."""
+        self._check_slot(slot)
+        headerdata = pickle.dumps(dict(header), pickle.HIGHEST_PROTOCOL)
+        if not self.fits(intensity.shape) or len(headerdata) > self.maxheader:
+            return False
+        while not self.is_free(slot):
+            if stopswitch is None:
+                time.sleep(pollinterval)
+            elif stopswitch.wait(pollinterval):
+                return False
+        intensityview, errorview = self._arrays(slot, intensity.shape)
+        intensityview[:] = intensity
+        if error is None:
+            np.clip(intensity, 0, None, errorview)
+            np.sqrt(errorview, errorview)
+        else:
+            errorview[:] = error
+        self._headerbuffer(slot)[:len(headerdata)] = np.frombuffer(
+            headerdata, dtype=np.uint8)
+        meta = slot * _META_FIELDS
+        self._meta[meta + _META_ROWS] = intensity.shape[0]
+        self._meta[meta + _META_COLUMNS] = intensity.shape[1]
+        self._meta[meta + _META_HEADERLENGTH] = len(headerdata)
+        self._meta[meta + _META_TAG] = tag
+        self._meta[meta + _META_STATE] = SLOT_READY
+        return True
+
+    def read(self, slot, tag=None):
+        """Return views of the intensity and error matrices in `slot` and the
+        header dictionary."""
+        self._check_slot(slot)
+        meta = slot * _META_FIELDS
+        if self._meta[meta + _META_STATE] != SLOT_READY:
+            raise FrameRingBufferError('No frame in slot %d' % slot)
+        if tag is not None and self._meta[meta + _META_TAG] != tag:
+            raise FrameRingBufferError(
+                'Frame in slot %d has tag %d instead of %d' % (slot, self._meta[meta + _META_TAG], tag))
+        intensity, error = self._arrays(
+            slot, (self._meta[meta + _META_ROWS], self._meta[meta + _META_COLUMNS]))
+        header = pickle.loads(
+            self._headerbuffer(slot)[:self._meta[meta + _META_HEADERLENGTH]].tostring())
+        return intensity, error, header
+
+    def release(self, slot, tag=None):
+        self._check_slot(slot)
+        meta = slot * _META_FIELDS
+        if tag is None or self._meta[meta + _META_TAG] == tag:
+            self._meta[meta + _META_STATE] = SLOT_FREE
+
+    def reset(self):
+        for slot in range(self.nslots):
+            self.release(slot)
@@ -0,0 +1,155 @@
+import threading
+import sqlite3
+import logging
+import re
+import os
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['FSNIndex']
+
+
+class FSNIndex(object):
+
+    """Persistent index of the file sequence numbers (FSNs) of the files in a
+    set of directories, stored in an sqlite database.
+
+    File names are split to a prefix and an FSN as <prefix>_<fsn>[...]. A
+    directory is only listed when it is indexed for the first time or when
+    its modification time changed since then (e.g. files were written while
+    we were not running): otherwise the index is to be kept current by
+    calling add() and remove() when files appear or disappear. Lookups by
+    prefix use the (prefix, fsn) index of the database, thus are O(log n).
+
+    Only one process should use the database at a time, but the methods can
+    be called from any thread.
+    """
+    filename_re = re.compile(r'(?P<prefix>[a-zA-Z0-9]+)_(?P<fsn>\d+)')
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(dbfile, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS directories '
+                             '(directory TEXT PRIMARY KEY, mtime REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files '
+                             '(directory TEXT, name TEXT, prefix TEXT, fsn INTEGER, '
+                             'PRIMARY KEY (directory, name))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_prefix_fsn '
+                             'ON files (prefix, fsn)')
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _parse(self, name):
+        m = self.filename_re.match(name)
+        if m is None:
+            return None
+        return m.group('prefix'), int(m.group('fsn'))
+
+    def sync(self, directories):
+        """Make the index cover exactly `directories`. Directories not seen
+        before or modified since they were indexed are (re)listed, the others
+        are not touched."""
+        with self._lock:
+            known = dict(self._db.execute('SELECT directory, mtime FROM directories'))
+            with self._db:
+                for d in set(known) - set(directories):
+                    self._db.execute('DELETE FROM files WHERE directory=?', (d,))
+                    self._db.execute('DELETE FROM directories WHERE directory=?', (d,))
+            for d in directories:
+                try:
+                    mtime = os.stat(d).st_mtime
+                except OSError:
+                    logger.warning('Cannot index directory ' + d)
+                    continue
+                if known.get(d) != mtime:
+                    self._scan(d, mtime)
+
+    def _scan(self, directory, mtime):
+        logger.debug('Indexing directory ' + directory)
+        rows = []
+        for name in os.listdir(directory):
+            parsed = self._parse(name)
+            if parsed is not None:
+                rows.append((directory, name) + parsed)
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM files WHERE directory=?', (directory,))
+                self._db.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', rows)
+                self._db.execute('INSERT OR REPLACE INTO directories VALUES (?, ?)',
+                                 (directory, mtime))
+
+    def rescan(self, directory):
+        """List `directory` again and include it in the index."""
+        self._scan(directory, os.stat(directory).st_mtime)
+
+    def add(self, directory, name):
+        """Register the file `name` in `directory`. Returns the prefix and
+        the FSN, or None if the file name does not contain an FSN."""
+        parsed = self._parse(name)
+        with self._lock:
+            with self._db:
+                if parsed is not None:
+                    self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                     (directory, name) + parsed)
+                self._touch(directory)
+        return parsed
+
+    def remove(self, directory, name):
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM files WHERE directory=? AND name=?',
+                                 (directory, name))
+                self._touch(directory)
+
+    def _touch(self, directory):
+        # the index is current: record the modification time of the
+        # directory, so that it is not listed again on the next sync().
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+        self._db.execute('UPDATE directories SET mtime=? WHERE directory=?', (mtime, directory))
+
+    def prefixes(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT DISTINCT prefix FROM files')]
+
+    def max_fsn(self, prefix):
+        """The highest FSN with `prefix`, or None if there is none."""
+        with self._lock:
+            return self._db.execute('SELECT MAX(fsn) FROM files WHERE prefix=?', (prefix,)).fetchone()[0]
+
+    def min_fsn(self, prefix):
+        """The lowest FSN with `prefix`, or None if there is none."""
+        with self._lock:
+            return self._db.execute('SELECT MIN(fsn) FROM files WHERE prefix=?', (prefix,)).fetchone()[0]
+
+    def is_taken(self, prefix, fsn):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM files WHERE prefix=? AND fsn=? LIMIT 1',
+                                    (prefix, fsn)).fetchone() is not None
+
+    def files(self, prefix):
+        """Return a dictionary of the FSNs with `prefix` and the full paths
+        of the corresponding files."""
+        result = {}
+        with self._lock:
+            rows = self._db.execute('SELECT directory, name, fsn FROM files WHERE prefix=?', (prefix,)).fetchall()
+        for d, n, fsn in rows:
+            result.setdefault(fsn, []).append(os.path.join(d, n))
+        return result
+
+    def find(self, prefix, fsn):
+        """Return the full paths of the files with `prefix` and `fsn`."""
+        with self._lock:
+            return [os.path.join(d, n) for d, n in self._db.execute(
+                'SELECT directory, name FROM files WHERE prefix=? AND fsn=?', (prefix, fsn))]
@@ -0,0 +1,176 @@
+import datetime
+import threading
+import sqlite3
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['HeaderCatalog', 'title_pattern']
+
+# header field, database column, type
+CATALOG_FIELDS = [('FSN', 'fsn', int),
+                  ('Title', 'title', str),
+                  ('Owner', 'owner', str),
+                  ('Date', 'date', float),
+                  ('MeasTime', 'meastime', float),
+                  ('Dist', 'dist', float),
+                  ('DistCalibrated', 'distcalibrated', float),
+                  ('Temperature', 'temperature', float),
+                  ('Transm', 'transm', float),
+                  ('Thickness', 'thickness', float),
+                  ('BeamPosX', 'beamposx', float),
+                  ('BeamPosY', 'beamposy', float)]
+
+
+def title_pattern(text):
+    """The title filter of HeaderCatalog.query() matching the titles which
+    contain `text` literally."""
+    for c in '\\%_':
+        text = text.replace(c, '\\' + c)
+    return '%' + text + '%'
+
+
+def _get(header, field):
+    # header[field] takes care of the key aliases and the generated fields
+    # of SASHeader, which dict.get() would bypass.
+    try:
+        return header[field]
+    except KeyError:
+        return None
+
+
+def _convert(value, type_):
+    if value is None:
+        return None
+    elif isinstance(value, datetime.datetime):
+        value = time.mktime(value.timetuple()) + value.microsecond * 1e-6
+    elif type_ is str and isinstance(value, unicode):
+        return value.encode('utf-8')
+    try:
+        return type_(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class HeaderCatalog(object):
+
+    """Catalog of the most important header fields of the exposures (FSN,
+    title, owner, date, exposure time, distance, temperature, transmission,
+    thickness, beam position) and their data reduction status, in an sqlite
+    database.
+
+    The entries are keyed by the file name prefix and the FSN. The database
+    is indexed on the FSN, the title and the date, so listing and filtering
+    even large catalogs is fast. The methods can be called from any thread.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(dbfile, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS headers (prefix TEXT, ' +
+                             ', '.join('%s %s' % (column, {int: 'INTEGER', str: 'TEXT', float: 'REAL'}[type_])
+                                       for field, column, type_ in CATALOG_FIELDS) +
+                             ', reduced INTEGER DEFAULT 0, PRIMARY KEY (prefix, fsn))')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS headers_title ON headers (prefix, title, fsn)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS headers_date ON headers (prefix, date)')
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @staticmethod
+    def record(header):
+        """Extract the catalogued fields from a header, as a tuple which can
+        be given to update(). The date is converted to seconds since the
+        epoch."""
+        date = _get(header, 'Date')
+        if date is None:
+            date = _get(header, 'StartDate')
+        return tuple(_convert(date if field == 'Date' else _get(header, field), type_)
+                     for field, column, type_ in CATALOG_FIELDS)
+
+    def update(self, prefix, records, reduced=False):
+        """Add or update entries, given as tuples returned by record(). If
+        `reduced` is True, the entries are marked as reduced, otherwise their
+        reduction status is not changed."""
+        columns = [column for field, column, type_ in CATALOG_FIELDS]
+        with self._lock:
+            with self._db:
+                for rec in records:
+                    self._db.execute('INSERT OR IGNORE INTO headers (prefix, fsn) VALUES (?, ?)',
+                                     (prefix, rec[0]))
+                    self._db.execute('UPDATE headers SET ' + ', '.join(c + '=?' for c in columns[1:]) +
+                                     (', reduced=1' if reduced else '') +
+                                     ' WHERE prefix=? AND fsn=?', rec[1:] + (prefix, rec[0]))
+
+    def set_reduced(self, prefix, fsn, reduced=True):
+        with self._lock:
+            with self._db:
+                self._db.execute('UPDATE headers SET reduced=? WHERE prefix=? AND fsn=?',
+                                 (int(reduced), prefix, fsn))
+
+    def fsns(self, prefix):
+        with self._lock:
+            return set(row[0] for row in self._db.execute(
+                'SELECT fsn FROM headers WHERE prefix=?', (prefix,)))
+
+    def _where(self, prefix, fsnmin, fsnmax, title, reduced):
+        conditions = ['prefix=?']
+        args = [prefix]
+        if fsnmin is not None:
+            conditions.append('fsn>=?')
+            args.append(fsnmin)
+        if fsnmax is not None:
+            conditions.append('fsn<=?')
+            args.append(fsnmax)
+        if title is not None:
+            conditions.append("title LIKE ? ESCAPE '\\'")
+            args.append(title)
+        if reduced is not None:
+            conditions.append('reduced=?')
+            args.append(int(reduced))
+        return ' WHERE ' + ' AND '.join(conditions), args
+
+    def count(self, prefix, fsnmin=None, fsnmax=None, title=None, reduced=None):
+        where, args = self._where(prefix, fsnmin, fsnmax, title, reduced)
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM headers' + where, args).fetchone()[0]
+
+    def query(self, prefix, fsnmin=None, fsnmax=None, title=None, reduced=None, limit=None, offset=0):
+        """Return the entries with FSNs between `fsnmin` and `fsnmax` (both
+        inclusive), optionally filtered by title (an SQL LIKE pattern with \ as
+        the escape character, see title_pattern()) and
+        reduction status, in the order of the FSN. Use `limit` and `offset`
+        for paging.
+
+        Each entry is a dictionary with the header field names as keys. Fields
+        missing from the header are left out. The 'Reduced' key holds the
+        reduction status.
+        """
+        where, args = self._where(prefix, fsnmin, fsnmax, title, reduced)
+        sql = 'SELECT ' + ', '.join(column for field, column, type_ in CATALOG_FIELDS) + \
+            ', reduced FROM headers' + where + ' ORDER BY fsn'
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            args.extend([limit, offset])
+        fields = [field for field, column, type_ in CATALOG_FIELDS] + ['Reduced']
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        result = []
+        for row in rows:
+            entry = dict((f, v) for f, v in zip(fields, row) if v is not None)
+            entry['Reduced'] = bool(entry['Reduced'])
+            if 'Date' in entry:
+                entry['Date'] = datetime.datetime.fromtimestamp(entry['Date'])
+            result.append(entry)
+        return result
@@ -0,0 +1,428 @@
+import multiprocessing
+import threading
+import datetime
+import Queue
+import dateutil.tz
+import traceback
+import logging
+import shutil
+import h5py
+import numpy as np
+import os
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['NeXusWriter', 'write_nexus_static', 'write_nexus_dynamic',
+           'write_nexus_frame']
+
+# motor roles: (group in entry, name of the positioner, name of the value)
+MOTOR_ROLES = {'sample_x': ('sample', 'positioner_x', 'x_translation'),
+               'sample_y': ('sample', 'positioner_y', 'y_translation'),
+               'beamstop_x': ('instrument/beam_stop', 'positioner_x', 'x'),
+               'beamstop_y': ('instrument/beam_stop', 'positioner_y', 'y'),
+               'ph1_x': ('instrument/collimator/aperture_1', 'positioner_x', 'x'),
+               'ph1_y': ('instrument/collimator/aperture_1', 'positioner_y', 'y'),
+               'ph2_x': ('instrument/collimator/aperture_2', 'positioner_x', 'x'),
+               'ph2_y': ('instrument/collimator/aperture_2', 'positioner_y', 'y'),
+               'ph3_x': ('instrument/collimator/aperture_3', 'positioner_x', 'x'),
+               'ph3_y': ('instrument/collimator/aperture_3', 'positioner_y', 'y')}
+
+
+def _set(group, name, value, units=None):
+    if value is None:
+        return
+    group[name] = value
+    if units is not None:
+        group[name].attrs['units'] = units
+
+
+def write_nexus_static(f, static, mask=None):
+    """Write the parts of a NeXus file which do not change from exposure to
+    exposure into the open h5py File `f`. `static` is the dictionary made
+    by SubSystemFiles._nexus_static_state(), `mask` is the mask matrix."""
+    f.attrs['NX_class'] = 'NXroot'
+    f.attrs['creator'] = 'SAXSCtrl@CREDO'
+    f.attrs['HDF5_version'] = h5py.version.hdf5_version
+    f.attrs['default'] = 'entry'
+    f.attrs['NeXus_version'] = '4.4.0'
+    entry = f.create_group('entry')
+    entry.attrs['NX_class'] = 'NXentry'
+    entry.attrs['default'] = 'data'
+    entry['experiment_identifier'] = static['projectid']
+    entry['experiment_description'] = static['projectname']
+    entry['program_name'] = 'SAXSCtrl'
+    entry['program_name'].attrs['version'] = static['version']
+    entry['revision'] = '0'
+    operator = entry.create_group('operator')
+    operator.attrs['NX_class'] = 'NXuser'
+    operator['name'] = static['username']
+    operator['role'] = 'local_contact'
+
+    proposer = entry.create_group('proposer')
+    proposer.attrs['NX_class'] = 'NXuser'
+    proposer['name'] = static['proposername']
+    proposer['role'] = 'proposer'
+
+    instrument = entry.create_group('instrument')
+    instrument.attrs['NX_class'] = 'NXinstrument'
+    instrument['name'] = 'Creative Research Equipment for DiffractiOn'
+    instrument['name'].attrs['short_name'] = 'CREDO'
+    instrument['URL'] = 'http://credo.ttk.mta.hu'
+    beamstop = instrument.create_group('beam_stop')
+    beamstop.attrs['NX_class'] = 'NXbeam_stop'
+    beamstop['description'] = 'circular'
+    _set(beamstop, 'size', static['dbs'], 'mm')
+    _set(beamstop, 'distance_to_detector', static['lbs'], 'mm')
+    coll = instrument.create_group('collimator')
+    coll.attrs['NX_class'] = 'NXcollimator'
+    l1, l2, ls = static['l1'], static['l2'], static['ls']
+    for idx, description, dist in [(1, 'Entrance', -(l1 + l2 + ls)),
+                                   (2, 'Beam defining', (-(l2 + ls))),
+                                   (3, 'Guard', (-ls))]:
+        ph = coll.create_group('aperture_%d' % idx)
+        ph.attrs['NX_class'] = 'NXaperture'
+        ph['material'] = 'Pt-Ir'
+        ph['description'] = description + ' pinhole'
+        geo = ph.create_group('geometry')
+        geo.attrs['NX_class'] = 'NXgeometry'
+        geo['component_index'] = idx - 4
+        shape = geo.create_group('shape')
+        shape.attrs['NX_class'] = 'NXshape'
+        shape['shape'] = 'nxcylinder'
+        shape.create_dataset('size', data=np.array(
+            [[static['aperture%d' % idx] * 1e-3, 0.2, 0, 0, 1.]]))
+        shape['size'].attrs['units'] = 'mm'
+        trans = geo.create_group('translation')
+        trans.attrs['NX_class'] = 'NXtranslation'
+        trans.create_dataset('distances', data=np.array([[0, 0, dist]]))
+        trans['distances'].attrs['units'] = 'mm'
+    motors = instrument.create_group('motors')
+    motors.attrs['NX_class'] = 'NXcollection'
+
+    monochromator = instrument.create_group('monochromator')
+    monochromator.attrs['NX_class'] = 'NXmonochromator'
+    _set(monochromator, 'wavelength', static['wavelength'], 'nm')
+    _set(monochromator, 'wavelength_error',
+         static['wavelength'] * static['wavelength_spread'], 'nm')
+    _set(monochromator, 'energy', static['energy'], 'eV')
+    _set(monochromator, 'energy_error',
+         static['energy'] * static['wavelength_spread'], 'eV')
+    source = instrument.create_group('source')
+    source.attrs['NX_class'] = 'NXsource'
+    source['distance'] = -ls - l2 - l1 - static['l0']
+    source['name'] = 'Xenocs GeniX3D Cu ULD'
+    source['name'].attrs['short_name'] = 'GeniX'
+    source['type'] = 'Fixed Tube X-ray'
+    source['probe'] = 'x-ray'
+    source['target_material'] = 'Cu'
+    sensors = instrument.create_group('sensors')
+    sensors.attrs['NX_class'] = 'NXcollection'
+    detector = instrument.create_group('detector')
+    detector.attrs['NX_class'] = 'NXdetector'
+    _set(detector, 'distance', static['dist'], 'mm')
+    _set(detector, 'polar_angle', 0, 'rad')
+    _set(detector, 'azimuthal_angle', 0, 'rad')
+    detector['local_name'] = 'pilatus300k'
+    _set(detector, 'x_pixel_size', 0.172, 'mm')
+    _set(detector, 'y_pixel_size', 0.172, 'mm')
+    detector['type'] = 'CMOS'
+    detector['layout'] = 'area'
+    _set(detector, 'beam_center_x', static['beamposy'] * 0.172, 'mm')
+    _set(detector, 'beam_center_y', static['beamposx'] * 0.172, 'mm')
+    detector['acquisition_mode'] = 'summed'
+    detector['angular_calibration_applied'] = False
+    detector['flatfield_applied'] = True
+    if mask is not None:
+        detector.create_dataset('pixel_mask', data=(mask == 0) << 6)
+        detector['pixel_mask'].attrs['file_name'] = static['maskfile']
+    detector['countrate_correction_applied'] = True
+    detector['bit_depth_readout'] = 20
+    _set(detector, 'detector_readout_time', 2.3, 'ms')
+    detector['sensor_material'] = 'Si'
+    _set(detector, 'sensor_thickness', 450e-3, 'mm')
+    data = entry.create_group('data')
+    data.attrs['NX_class'] = 'NXdata'
+
+
+def write_nexus_dynamic(f, filename, state):
+    """Complete a NeXus file made by write_nexus_static() with the state of
+    the instrument at the start of the exposure. `state` is the dictionary
+    made by SubSystemFiles._nexus_dynamic_state()."""
+    f.attrs['file_name'] = filename
+    f.attrs['file_time'] = state['start_time']
+    entry = f['entry']
+    entry['title'] = os.path.splitext(os.path.split(filename)[-1])
+    entry['entry_identifier'] = os.path.splitext(
+        os.path.split(filename)[-1])[0]
+    if state['nscan'] is None:
+        entry['definition'] = 'NXsas'
+        entry['definition'].attrs['version'] = '1.0b'
+        entry['definition'].attrs[
+            'URL'] = 'https://github.com/nexusformat/definitions/blob/master/applications/NXsas.nxdl.xml'
+        _set(entry, 'collection_time', state['exptime'], 's')
+    else:
+        entry['definition'] = 'CREDOscan'
+        entry['collection_time'] = state['exptime'] * state['nscan']
+    entry['run_cycle'] = state['start_time'][:4]
+    sam = state['sample']
+    if sam is not None:
+        samplefrom = entry.create_group('sample_from')
+        samplefrom.attrs['NX_class'] = 'NXuser'
+        samplefrom['name'] = sam['preparedby']
+        samplefrom['role'] = 'sample_preparator'
+
+        sample = entry.create_group('sample')
+        sample.attrs['NX_class'] = 'NXsample'
+        for name in ['name', 'type', 'situation', 'description', 'preparation_date']:
+            sample[name] = sam[name]
+        _set(sample, 'thickness', sam['thickness'], 'cm')
+        _set(sample, 'thickness_error', sam['thickness_error'], 'cm')
+        sample['short_title'] = sample['name']
+        sample['prepared_by'] = samplefrom
+        _set(sample, 'distance', sam['distance'], 'mm')
+        _set(sample, 'distance_error', sam['distance_error'], 'mm')
+        sample.create_group('transmission')
+        sample['transmission'].attrs['NX_class'] = 'NXdata'
+        sample['transmission']['data'] = sam['transmission']
+        if sam['transmission_error'] is not None:
+            sample['transmission']['errors'] = sam['transmission_error']
+            sample['transmission']['data'].attrs['uncertainties'] = 'errors'
+        _set(sample, 'temperature', state['temperature'], 'degC')
+    monitor = entry.create_group('monitor')
+    monitor.attrs['NX_class'] = 'NXmonitor'
+    monitor['mode'] = 'timer'
+    _set(monitor, 'preset', state['exptime'], 's')
+    _set(monitor, 'nominal', state['exptime'], 's')
+    monitor['type'] = 'timer'
+    _set(monitor, 'count_time', state['exptime'], 's')
+    instrument = entry['instrument']
+    for m in state['motors']:
+        mot = instrument['motors'].create_group(m['name'])
+        mot.attrs['NX_class'] = 'NXpositioner'
+        mot['name'] = m['name']
+        mot['description'] = m['alias']
+        _set(mot, 'value', m['value'], 'mm')
+        _set(mot, 'raw_value', m['raw_value'], '')
+        _set(mot, 'soft_limit_min', m['soft_left'], 'mm')
+        _set(mot, 'soft_limit_max', m['soft_right'], 'mm')
+        if m['role'] not in MOTOR_ROLES:
+            continue
+        group, positioner, value = MOTOR_ROLES[m['role']]
+        if group not in entry:
+            continue
+        entry[group][positioner] = mot
+        entry[group][value] = mot['value']
+        if m['role'] == 'beamstop_y':
+            entry[group]['status'] = ['out', 'in'][
+                state['beamstop_in'][0] < m['value'] < state['beamstop_in'][1]]
+    source = instrument['source']
+    if state['ht'] is not None and state['current'] is not None:
+        _set(source, 'power', state['ht'] * state['current'], 'W')
+        _set(source, 'energy', state['ht'] * 1000, 'eV')
+        _set(source, 'current', state['current'] * 1e-3, 'A')
+    sensors = instrument['sensors']
+    if state['pressure'] is not None:
+        vacuum = sensors.create_group('vacuum')
+        vacuum.attrs['NX_class'] = 'NXsensor'
+        _set(vacuum, 'value', state['pressure'], 'mbar')
+        vacuum['model'] = state['vacuumgauge']
+        vacuum['name'] = 'Pirani Vacuum Gauge'
+        vacuum['short_name'] = 'vacgauge'
+        vacuum['attached_to'] = 'flight path'
+        vacuum['measurement'] = 'pressure'
+        vacuum['type'] = 'Pirani'
+        vacuum['run_control'] = False
+    detector = instrument['detector']
+    _set(detector, 'count_time', state['exptime'], 's')
+    _set(detector, 'sequence_number', state['fsn'])
+    pilatus = state['pilatus']
+    if pilatus:
+        detector['description'] = 'Dectris Pilatus-300k SN: %s' % pilatus['camerasn']
+        _set(detector, 'comparator_voltage', pilatus['vcmp'], 'V')
+        if pilatus['tau'] is not None:
+            _set(detector, 'dead_time', pilatus['tau'] * 1e9, 'ns')
+        _set(detector, 'gain_setting', pilatus['gain'])
+        _set(detector, 'threshold_energy', pilatus['threshold'], 'eV')
+        _set(detector, 'saturation_value', pilatus['cutoff'])
+        for i, attached_to in zip(range(3), ['power board', 'base plate', 'sensor']):
+            hum = sensors.create_group('detector_humidity%d' % i)
+            hum.attrs['NX_class'] = 'NXsensor'
+            _set(hum, 'value', pilatus['humidity%d' % i], '%')
+            hum['model'] = 'Pilatus-300k'
+            hum['name'] = 'Humidity sensor, channel #%d' % (12 + i)
+            hum['short_name'] = 'Humidity #%d' % i
+            hum['attached_to'] = 'Detector power board'
+            hum['measurement'] = 'humidity'
+            hum['type'] = 'combined temperature and humidity sensor'
+            hum['run_control'] = False
+            temp = sensors.create_group('detector_temperature%d' % i)
+            temp.attrs['NX_class'] = 'NXsensor'
+            _set(temp, 'value', pilatus['temperature%d' % i], 'deg_C')
+            temp['model'] = 'Pilatus-300k'
+            temp['name'] = 'Temperature sensor, channel #%d' % (12 + i)
+            temp['short_name'] = 'Temperature #%d' % i
+            temp['attached_to'] = 'Detector ' + attached_to
+            temp['measurement'] = 'temperature'
+            temp['type'] = 'combined temperature and humidity sensor'
+            temp['run_control'] = False
+    monitor['start_time'] = state['start_time']
+    entry['start_time'] = monitor['start_time']
+
+
+def write_nexus_frame(f, data, endtime):
+    """Write the image `data` and its error into a NeXus file made by
+    write_nexus_static() and write_nexus_dynamic(), and set the times of the
+    exposure. `endtime` is the end of this frame, in seconds since the
+    epoch."""
+    end = datetime.datetime.fromtimestamp(endtime, dateutil.tz.tzlocal())
+    start = end - datetime.timedelta(
+        seconds=float(f['entry/monitor/count_time'].value))
+    f['entry/monitor/start_time'][()] = start.isoformat()
+    f['entry/monitor/end_time'] = end.isoformat()
+    f['entry/end_time'] = f['entry/monitor/end_time']
+    f['entry/duration'] = (end - start).total_seconds()
+    f['entry/duration'].attrs['units'] = 's'
+    detector = f['entry/instrument/detector']
+    detector.create_dataset('data', data=data, compression='gzip')
+    detector['data'].attrs['signal'] = 1
+    detector['data'].attrs['axes'] = 'x_pixel_offset:y_pixel_offset'
+    detector['data'].attrs['units'] = 'counts'
+    detector['data'].attrs['long_name'] = 'Detector counts'
+    detector['data'].attrs['check_sum'] = data.sum()
+    err = data.copy()
+    idx = err > 0
+    err[idx] = err[idx] ** 0.5
+    err[~idx] = np.nan
+    detector.create_dataset('data_error', data=err, compression='gzip')
+    detector['data_error'].attrs['units'] = 'counts'
+    detector['data_error'].attrs['long_name'] = 'Standard deviation of detector counts'
+    detector['data_error'].attrs['check_sum'] = np.nansum(err)
+    detector.create_dataset('x_pixel_offset', data=np.arange(data.shape[1]))
+    detector['x_pixel_offset'].attrs['primary'] = 1
+    detector['x_pixel_offset'].attrs['long_name'] = 'Horizontal pixel coordinate (column index)'
+    detector.create_dataset('y_pixel_offset', data=np.arange(data.shape[0]))
+    detector['y_pixel_offset'].attrs['primary'] = 1
+    detector['y_pixel_offset'].attrs['long_name'] = 'Vertical pixel coordinate (row index)'
+    f['entry/data/data'] = detector['data']
+    f['entry/data/errors'] = detector['data_error']
+    f['entry/data/x_pixel_offset'] = detector['x_pixel_offset']
+    f['entry/data/y_pixel_offset'] = detector['y_pixel_offset']
+
+
+class NeXusWriter(object):
+
+    """Write NeXus files in a dedicated process.
+
+    create() queues the creation of a NeXus file as a byte-level copy of a
+    static template file (see write_nexus_static()), completed with the
+    dynamic state of the instrument. write_frame() queues writing an image
+    into it. Frames may arrive before the creation of their file is done:
+    they are held back until then. If the creation fails, the frame is
+    dropped.
+
+    The job queue is bounded (`maxjobs`): if the writer lags behind, the
+    submitting processes block. The jobs of the process owning the writer
+    (create(), replace_template()) are forwarded to the queue by a thread,
+    in the order of submission, so they never block the caller. The writer
+    must be created before forking the processes which submit frames, as
+    they share the queue by inheritance.
+    """
+
+    def __init__(self, maxjobs=16):
+        self._queue = multiprocessing.Queue(maxjobs)
+        self._outbox = Queue.Queue()
+        self._process = None
+        self._forwarder = None
+
+    def is_running(self):
+        return (self._process is not None) and self._process.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._process = multiprocessing.Process(
+            target=self._worker, args=(self._queue,))
+        self._process.daemon = True
+        self._process.start()
+        if self._forwarder is None:
+            self._forwarder = threading.Thread(target=self._forward)
+            self._forwarder.daemon = True
+            self._forwarder.start()
+
+    def shutdown(self):
+        if self._process is None:
+            return
+        # after the jobs still waiting to be forwarded.
+        self._outbox.put(None)
+        self._forwarder.join()
+        self._forwarder = None
+        if self._process.is_alive():
+            self._queue.put(None)
+        self._process.join()
+        self._process = None
+
+    def create(self, filename, template, state):
+        self._outbox.put(('create', filename, template, state))
+
+    def replace_template(self, newtemplate, template):
+        """Rename `newtemplate` to `template`, after the files queued so far
+        have been copied from the old one."""
+        self._outbox.put(('template', newtemplate, template))
+
+    def write_frame(self, filename, data, endtime):
+        # the data is pickled later by the feeder thread of the queue.
+        self._queue.put(('frame', filename, np.array(data), endtime))
+
+    def _forward(self):
+        while True:
+            job = self._outbox.get()
+            if job is None:
+                break
+            self._queue.put(job)
+
+    @staticmethod
+    def _worker(queue):
+        created = set()
+        failed = set()
+        pending = {}
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            try:
+                if job[0] == 'template':
+                    os.rename(job[1], job[2])
+                    continue
+                if job[0] == 'create':
+                    filename, template, state = job[1:]
+                    try:
+                        shutil.copyfile(template, filename)
+                        with h5py.File(filename, 'r+') as f:
+                            write_nexus_dynamic(f, filename, state)
+                    except Exception:
+                        if pending.pop(filename, None) is None:
+                            failed.add(filename)
+                        else:
+                            logger.error('Dropped the frame of NeXus file %s, '
+                                         'which could not be created.' % filename)
+                        raise
+                    created.add(filename)
+                    job = pending.pop(filename, None)
+                    if job is None:
+                        continue
+                filename, data, endtime = job[1:]
+                if filename in failed:
+                    failed.discard(filename)
+                    logger.error('Dropped the frame of NeXus file %s, '
+                                 'which could not be created.' % filename)
+                    continue
+                if filename not in created:
+                    pending[filename] = job
+                    continue
+                created.discard(filename)
+                with h5py.File(filename, 'r+') as f:
+                    write_nexus_frame(f, data, endtime)
+            except Exception:
+                logger.error('Error while writing NeXus file: ' +
+                             traceback.format_exc())
@@ -0,0 +1,95 @@
+import logging
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['ScanContainer', 'swmr_supported']
+
+
+def swmr_supported():
+    """Check if h5py and the HDF5 library support single-writer multiple-reader
+    (SWMR) access."""
+    return hasattr(h5py.File, 'swmr_mode') and h5py.version.hdf5_version_tuple >= (1, 10)
+
+
+class ScanContainer(object):
+
+    """A single HDF5 file holding all frames of a scan or an imaging run.
+
+    The frames are appended to the chunked, extendable datasets
+    entry/instrument/detector/data and data_error, of shape (N, rows,
+    columns), one chunk per frame. The per-frame scalars (scan columns, motor
+    positions, monitor etc.) are one-dimensional extendable datasets in
+    entry/scan. Names can contain '/', to put them in subgroups.
+
+    The file may already exist (e.g. a NeXus template created with
+    libver='latest'): the groups are created only if missing. After the
+    datasets have been created, the file is switched to SWMR mode if
+    supported, so it can be read while the acquisition is running: open it
+    with h5py.File(filename, 'r', libver='latest', swmr=True) and call
+    refresh() on the datasets to see the new frames. No new datasets or
+    attributes can be created afterwards, thus all scalar names must be
+    given in advance.
+    """
+
+    def __init__(self, filename, shape, scalars, compression='gzip', swmr=True):
+        self.filename = filename
+        self.nframes = 0
+        self._file = h5py.File(filename, 'a', libver='latest')
+        try:
+            entry = self._file.require_group('entry')
+            detector = entry.require_group('instrument').require_group('detector')
+            self._data = detector.create_dataset(
+                'data', (0,) + tuple(shape), np.double, maxshape=(None,) + tuple(shape),
+                chunks=(1,) + tuple(shape), compression=compression)
+            self._data.attrs['signal'] = 1
+            self._data.attrs['units'] = 'counts'
+            self._data.attrs['long_name'] = 'Detector counts'
+            self._error = detector.create_dataset(
+                'data_error', (0,) + tuple(shape), np.double, maxshape=(None,) + tuple(shape),
+                chunks=(1,) + tuple(shape), compression=compression)
+            self._error.attrs['units'] = 'counts'
+            self._error.attrs['long_name'] = 'Standard deviation of detector counts'
+            data = entry.require_group('data')
+            data.attrs['NX_class'] = 'NXdata'
+            data['data'] = self._data
+            data['errors'] = self._error
+            scan = entry.require_group('scan')
+            scan.attrs['NX_class'] = 'NXcollection'
+            self._scalars = {}
+            for name in scalars:
+                self._scalars[name] = scan.create_dataset(
+                    name, (0,), np.double, maxshape=(None,), chunks=(256,))
+            if swmr and swmr_supported():
+                self._file.swmr_mode = True
+            elif swmr:
+                logger.warning(
+                    'SWMR mode is not supported by this version of h5py/HDF5.')
+        except:
+            self._file.close()
+            raise
+
+    def append(self, intensity, error=None, scalars=None):
+        """Append a frame. If `error` is None, the square root of the
+        intensity is used. Scalars not given are stored as NaN."""
+        if scalars is None:
+            scalars = {}
+        n = self.nframes
+        self._data.resize(n + 1, axis=0)
+        self._data[n] = intensity
+        self._error.resize(n + 1, axis=0)
+        if error is None:
+            error = np.sqrt(np.clip(intensity, 0, None))
+        self._error[n] = error
+        for name, dataset in self._scalars.iteritems():
+            dataset.resize((n + 1,))
+            dataset[n] = scalars.get(name, np.nan)
+        self.nframes = n + 1
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,131 @@
+import argparse
+import logging
+import errno
+import re
+import os
+
+from .fsnindex import FSNIndex
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['shard_subdir', 'shard_path', 'make_shard_dir', 'find_shards',
+           'shard_base', 'reshard']
+
+_prefix_re = re.compile(r'^[a-zA-Z0-9]+$')
+
+
+def shard_subdir(filename, shardsize):
+    """The relative directory (<prefix>/<bucket>) where `filename` belongs in
+    the sharded layout, with `shardsize` FSNs per directory. The bucket is
+    FSN // shardsize, e.g. crd/0123 for crd_0123456.cbf with a shard size of
+    1000. Returns '' if `shardsize` is 0 (flat layout) or if the file name
+    does not contain an FSN."""
+    if shardsize <= 0:
+        return ''
+    m = FSNIndex.filename_re.match(os.path.basename(filename))
+    if m is None:
+        return ''
+    return os.path.join(m.group('prefix'), '%04d' % (int(m.group('fsn')) // shardsize))
+
+
+def shard_path(basedir, filename, shardsize):
+    """The full path of `filename` under `basedir` in the sharded layout."""
+    return os.path.join(basedir, shard_subdir(filename, shardsize), filename)
+
+
+def make_shard_dir(path):
+    """Create the directory `path` with its parents. Returns True if it has
+    been created, False if it already existed."""
+    try:
+        os.makedirs(path)
+    except OSError as ose:
+        if ose.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+        return False
+    return True
+
+
+def find_shards(basedir):
+    """List the shard directories (<basedir>/<prefix>/<bucket>) under
+    `basedir`, sorted by prefix and bucket."""
+    shards = []
+    try:
+        prefixes = sorted(d for d in os.listdir(basedir) if _prefix_re.match(d))
+    except OSError:
+        return shards
+    for prefix in prefixes:
+        prefixdir = os.path.join(basedir, prefix)
+        if not os.path.isdir(prefixdir):
+            continue
+        shards.extend(os.path.join(prefixdir, b) for b in sorted(os.listdir(prefixdir))
+                      if b.isdigit() and os.path.isdir(os.path.join(prefixdir, b)))
+    return shards
+
+
+def shard_base(directory):
+    """The base directory of a shard directory. Other directories are
+    returned unchanged."""
+    head, bucket = os.path.split(directory)
+    base, prefix = os.path.split(head)
+    if bucket.isdigit() and _prefix_re.match(prefix):
+        return base
+    return directory
+
+
+def reshard(basedir, shardsize, dryrun=False):
+    """Move the files with an FSN in their names under `basedir` (either
+    directly or in shard directories) to their places in the layout with
+    `shardsize` FSNs per directory (0: flat layout). Shard directories left
+    empty are removed. Existing files are never overwritten.
+
+    Returns the number of files moved (or to be moved, if `dryrun` is True).
+    """
+    moved = 0
+    for directory in [basedir] + find_shards(basedir):
+        for name in sorted(os.listdir(directory)):
+            src = os.path.join(directory, name)
+            if FSNIndex.filename_re.match(name) is None or not os.path.isfile(src):
+                continue
+            dest = shard_path(basedir, name, shardsize)
+            if dest == src:
+                continue
+            if os.path.exists(dest):
+                logger.warning('Not moving %s: %s already exists.' % (src, dest))
+                continue
+            moved += 1
+            if dryrun:
+                continue
+            make_shard_dir(os.path.dirname(dest))
+            os.rename(src, dest)
+    if not dryrun:
+        for shard in find_shards(basedir):
+            if not os.listdir(shard):
+                os.rmdir(shard)
+                if not os.listdir(os.path.dirname(shard)):
+                    os.rmdir(os.path.dirname(shard))
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Re-shard the data directories of a SAXSCtrl root folder in place. '
+        'Do not run it while SAXSCtrl is running. The FSN index and the header '
+        'catalog are updated on the next start of SAXSCtrl.')
+    parser.add_argument('rootpath', help='SAXSCtrl root folder')
+    parser.add_argument('--shardsize', type=int, default=1000,
+                        help='Number of FSNs in a directory, 0 for the flat layout (default: %(default)s)')
+    parser.add_argument('--subdirs', default='images,param,param_override,eval2d,eval1d,nexus',
+                        help='Comma-separated list of subfolders to re-shard (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only count the files to be moved')
+    args = parser.parse_args()
+    logging.basicConfig()
+    for subdir in args.subdirs.split(','):
+        basedir = os.path.realpath(os.path.join(args.rootpath, subdir))
+        if not os.path.isdir(basedir):
+            print 'Skipping %s: not a directory.' % basedir
+            continue
+        print '%s: %d files %s.' % (basedir, reshard(basedir, args.shardsize, args.dry_run),
+                                    ['moved', 'to be moved'][args.dry_run])
+    print 'Set the shard size of the Files subsystem to %d to write new files in this layout.' % args.shardsize
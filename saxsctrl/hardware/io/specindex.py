@@ -0,0 +1,243 @@
+import warnings
+import datetime
+import sqlite3
+import logging
+import os
+
+import dateutil.parser
+import sastool
+from sastool.io import onedim
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['SpecIndex', 'SpecScanStore']
+
+
+class SpecIndex(object):
+
+    """Byte-offset index of the scans in a spec file, stored in an sqlite
+    database next to it (<specfile>.index).
+
+    For each scan the number, the offset of its #S line, the number of data
+    points, the command, the date, the comment and the column names are
+    stored. The index also remembers how much of the file it covers: as spec
+    files are only appended to, update() reads just the last indexed scan
+    (which may have grown) and what follows it. If the file was truncated or
+    replaced, the index is rebuilt.
+    """
+
+    def __init__(self, specfile):
+        self.specfile = specfile
+        try:
+            self._db = self._connect(specfile + '.index')
+        except sqlite3.Error:
+            # e.g. read-only directory: keep the index in memory.
+            logger.warning('Cannot open the index of spec file %s, using a temporary one.' % specfile)
+            self._db = self._connect(':memory:')
+        self.update()
+
+    @staticmethod
+    def _connect(filename):
+        # sqlite only notices an unwritable database when writing first.
+        db = sqlite3.connect(filename)
+        try:
+            db.text_factory = str
+            db.execute('PRAGMA synchronous = NORMAL')
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+                db.execute('CREATE TABLE IF NOT EXISTS scans '
+                           '(number INTEGER PRIMARY KEY, offset INTEGER, npoints INTEGER, '
+                           'command TEXT, datestring TEXT, comment TEXT, columns TEXT)')
+                # the tables may already exist in a read-only file.
+                db.execute("INSERT OR IGNORE INTO meta VALUES ('size', 0)")
+        except sqlite3.Error:
+            db.close()
+            raise
+        return db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _indexed_size(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key='size'").fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def _last(self):
+        return self._db.execute('SELECT number, offset FROM scans ORDER BY offset DESC LIMIT 1').fetchone()
+
+    def _is_valid(self, size):
+        if size < self._indexed_size():
+            return False
+        last = self._last()
+        if last is None:
+            return True
+        with open(self.specfile, 'rb') as f:
+            f.seek(last[1])
+            l = f.readline()
+        return l.startswith('#S') and l[2:].split()[:1] == [str(last[0])]
+
+    def update(self):
+        """Index the scans added to the file since the last update."""
+        size = os.stat(self.specfile).st_size
+        if not self._is_valid(size):
+            logger.info('Rebuilding the index of spec file ' + self.specfile)
+            with self._db:
+                self._db.execute('DELETE FROM scans')
+                self._db.execute('DELETE FROM meta')
+        if size == self._indexed_size():
+            return
+        last = self._last()
+        scans = []
+        with open(self.specfile, 'rb') as f:
+            if last is not None:
+                f.seek(last[1])
+            offset = f.tell()
+            scan = None
+            for l in iter(f.readline, ''):
+                if l.startswith('#S'):
+                    number, command = (l[2:].split(None, 1) + [''])[:2]
+                    scan = [int(number), offset, 0, command.strip(), '', '', '']
+                    scans.append(scan)
+                elif scan is None:
+                    pass
+                elif l.startswith('#D'):
+                    scan[4] = l[2:].strip()
+                elif l.startswith('#C'):
+                    scan[5] = l[2:].strip()
+                elif l.startswith('#L'):
+                    scan[6] = l[3:].rstrip('\r\n')
+                elif l.strip() and not l.startswith('#'):
+                    scan[2] += 1
+                offset += len(l)
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?)', scans)
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('size', ?)", (offset,))
+
+    def add_points(self, npoints):
+        """Register `npoints` data lines appended to the last scan."""
+        last = self._last()
+        with self._db:
+            if last is not None:
+                self._db.execute('UPDATE scans SET npoints=npoints+? WHERE number=?',
+                                 (npoints, last[0]))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('size', ?)",
+                             (os.stat(self.specfile).st_size,))
+
+    def max_number(self):
+        return self._db.execute('SELECT MAX(number) FROM scans').fetchone()[0] or 0
+
+    def offset(self, number):
+        """The byte offset of the #S line of scan `number`, or None."""
+        row = self._db.execute('SELECT offset FROM scans WHERE number=?', (number,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def scans(self):
+        """List the scans as dicts with the keys 'number', 'offset',
+        'npoints', 'command', 'datestring', 'comment' and 'columns'."""
+        return [{'number': number, 'offset': offset, 'npoints': npoints, 'command': command,
+                 'datestring': datestring, 'comment': comment,
+                 'columns': [c.strip() for c in columns.split('  ')]}
+                for number, offset, npoints, command, datestring, comment, columns in
+                self._db.execute('SELECT * FROM scans ORDER BY number')]
+
+
+class SpecScanStore(sastool.classes.SASScanStore):
+
+    """A SASScanStore which uses a SpecIndex, thus opening the file and
+    loading a scan do not need to parse all the scans before it."""
+
+    def __init__(self, filename, comment=None, motors=None):
+        if not os.path.exists(filename):
+            sastool.classes.SASScanStore.__init__(self, filename, comment, motors)
+        else:
+            self.scans = {}
+            self.filename = filename
+            self._read_header()
+            if motors is not None and set(motors) != set(self.motors):
+                warnings.warn('Different motors in SPEC file!')
+        self.index = SpecIndex(filename)
+        self.maxnumber = self.index.max_number()
+
+    def _read_header(self):
+        # the file header is everything before the first empty line.
+        self.motors = []
+        self.comment = ''
+        self.epoch = 0
+        with open(self.filename, 'rt') as f:
+            for l in iter(f.readline, ''):
+                if not l.strip() or l.startswith('#S'):
+                    break
+                elif l.startswith('#E'):
+                    self.epoch = int(l[2:].strip())
+                elif l.startswith('#C'):
+                    self.comment = l[2:].strip()
+                elif l.startswith('#O'):
+                    self.motors.extend([x.strip() for x in (l.split(None, 1) + [''])[1].split('  ')
+                                        if x.strip()])
+        self.datetime = datetime.datetime.fromtimestamp(self.epoch)
+
+    def add_scan(self, scn, N=None):
+        sastool.classes.SASScanStore.add_scan(self, scn, N)
+        self.index.update()
+
+    def append_data(self, data):
+        sastool.classes.SASScanStore.append_data(self, data)
+        self.index.add_points(len(data))
+
+    def _read_scan(self, idx):
+        offset = self.index.offset(idx)
+        if offset is None:
+            return None
+        with open(self.filename, 'rt') as f:
+            f.seek(offset)
+            try:
+                scan = onedim.readspecscan(f, idx)
+            except onedim.SpecFileEOF:
+                return None
+        if not isinstance(scan, dict):
+            return None
+        scan['motors'] = self.motors
+        scan.setdefault('comment', self.comment)
+        scan.setdefault('positions', [None] * len(self.motors))
+        return scan
+
+    def get_scan(self, idx):
+        if idx < 1 or idx > self.maxnumber:
+            raise ValueError('Invalid scan index!')
+        if idx not in self.scans:
+            scan = self._read_scan(idx)
+            if scan is None:
+                # the index is out of date
+                self.index.update()
+                scan = self._read_scan(idx)
+            if scan is None:
+                raise ValueError('Scan #%d not found in the spec file.' % idx)
+            self.scans[idx] = sastool.classes.SASScan.read_from_spec(scan)
+        return self.scans[idx]
+
+    def refresh(self):
+        """Pick up the scans appended by others."""
+        self.index.update()
+        self.maxnumber = max(self.maxnumber, self.index.max_number())
+
+    def list_scans(self):
+        """The scans in the file (see SpecIndex.scans()), without loading
+        them. The 'timestamp' key is added, parsed from 'datestring'."""
+        scans = self.index.scans()
+        for scan in scans:
+            try:
+                scan['timestamp'] = float(dateutil.parser.parse(scan['datestring']).strftime('%s.%f'))
+            except (ValueError, TypeError):
+                scan['timestamp'] = None
+        return scans
+
+    def finalize(self):
+        self.scans = {}
+        self.index.close()
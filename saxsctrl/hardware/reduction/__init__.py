@@ -0,0 +1,11 @@
+__all__ = ['corrections', 'kernel', 'profiler', 'radavg']
+
+import corrections
+import kernel
+import profiler
+import radavg
+
+from corrections import *
+from kernel import *
+from profiler import *
+from radavg import *
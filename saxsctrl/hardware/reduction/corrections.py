@@ -0,0 +1,150 @@
+import collections
+import threading
+import hashlib
+import logging
+import os
+
+import numpy as np
+from sastool.utils2d import corrections
+
+from ..io.asyncwriter import write_atomic
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['CorrectionMapCache', 'correction_key', 'correction_map', 'quantize']
+
+
+def quantize(value, tolerance):
+    """Round `value` to a multiple of `tolerance` (if positive)."""
+    if tolerance <= 0:
+        return value
+    return round(value / tolerance) * tolerance
+
+
+def correction_key(header, shape, solidangle=True, transmission=None, mu=None):
+    """The cache key of the geometry correction map of an exposure: its
+    shape, beam position, pixel size and distance, the enabled corrections
+    and their parameters. `transmission` is a (value, error) tuple for the
+    angle-dependent self-absorption correction (already quantized), `mu` is
+    the absorption coefficient for the air absorption correction (computed
+    from a quantized pressure, or the key would differ for every exposure).
+    None disables the correction."""
+    return (tuple(shape), float(header['BeamPosX']), float(header['BeamPosY']),
+            float(header['XPixel']), float(header['YPixel']),
+            float(header['DistCalibrated']), float(header['DistCalibratedError']),
+            bool(solidangle), transmission, mu)
+
+
+def correction_map(tth, dtth, dist, ddist, solidangle=True, transmission=None, mu=None):
+    """The combined solid-angle, self-absorption and air absorption
+    correction (see correction_key() for the arguments), as (value, error)
+    matrices. The errors are propagated the same way as multiplying the
+    exposure by the corrections one by one."""
+    value = np.ones_like(tth)
+    error = np.zeros_like(tth)
+    factors = []
+    if solidangle:
+        factors.append(corrections.solidangle_errorprop(tth, dtth, dist, ddist))
+    if transmission is not None:
+        factors.append(corrections.angledependentabsorption_errorprop(
+            tth, dtth, transmission[0], transmission[1]))
+    if mu is not None:
+        factors.append(corrections.angledependentairtransmission_errorprop(
+            tth, dtth, mu, 0, dist, ddist))
+    for val, err in factors:
+        error = np.sqrt((value * err) ** 2 + (error * val) ** 2)
+        value = value * val
+    return value, error
+
+
+class CorrectionMapCache(object):
+
+    """LRU cache of correction maps: (value, error) pairs of matrices.
+
+    At most `maxsize` maps are kept in memory. If `spilldir` is given, the
+    maps dropped from the memory are saved there (one .npz file each, named
+    after the hash of the key), and loaded back when needed again. At most
+    `maxspill` files are kept there: the least recently used ones are
+    removed. The methods can be called from any thread.
+    """
+
+    def __init__(self, maxsize=16, spilldir=None, maxspill=256):
+        self.maxsize = maxsize
+        self.spilldir = spilldir
+        self.maxspill = maxspill
+        self._maps = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _spillname(self, key):
+        return os.path.join(self.spilldir, 'correction_%s.npz' % hashlib.sha1(repr(key)).hexdigest())
+
+    def _spill(self, key, value):
+        if not self.spilldir:
+            return
+        try:
+            if not os.path.isdir(self.spilldir):
+                os.makedirs(self.spilldir)
+            write_atomic(self._spillname(key), lambda filename: np.savez(filename, value=value[0],
+                                                                          error=value[1]))
+        except (IOError, OSError):
+            logger.warning('Cannot save correction map to ' + self.spilldir)
+            return
+        self._prune()
+
+    def _prune(self):
+        # remove the least recently used files above maxspill
+        try:
+            files = [os.path.join(self.spilldir, f) for f in os.listdir(self.spilldir)
+                     if f.startswith('correction_') and f.endswith('.npz')]
+            if len(files) <= self.maxspill:
+                return
+            files.sort(key=lambda f: os.stat(f).st_mtime)
+            for f in files[:len(files) - self.maxspill]:
+                os.remove(f)
+        except OSError:
+            logger.warning('Cannot prune the correction maps in ' + self.spilldir)
+
+    def _unspill(self, key):
+        if not self.spilldir:
+            return None
+        try:
+            with np.load(self._spillname(key)) as f:
+                value = f['value'], f['error']
+            # used: kept longer by _prune()
+            os.utime(self._spillname(key), None)
+            return value
+        except (IOError, OSError, KeyError):
+            return None
+
+    def get(self, key, compute):
+        """The map for `key`. If not cached, it is made by calling `compute`
+        without arguments."""
+        with self._lock:
+            try:
+                value = self._maps.pop(key)
+                self._maps[key] = value
+                self.hits += 1
+                return value
+            except KeyError:
+                pass
+        value = self._unspill(key)
+        if value is None:
+            value = compute()
+        for matrix in value:
+            matrix.flags.writeable = False
+        with self._lock:
+            self.misses += 1
+            self._maps[key] = value
+            dropped = []
+            while len(self._maps) > self.maxsize:
+                dropped.append(self._maps.popitem(last=False))
+        for k, v in dropped:
+            self._spill(k, v)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._maps.clear()
@@ -0,0 +1,104 @@
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+__all__ = ['FusedCorrection']
+
+
+def _product(x, y):
+    # error propagation as in SASExposure.__imul__()
+    (v1, e1), (v2, e2) = x, y
+    return v1 * v2, np.sqrt((v1 * e2) ** 2 + (e1 * v2) ** 2)
+
+
+class FusedCorrection(object):
+
+    """Collects the operations of consecutive data reduction steps and
+    applies them to an exposure in a single pass.
+
+    The operations are multiplications and divisions by scalars or matrices
+    with errors (mul(), div()) and subtractions of matrices with errors
+    (sub(), e.g. the background). The factors before and after a subtraction
+    are combined, thus the exposure is corrected as (I * a - B) * c, with
+    the same first-order error propagation as applying the operations one
+    by one. The intensity and error matrices of the exposure are overwritten
+    in place, with numexpr if it is installed, or else with numpy, using two
+    temporary matrices.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._pre = (1.0, 0.0)
+        self._sub = None
+        self._post = (1.0, 0.0)
+        self._empty = True
+
+    def is_empty(self):
+        return self._empty
+
+    def mul(self, value, error=0.0):
+        self._empty = False
+        if self._sub is None:
+            self._pre = _product(self._pre, (value, error))
+        else:
+            self._post = _product(self._post, (value, error))
+
+    def div(self, value, error=0.0):
+        self.mul(1.0 / value, error / (value * value))
+
+    def sub(self, value, error, exposure):
+        """Subtract (value, error). As only one subtraction is fused, the
+        operations collected so far may have to be applied first."""
+        if self._sub is not None:
+            self.apply(exposure)
+        self._empty = False
+        self._sub = (value, error)
+
+    def apply(self, exposure):
+        """Apply the collected operations to `exposure` in place, then start
+        over. Returns False if there was nothing to do."""
+        if self.is_empty():
+            return False
+        I = exposure.Intensity
+        if I.dtype != np.double or not I.flags.writeable:
+            I = I.astype(np.double)
+        E = exposure.Error
+        if E is None:
+            E = np.zeros_like(I)
+        elif E.dtype != np.double or not E.flags.writeable:
+            E = E.astype(np.double)
+        a, ea = self._pre
+        c, ec = self._post
+        if self._sub is None:
+            B = Eb = 0.0
+        else:
+            B, Eb = self._sub
+        if numexpr is not None:
+            numexpr.evaluate('sqrt(((I * a - B) * ec) ** 2 + c ** 2 * ((I * ea) ** 2 + (E * a) ** 2 + Eb ** 2))',
+                             out=E, casting='unsafe')
+            numexpr.evaluate('(I * a - B) * c', out=I, casting='unsafe')
+        else:
+            corrected = np.multiply(I, a)
+            corrected -= B
+            tmp = np.multiply(I, ea)
+            tmp *= tmp
+            E *= a
+            E *= E
+            E += tmp
+            if self._sub is not None:
+                E += Eb * Eb
+            E *= c * c
+            np.multiply(corrected, ec, out=tmp)
+            tmp *= tmp
+            E += tmp
+            np.sqrt(E, out=E)
+            np.multiply(corrected, c, out=I)
+        exposure.Intensity = I
+        exposure.Error = E
+        self.clear()
+        return True
@@ -0,0 +1,111 @@
+import collections
+import threading
+import resource
+import time
+import sys
+
+import numpy as np
+
+__all__ = ['ReductionProfiler', 'add_diagnostics', 'PER_THREAD']
+
+_pagesize = resource.getpagesize()
+
+# the page faults of the calling thread only (RUSAGE_THREAD, Linux), so that
+# the other threads do not count in a measurement. Elsewhere the whole
+# process is counted.
+_who = getattr(resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith('linux') else None)
+try:
+    resource.getrusage(_who)
+    PER_THREAD = True
+except (TypeError, ValueError, resource.error):
+    _who = resource.RUSAGE_SELF
+    PER_THREAD = False
+
+
+def _touched():
+    # memory touched for the first time by the thread: a cheap estimate of
+    # the allocations (large numpy arrays are usually mapped fresh).
+    return resource.getrusage(_who).ru_minflt * _pagesize
+
+
+def add_diagnostics(exposure):
+    """Add the diagnostic statistics of the current state of `exposure` to
+    its history."""
+    exposure.header.add_history('Maximum relative error: %g' % (
+        np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
+
+
+class ReductionProfiler(object):
+
+    """Wall-clock time and memory allocation of the parts of the data
+    reduction (steps, fused passes, loading etc.), accumulated under their
+    names. The allocation is the memory newly touched by the calling thread
+    during the part, from the number of minor page faults. Where the faults
+    of a single thread are not available (PER_THREAD is False), those of
+    the whole process are counted: the figures are then only meaningful if
+    nothing else runs concurrently. The methods can be called from any
+    thread.
+    """
+
+    def __init__(self):
+        self._stats = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, allocated, count=1):
+        with self._lock:
+            s = self._stats.setdefault(name, [0, 0.0, 0, 0.0])
+            s[0] += count
+            s[1] += seconds
+            s[2] += allocated
+            if count:
+                s[3] = max(s[3], seconds / count)
+
+    def start(self):
+        """Start a measurement: returns the token to give to stop()."""
+        return time.time(), _touched()
+
+    def stop(self, name, started, count=1):
+        """Account the time and the allocation since `started` (see start())
+        to `name`, as `count` calls."""
+        self.add(name, time.time() - started[0], _touched() - started[1], count)
+
+    def measure(self, name, function, *args):
+        """Call `function` with the given arguments and account it to
+        `name`. Returns the result of the function."""
+        started = self.start()
+        try:
+            return function(*args)
+        finally:
+            self.stop(name, started)
+
+    def merge(self, stats):
+        """Add the results of another profiler (see stats())."""
+        for name, count, seconds, allocated, slowest in stats:
+            self.add(name, seconds, allocated, count)
+            with self._lock:
+                s = self._stats[name]
+                s[3] = max(s[3], slowest)
+
+    def stats(self):
+        """A list of (name, count, total time, total allocation in bytes,
+        longest time)."""
+        with self._lock:
+            return [(name,) + tuple(s) for name, s in self._stats.iteritems()]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self):
+        """The results as a text table."""
+        stats = self.stats()
+        total = sum(s[2] for s in stats) or 1
+        lines = ['%-24s %7s %10s %10s %10s %6s %12s' % (
+            'Step', 'Count', 'Total (s)', 'Mean (ms)', 'Max (ms)', '%', 'Alloc (MB)')]
+        for name, count, seconds, allocated, slowest in stats:
+            lines.append('%-24s %7d %10.3f %10.2f %10.2f %6.1f %12.1f' % (
+                name, count, seconds, seconds / max(count, 1) * 1000, slowest * 1000,
+                seconds / total * 100, allocated / 1048576.))
+        if not PER_THREAD:
+            lines.append('(allocations of the whole process, only meaningful for serial runs)')
+        return '\n'.join(lines)
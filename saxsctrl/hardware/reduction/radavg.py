@@ -0,0 +1,186 @@
+import collections
+import threading
+import hashlib
+import logging
+
+import numpy as np
+import sastool
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['RadialAverager', 'RadialAveragerCache', 'radial_average']
+
+
+def pixel_q(shape, wavelength, wavelengtherror, distance, distanceerror, pixelsizex, pixelsizey,
+            bcx, bcy):
+    """q and its error for each pixel, computed as in
+    sastool.utils2d.integrate.radint_fullq_errorprop() (the beam position is
+    taken as exact, the pixel position uncertain by half a pixel)."""
+    row, col = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    x = (row - bcx) * pixelsizex
+    y = (col - bcy) * pixelsizey
+    xerr = 0.5 * pixelsizex
+    yerr = 0.5 * pixelsizey
+    r2 = x * x + y * y
+    rho = np.sqrt(r2) / distance
+    q = 4 * np.pi * np.sin(0.5 * np.arctan(rho)) / wavelength
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rhoerr = np.sqrt((xerr * xerr * x * x + yerr * yerr * y * y) / (distance * distance * r2) +
+                         distanceerror * distanceerror * r2 / (distance ** 4))
+        dq = 2 * np.pi / wavelength * np.sqrt(
+            (rhoerr ** 2 * np.cos(0.5 * np.arctan(rho)) ** 2) / (rho ** 2 + 1) ** 2 +
+            4 * wavelengtherror ** 2 * np.sin(0.5 * np.arctan(rho)) ** 2 / wavelength ** 2)
+    return q, dq
+
+
+def _mean_and_error(total, squares, errorsquares, area, keep_errorless=True):
+    # the larger of the propagated error and the standard error of the mean,
+    # as with errorpropagation=3 in sastool.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stderr = np.where(area > 1, np.sqrt((squares - total * total / area) / (area - 1)) / np.sqrt(area), 0)
+        properr = np.sqrt(errorsquares) / area
+        error = np.where(stderr > properr, stderr, properr)
+        mean = total / area
+    # bins without pixels (and sastool leaves the intensity of the bins
+    # without error undivided)
+    untouched = (area == 0)
+    if keep_errorless:
+        untouched |= (errorsquares == 0)
+    return np.where(untouched, total, mean), np.where(untouched, errorsquares, error)
+
+
+class RadialAverager(object):
+
+    """Radial averaging for a fixed geometry, mask and set of q-bins.
+
+    The bin of each pixel is determined once, when the averager is made.
+    Averaging a frame then takes three weighted np.bincount() calls over the
+    unmasked pixels: the sums of the intensities, of their squares and of the
+    squared errors. The results are the same as those of
+    SASExposure.radial_average() with the default error propagation (the
+    larger of the propagated error and the standard error of the mean, for
+    the abscissa too): the pixels are summed in the same order.
+
+    `q` and `dq` are the q values of the pixels and their errors (see
+    pixel_q()), `mask` is True for the pixels to be taken into account and
+    `bins` are the centers of the q-bins.
+    """
+
+    def __init__(self, q, dq, mask, bins):
+        self.q = np.asarray(bins, dtype=np.double)
+        edges = np.empty_like(self.q)
+        edges[:-1] = 0.5 * (self.q[:-1] + self.q[1:])
+        edges[-1:] = self.q[-1:]
+        valid = mask & (q >= self.q[0]) & (q <= self.q[-1])
+        self.shape = q.shape
+        self._pixels = np.flatnonzero(valid)
+        self._bins = np.searchsorted(edges, q.ravel()[self._pixels], side='left')
+        self._q = q.ravel()[self._pixels]
+        self._dq2 = dq.ravel()[self._pixels] ** 2
+        self._abscissa = self._average_abscissa(self._bins, self._q, self._dq2)
+
+    def _average_abscissa(self, bins, q, dq2):
+        area = np.bincount(bins, minlength=len(self.q)).astype(np.double)
+        qmean, dqmean = _mean_and_error(np.bincount(bins, q, minlength=len(self.q)),
+                                        np.bincount(bins, q * q, minlength=len(self.q)),
+                                        np.bincount(bins, dq2, minlength=len(self.q)), area, False)
+        return qmean, dqmean, area
+
+    def average(self, intensity, error):
+        """Average a frame. Returns q, dq, intensity, error and the number of
+        pixels in each bin. Non-finite pixels are skipped."""
+        if intensity.shape != self.shape:
+            raise ValueError('Incompatible shape!')
+        data = intensity.ravel()[self._pixels]
+        dataerr = error.ravel()[self._pixels]
+        finite = np.isfinite(data) & np.isfinite(dataerr)
+        if finite.all():
+            bins = self._bins
+            q, dq, area = self._abscissa
+        else:
+            bins, data, dataerr = self._bins[finite], data[finite], dataerr[finite]
+            q, dq, area = self._average_abscissa(bins, self._q[finite], self._dq2[finite])
+        I, E = _mean_and_error(np.bincount(bins, data, minlength=len(self.q)),
+                               np.bincount(bins, data * data, minlength=len(self.q)),
+                               np.bincount(bins, dataerr * dataerr, minlength=len(self.q)), area)
+        return q, dq, I, E, area
+
+
+class RadialAveragerCache(object):
+
+    """LRU cache of RadialAverager instances (at most `maxsize`), keyed by
+    the geometry, the mask and the q-bins. The methods can be called from
+    any thread."""
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._averagers = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _make(self, exposure, geometry, validmask, qrange, pixels_per_qbin):
+        q, dq = pixel_q(exposure.shape, *geometry)
+        if qrange is None:
+            # as SASExposure.get_qrange() and get_pixrange()
+            qvalid = q[validmask]
+            M, N = exposure.shape
+            nbins = int(np.sqrt(M * M + N * N) / 2)
+            if pixels_per_qbin is not None:
+                row, col = np.meshgrid(np.arange(M), np.arange(N), indexing='ij')
+                dpix = np.sqrt((col - geometry[7]) ** 2 + (row - geometry[6]) ** 2)[validmask]
+                nbins = int((dpix.max() - dpix.min()) / float(pixels_per_qbin))
+            qrange = np.linspace(qvalid.min(), qvalid.max(), nbins)
+        return RadialAverager(q, dq, validmask, qrange)
+
+    def get(self, exposure, qrange=None, pixels_per_qbin=None):
+        """The averager for `exposure` with the q-bins `qrange`. If None, the
+        bins are determined automatically: either as in
+        SASExposure.radial_average(), or spaced to have `pixels_per_qbin`
+        pixels in each bin."""
+        h = exposure.header
+        geometry = (float(h['WavelengthCalibrated']), float(h['WavelengthCalibratedError']),
+                    float(h['DistCalibrated']), float(h['DistCalibratedError']),
+                    float(h['XPixel']), float(h['YPixel']), float(h['BeamPosX']), float(h['BeamPosY']))
+        validmask = (exposure.mask.mask != 0)
+        if qrange is not None:
+            qrange = np.asarray(qrange, dtype=np.double)
+            binning = hashlib.sha1(qrange.tostring()).hexdigest()
+        else:
+            binning = pixels_per_qbin
+        key = (exposure.shape, geometry, hashlib.sha1(np.packbits(validmask).tostring()).hexdigest(),
+               qrange is None, binning)
+        with self._lock:
+            try:
+                averager = self._averagers.pop(key)
+                self._averagers[key] = averager
+                self.hits += 1
+                return averager
+            except KeyError:
+                pass
+        averager = self._make(exposure, geometry, validmask, qrange, pixels_per_qbin)
+        with self._lock:
+            self.misses += 1
+            self._averagers[key] = averager
+            while len(self._averagers) > self.maxsize:
+                self._averagers.popitem(last=False)
+        return averager
+
+    def radial_average(self, exposure, qrange=None, pixels_per_qbin=None):
+        """Radial average of `exposure`, as a SASCurve (see get() for the
+        arguments)."""
+        exposure.check_for_mask()
+        exposure.check_for_q()
+        q, dq, I, E, A = self.get(exposure, qrange, pixels_per_qbin).average(
+            exposure.Intensity, exposure.Error)
+        return sastool.classes.SASCurve(q, I, E, dq, pixel=exposure.qtopixel_radius(q), area=A)
+
+
+_default_cache = RadialAveragerCache()
+
+
+def radial_average(exposure, qrange=None, pixels_per_qbin=None):
+    """Radial average of `exposure` using a common RadialAveragerCache, see
+    RadialAveragerCache.radial_average()."""
+    return _default_cache.radial_average(exposure, qrange, pixels_per_qbin)
@@ -0,0 +1,15 @@
+__all__ = ['simulator', 'pilatus', 'tmcm', 'genix', 'haakephoenix', 'vacgauge']
+
+import simulator
+import pilatus
+import tmcm
+import genix
+import haakephoenix
+import vacgauge
+
+from simulator import *
+from pilatus import *
+from tmcm import *
+from genix import *
+from haakephoenix import *
+from vacgauge import *
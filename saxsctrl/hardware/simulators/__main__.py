@@ -0,0 +1,53 @@
+"""Start all instrument simulators on the local host.
+
+Usage: python -m saxsctrl.hardware.simulators [options]
+"""
+import argparse
+import logging
+import time
+import os
+
+from .pilatus import PilatusSimulator
+from .tmcm import TMCMSimulator
+from .genix import GenixSimulator
+from .haakephoenix import HaakePhoenixSimulator
+from .vacgauge import VacuumGaugeSimulator
+
+parser = argparse.ArgumentParser(
+    description='Run the SAXSCtrl instrument simulators')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--latency', type=float, default=0,
+                    help='Reply latency (sec)')
+parser.add_argument('--jitter', type=float, default=0,
+                    help='Standard deviation of the reply latency (sec)')
+parser.add_argument('--imgpath', default='images',
+                    help='Directory where the Pilatus simulator writes images')
+parser.add_argument('--pilatus-port', type=int, default=41234)
+parser.add_argument('--tmcm351-port', type=int, default=2001)
+parser.add_argument('--tmcm6110-port', type=int, default=2004)
+parser.add_argument('--genix-port', type=int, default=1502,
+                    help='Modbus TCP port of the GeniX simulator (502 needs root)')
+parser.add_argument('--haakephoenix-port', type=int, default=2003)
+parser.add_argument('--vacgauge-port', type=int, default=2002)
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+if not os.path.isdir(args.imgpath):
+    os.makedirs(args.imgpath)
+common = {'host': args.host, 'latency': args.latency, 'jitter': args.jitter}
+simulators = [PilatusSimulator(port=args.pilatus_port, imgpath=args.imgpath, **common),
+              TMCMSimulator(port=args.tmcm351_port,
+                            hwtype='TMCM351', **common),
+              TMCMSimulator(port=args.tmcm6110_port,
+                            hwtype='TMCM6110', **common),
+              GenixSimulator(port=args.genix_port, **common),
+              HaakePhoenixSimulator(port=args.haakephoenix_port, **common),
+              VacuumGaugeSimulator(port=args.vacgauge_port, **common)]
+for s in simulators:
+    s.start()
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    for s in simulators:
+        s.stop()
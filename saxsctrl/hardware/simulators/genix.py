@@ -0,0 +1,241 @@
+from .simulator import Simulator
+import logging
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['GenixSimulator']
+
+# status bits, starting from coil 210. See Genix.get_status().
+STATUS_BITS = ('DISTANT_MODE', 'XRAY_ON', 'STANDBY_ON', 'CYCLE_AUTO_ON', 'CONDITIONS_AUTO_OK', 'CYCLE_RESET_ON', 'CYCLE_TUBE_WARM_UP_ON',
+               'CONFIGURATION_POWER_TUBE', 'UNKNOWN1', 'FAULTS', 'X-RAY_LIGHT_FAULT', 'SHUTTER_LIGHT_FAULT', 'SENSOR2_FAULT', 'TUBE_POSITION_FAULT',
+               'VACUUM_FAULT', 'WATERFLOW_FAULT', 'SAFETY_SHUTTER_FAULT', 'TEMPERATURE_FAULT', 'SENSOR1_FAULT', 'RELAY_INTERLOCK_FAULT',
+               'DOOR_SENSOR_FAULT', 'FILAMENT_FAULT', 'TUBE_WARM_UP_NEEDED_FAULT', 'UNKNOWN2', 'RUN_AUTOMATE', 'INTERLOCK_OK', 'SHUTTER_CLOSED',
+               'SHUTTER_OPENED', 'UNKNOWN3', 'OVERRIDDEN_ON')
+STATUS_COIL_START = 210
+
+COIL_INCREASE_CURRENT = 240
+COIL_DECREASE_CURRENT = 241
+COIL_INCREASE_HT = 242
+COIL_DECREASE_HT = 243
+COIL_POWERDOWN = 244
+COIL_WARMUP_START = 245
+COIL_WARMUP_STOP = 246
+COIL_SHUTTER_OPEN = 247
+COIL_SHUTTER_CLOSE = 248
+COIL_RESET_FAULTS = 249
+COIL_STANDBY = 250
+COIL_XRAYS = 251
+COIL_RAMPUP = 252
+
+REGISTER_HT = 50
+REGISTER_CURRENT = 51
+REGISTER_TUBETIME_MINUTES = 55
+REGISTER_TUBETIME_HOURS = 56
+
+MODBUS_READ_COILS = 1
+MODBUS_READ_DISCRETE_INPUTS = 2
+MODBUS_READ_HOLDING_REGISTERS = 3
+MODBUS_READ_INPUT_REGISTERS = 4
+MODBUS_WRITE_SINGLE_COIL = 5
+MODBUS_WRITE_SINGLE_REGISTER = 6
+
+MODBUS_ILLEGAL_FUNCTION = 1
+MODBUS_ILLEGAL_DATA_VALUE = 3
+
+
+class GenixSimulator(Simulator):
+
+    """Simulator of the GeniX3D X-ray source, speaking Modbus TCP.
+
+    The coil and register map is the one used by the Genix instrument class.
+    High tension and tube current are ramped linearly with `ht_rate` (kV/sec)
+    and `current_rate` (mA/sec) towards the targets of the requested power
+    state. When going up, the high tension is raised first; when going down,
+    the current is lowered first. The shutter needs `shutter_time` seconds
+    to open or close.
+    """
+    name = 'genix'
+    standby_power = (30, 0.3)
+    full_power = (50, 0.6)
+
+    def __init__(self, host='127.0.0.1', port=502, latency=0, jitter=0,
+                 ht_rate=10, current_rate=0.2, shutter_time=0.3, warmup_time=30):
+        Simulator.__init__(self, host, port, latency, jitter)
+        self.ht_rate = ht_rate
+        self.current_rate = current_rate
+        self.shutter_time = shutter_time
+        self.warmup_time = warmup_time
+        self.status = dict((k, False) for k in STATUS_BITS)
+        self.status.update({'DISTANT_MODE': True, 'XRAY_ON': True, 'CONDITIONS_AUTO_OK': True,
+                            'CONFIGURATION_POWER_TUBE': True, 'INTERLOCK_OK': True, 'SHUTTER_CLOSED': True})
+        self.coils = {}
+        self.holding_registers = {}
+        self.ht = 0.
+        self.current = 0.
+        self.tubetime = 3600 * 1000.
+        self._target = (0, 0)
+        self._shutter_target = False
+        self._shutter_t0 = 0
+        self._warmup_t0 = None
+        self._lastupdate = time.time()
+
+    def split_requests(self, buf):
+        requests = []
+        while len(buf) >= 6:
+            length = struct.unpack('>H', buf[4:6])[0]
+            if len(buf) < 6 + length:
+                break
+            requests.append(buf[:6 + length])
+            buf = buf[6 + length:]
+        return requests, buf
+
+    def _approach(self, value, target, rate, dt):
+        if value < target:
+            return min(target, value + rate * dt)
+        return max(target, value - rate * dt)
+
+    def _update(self):
+        now = time.time()
+        dt = now - self._lastupdate
+        self._lastupdate = now
+        if self._warmup_t0 is not None and now - self._warmup_t0 > self.warmup_time:
+            self._warmup_t0 = None
+            self.status['CYCLE_TUBE_WARM_UP_ON'] = False
+            self.status['TUBE_WARM_UP_NEEDED_FAULT'] = False
+            self._set_target(*self.full_power)
+        if not self.status['XRAY_ON']:
+            self.ht = self.current = 0.
+        elif self._target[0] >= self.ht:
+            self.ht = self._approach(self.ht, self._target[0], self.ht_rate, dt)
+            if self.ht == self._target[0]:
+                self.current = self._approach(
+                    self.current, self._target[1], self.current_rate, dt)
+        else:
+            self.current = self._approach(
+                self.current, self._target[1], self.current_rate, dt)
+            if self.current == self._target[1]:
+                self.ht = self._approach(
+                    self.ht, self._target[0], self.ht_rate, dt)
+        if (self.ht, self.current) == self._target:
+            self.status['STANDBY_ON'] = False
+            self.status['CYCLE_AUTO_ON'] = False
+            self.status['CYCLE_RESET_ON'] = False
+        if self.ht > 0:
+            self.tubetime += dt
+        if self.status['SHUTTER_OPENED'] != self._shutter_target and now - self._shutter_t0 > self.shutter_time:
+            self.status['SHUTTER_OPENED'] = self._shutter_target
+            self.status['SHUTTER_CLOSED'] = not self._shutter_target
+        self.status['RUN_AUTOMATE'] = bool(int(now) % 2)
+        self.status['FAULTS'] = any(
+            self.status[k] for k in STATUS_BITS if k.endswith('_FAULT'))
+
+    def _set_target(self, ht, current):
+        # the high tension and the current are stored as integers in units of
+        # 0.01 kV and 0.01 mA, respectively.
+        self._target = (round(ht * 100) / 100., round(current * 100) / 100.)
+
+    def _move_shutter(self, open_):
+        if open_ and not (self.status['INTERLOCK_OK'] and self.status['XRAY_ON']):
+            return
+        if self._shutter_target != open_:
+            self._shutter_target = open_
+            self._shutter_t0 = time.time()
+            self.status['SHUTTER_OPENED'] = False
+            self.status['SHUTTER_CLOSED'] = False
+
+    def _write_coil(self, coil, value):
+        rising = value and not self.coils.get(coil, False)
+        self.coils[coil] = value
+        if coil == COIL_XRAYS:
+            self.status['XRAY_ON'] = value
+            if not value:
+                self._move_shutter(False)
+                self._set_target(0, 0)
+        elif coil == COIL_STANDBY and value:
+            self.status['STANDBY_ON'] = True
+            self._set_target(*self.standby_power)
+        elif not rising:
+            return
+        elif coil == COIL_INCREASE_CURRENT:
+            self._set_target(self._target[0], self._target[1] + 0.01)
+        elif coil == COIL_DECREASE_CURRENT:
+            self._set_target(self._target[0], max(0, self._target[1] - 0.01))
+        elif coil == COIL_INCREASE_HT:
+            self._set_target(self._target[0] + 1, self._target[1])
+        elif coil == COIL_DECREASE_HT:
+            self._set_target(max(0, self._target[0] - 1), self._target[1])
+        elif coil == COIL_POWERDOWN:
+            self.status['CYCLE_RESET_ON'] = True
+            self._set_target(0, 0)
+        elif coil == COIL_WARMUP_START:
+            self.status['CYCLE_TUBE_WARM_UP_ON'] = True
+            self._warmup_t0 = time.time()
+            self._set_target(*self.standby_power)
+        elif coil == COIL_WARMUP_STOP:
+            self.status['CYCLE_TUBE_WARM_UP_ON'] = False
+            self._warmup_t0 = None
+        elif coil == COIL_SHUTTER_OPEN:
+            self._move_shutter(True)
+        elif coil == COIL_SHUTTER_CLOSE:
+            self._move_shutter(False)
+        elif coil == COIL_RESET_FAULTS:
+            for k in STATUS_BITS:
+                if k.endswith('_FAULT'):
+                    self.status[k] = False
+        elif coil == COIL_RAMPUP:
+            self.status['CYCLE_AUTO_ON'] = True
+            self._set_target(*self.full_power)
+
+    def _read_coil(self, coil):
+        idx = coil - STATUS_COIL_START
+        if 0 <= idx < len(STATUS_BITS):
+            return self.status[STATUS_BITS[idx]]
+        return self.coils.get(coil, False)
+
+    def _read_register(self, regno):
+        if regno == REGISTER_HT:
+            return int(round(self.ht * 100))
+        elif regno == REGISTER_CURRENT:
+            return int(round(self.current * 100))
+        elif regno == REGISTER_TUBETIME_MINUTES:
+            return int(self.tubetime / 60) % 60
+        elif regno == REGISTER_TUBETIME_HOURS:
+            return int(self.tubetime / 3600) % 65536
+        return self.holding_registers.get(regno, 0)
+
+    def handle(self, request, conn):
+        transaction, protocol, length, unit, function = struct.unpack(
+            '>HHHBB', request[:8])
+        data = request[8:]
+
+        def reply(pdu):
+            return struct.pack('>HHHB', transaction, protocol, len(pdu) + 1, unit) + pdu
+
+        with self._lock:
+            self._update()
+            if function in [MODBUS_READ_COILS, MODBUS_READ_DISCRETE_INPUTS]:
+                start, count = struct.unpack('>HH', data[:4])
+                bytes_ = [0] * ((count + 7) // 8)
+                for i in range(count):
+                    if self._read_coil(start + i):
+                        bytes_[i // 8] |= 1 << (i % 8)
+                return reply(struct.pack('>BB', function, len(bytes_)) + ''.join(chr(b) for b in bytes_))
+            elif function in [MODBUS_READ_HOLDING_REGISTERS, MODBUS_READ_INPUT_REGISTERS]:
+                start, count = struct.unpack('>HH', data[:4])
+                values = [self._read_register(start + i) for i in range(count)]
+                return reply(struct.pack('>BB', function, 2 * count) + struct.pack('>%dH' % count, *values))
+            elif function == MODBUS_WRITE_SINGLE_COIL:
+                coil, value = struct.unpack('>HH', data[:4])
+                if value not in [0, 0xff00]:
+                    return reply(struct.pack('>BB', function | 0x80, MODBUS_ILLEGAL_DATA_VALUE))
+                self._write_coil(coil, value == 0xff00)
+                return reply(struct.pack('>B', function) + data[:4])
+            elif function == MODBUS_WRITE_SINGLE_REGISTER:
+                regno, value = struct.unpack('>HH', data[:4])
+                self.holding_registers[regno] = value
+                return reply(struct.pack('>B', function) + data[:4])
+            else:
+                return reply(struct.pack('>BB', function | 0x80, MODBUS_ILLEGAL_FUNCTION))
@@ -0,0 +1,90 @@
+from .simulator import Simulator
+import logging
+import math
+import time
+import re
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['HaakePhoenixSimulator']
+
+
+class HaakePhoenixSimulator(Simulator):
+
+    """Simulator of the Haake Phoenix circulator, speaking its serial protocol
+    through TCP (like through ser2net).
+
+    Requests and replies are terminated by CR. While circulating, the bath
+    temperature relaxes exponentially towards the setpoint with a time
+    constant of `timeconstant` seconds, otherwise towards `ambient`.
+    """
+    name = 'haakephoenix'
+    version = '1P/H 2.17'
+
+    def __init__(self, host='127.0.0.1', port=2003, latency=0, jitter=0,
+                 ambient=25., timeconstant=60.):
+        Simulator.__init__(self, host, port, latency, jitter)
+        self.ambient = ambient
+        self.timeconstant = timeconstant
+        self.temperature = ambient
+        self.setpoint = ambient
+        self.circulating = False
+        self.pumppower = 5.0
+        self.faults = {'mainrelay_fault': False, 'overtemperature_fault': False, 'liquidlevel_fault': False,
+                       'motor_overload_fault': False, 'external_connection_fault': False, 'cooling_fault': False,
+                       'internal_pt100_fault': False, 'external_pt100_fault': False}
+        self._lastupdate = time.time()
+
+    def split_requests(self, buf):
+        lines = buf.split('\r')
+        return [l.strip('\n') for l in lines[:-1]], lines[-1]
+
+    def _update(self):
+        now = time.time()
+        if self.circulating:
+            target = self.setpoint
+        else:
+            target = self.ambient
+        self.temperature = target + (self.temperature - target) * \
+            math.exp(-(now - self._lastupdate) / self.timeconstant)
+        self._lastupdate = now
+
+    def _temperature(self, t):
+        return '%+08.2f C$\r' % t
+
+    def handle(self, request, conn):
+        with self._lock:
+            self._update()
+            if request == 'I':
+                return self._temperature(self.temperature)
+            elif request == 'S':
+                return self._temperature(self.setpoint)
+            elif request.startswith('S '):
+                m = re.match(r'S\s+(-?\d+)$', request)
+                if m is None:
+                    return 'F123\r'
+                setpoint = int(m.group(1)) / 100.
+                if (setpoint < -50) or (setpoint > 200):
+                    return 'F123\r'
+                self.setpoint = setpoint
+                return '$\r'
+            elif request == 'GO':
+                self.circulating = True
+                return '$\r'
+            elif request == 'ST':
+                self.circulating = False
+                return '$\r'
+            elif request.lower() == 'r pf':
+                return 'PF%.2f$\r' % (self.pumppower * self.circulating)
+            elif request == 'V':
+                return self.version + '\r'
+            elif request == 'B':
+                flags = [self.circulating, False, self.faults['mainrelay_fault'], self.faults['overtemperature_fault'],
+                         self.faults['liquidlevel_fault'], self.faults[
+                             'motor_overload_fault'], self.faults['external_connection_fault'],
+                         self.faults['cooling_fault'], False, False, self.faults['internal_pt100_fault'], self.faults['external_pt100_fault']]
+                return ''.join(str(int(f)) for f in flags) + '$\r'
+            elif request.upper() == 'R CC':
+                return 'CC%d$\r' % (self.circulating and self.temperature > self.setpoint)
+            return 'F001\r'
@@ -0,0 +1,385 @@
+from .simulator import Simulator
+import numpy as np
+import threading
+import datetime
+import hashlib
+import base64
+import logging
+import time
+import os
+import re
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['PilatusSimulator', 'byte_offset_compress', 'write_cbf']
+
+CBF_BINARY_START = '\x0c\x1a\x04\xd5'
+CBF_PADDING = 4095
+
+# (first row, last row + 1) of the insensitive gaps between the modules
+PILATUS300K_GAPS = [(195, 212), (407, 424)]
+
+
+def byte_offset_compress(data):
+    """Compress an integer array with the CBF byte-offset algorithm. Returns
+    the compressed data as a string."""
+    flat = np.asarray(data, dtype=np.int64).ravel()
+    delta = np.empty_like(flat)
+    delta[0] = flat[0]
+    delta[1:] = flat[1:] - flat[:-1]
+    absdelta = np.abs(delta)
+    lengths = np.ones(len(delta), np.int64)
+    lengths[absdelta > 127] = 3
+    lengths[absdelta > 32767] = 7
+    offsets = np.zeros(len(delta), np.int64)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    out = np.zeros(lengths.sum(), np.uint8)
+    idx = lengths == 1
+    out[offsets[idx]] = delta[idx] & 0xff
+    idx = lengths == 3
+    o = offsets[idx]
+    d = delta[idx]
+    out[o] = 0x80
+    out[o + 1] = d & 0xff
+    out[o + 2] = (d >> 8) & 0xff
+    idx = lengths == 7
+    o = offsets[idx]
+    d = delta[idx]
+    out[o] = 0x80
+    out[o + 1] = 0x00
+    out[o + 2] = 0x80
+    for k in range(4):
+        out[o + 3 + k] = (d >> (8 * k)) & 0xff
+    return out.tostring()
+
+
+def write_cbf(filename, data, headerlines):
+    """Write a Pilatus-style mini-CBF file. `headerlines` is a list of
+    strings which are written in the header_contents section, each prefixed
+    by '# '."""
+    binary = byte_offset_compress(data)
+    lines = ['###CBF: VERSION 1.5, CBFlib v0.7.8 - PILATUS detectors',
+             '',
+             'data_' + os.path.splitext(os.path.basename(filename))[0],
+             '',
+             '_array_data.header_convention "PILATUS_1.2"',
+             '_array_data.header_contents',
+             ';'] + ['# ' + l for l in headerlines] + \
+        [';',
+         '',
+         '_array_data.data',
+         ';',
+         '--CIF-BINARY-FORMAT-SECTION--',
+         'Content-Type: application/octet-stream;',
+         '     conversions="x-CBF_BYTE_OFFSET"',
+         'Content-Transfer-Encoding: BINARY',
+         'X-Binary-Size: %d' % len(binary),
+         'X-Binary-ID: 1',
+         'X-Binary-Element-Type: "signed 32-bit integer"',
+         'X-Binary-Element-Byte-Order: LITTLE_ENDIAN',
+         'Content-MD5: ' + base64.b64encode(hashlib.md5(binary).digest()),
+         'X-Binary-Number-of-Elements: %d' % data.size,
+         'X-Binary-Size-Fastest-Dimension: %d' % data.shape[1],
+         'X-Binary-Size-Second-Dimension: %d' % data.shape[0],
+         'X-Binary-Size-Padding: %d' % CBF_PADDING,
+         '',
+         '']
+    with open(filename, 'wb') as f:
+        f.write('\r\n'.join(lines) + CBF_BINARY_START + binary +
+                '\0' * CBF_PADDING + '\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n\r\n')
+
+
+class PilatusSimulator(Simulator):
+
+    """Simulator of the camserver program of a Pilatus 300k detector.
+
+    Replies are terminated by the \\x18 character. The first connected
+    client gets read-write access, the others can only query. Exposures
+    write synthetic scattering patterns as CBF files into `imgpath` at the
+    cadence given by ExpTime, ExpPeriod and NImages. If the file name ends
+    in a number, it is incremented for each image of a multi-image exposure.
+    """
+    name = 'pilatus'
+    shape = (619, 487)
+    cameradef = 'PILATUS-300K, 3-0133'
+    cameraname = 'PILATUS 300K'
+    cameraSN = '3-0133'
+    version = 'tvx-7.3.13-121212'
+
+    def __init__(self, host='127.0.0.1', port=41234, latency=0, jitter=0, imgpath='images',
+                 beampos=(308, 244), intensity=1e4, trimtime=1.0):
+        Simulator.__init__(self, host, port, latency, jitter)
+        self.imgpath = os.path.abspath(imgpath)
+        self.beampos = beampos
+        self.intensity = intensity
+        self.trimtime = trimtime
+        self.exptime = 1.0
+        self.expperiod = 1.003
+        self.nimages = 1
+        self.tau = 383.8e-9
+        self.cutoff = 1077896
+        self.gain = 'high'
+        self.threshold = 4024
+        self.vcmp = 0.654
+        self.imgmode = 'x-ray'
+        self.temperatures = [28.0, 25.5, 23.2]
+        self.humidities = [10.3, 11.2, 2.1]
+        self._pids = {}
+        self._nextpid = 12345
+        self._controller = None
+        self._exposurethread = None
+        self._stopexposure = threading.Event()
+        self._exposure_end = 0
+        self._targetfile = None
+        self._lastimage = None
+        self._lastcompleted = None
+
+    def split_requests(self, buf):
+        lines = buf.split('\n')
+        return [l.strip() for l in lines[:-1] if l.strip()], lines[-1]
+
+    def _reply(self, context, text, status='OK'):
+        return '%d %s %s\x18' % (context, status, text)
+
+    def _now(self):
+        return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+
+    def _is_exposing(self):
+        return (self._exposurethread is not None) and self._exposurethread.is_alive()
+
+    def handle(self, request, conn):
+        with self._lock:
+            if conn not in self._pids:
+                self._pids[conn] = self._nextpid
+                self._nextpid += 1
+                if self._controller is None:
+                    self._controller = conn
+            args = request.split(None, 1)
+            command = args[0].lower()
+            if len(args) > 1:
+                arg = args[1].strip()
+            else:
+                arg = None
+            readonly = (arg is None) and (
+                command not in ['exposure', 'k', 'resetcam'])
+            if not readonly and conn is not self._controller:
+                return self._reply(1, 'access denied', 'ERR')
+            try:
+                handler = getattr(self, '_cmd_' + command)
+            except AttributeError:
+                return self._reply(1, 'Unrecognized command: ' + args[0], 'ERR')
+            return handler(arg, conn)
+
+    def client_disconnected(self, conn):
+        with self._lock:
+            if conn in self._pids:
+                del self._pids[conn]
+            if self._controller is conn:
+                self._controller = None
+                if self._pids:
+                    self._controller = min(
+                        self._pids, key=lambda c: self._pids[c])
+
+    def _cmd_showpid(self, arg, conn):
+        return self._reply(16, 'PID = %d' % self._pids[conn])
+
+    def _cmd_version(self, arg, conn):
+        return self._reply(24, 'Code release:  ' + self.version)
+
+    def _cmd_exptime(self, arg, conn):
+        if arg is not None:
+            try:
+                self.exptime = float(arg)
+            except ValueError:
+                return self._reply(15, 'Illegal exposure time', 'ERR')
+        return self._reply(15, 'Exposure time set to: %.7f sec.' % self.exptime)
+
+    def _cmd_expperiod(self, arg, conn):
+        if arg is not None:
+            try:
+                self.expperiod = float(arg)
+            except ValueError:
+                return self._reply(15, 'Illegal exposure period', 'ERR')
+        return self._reply(15, 'Exposure period set to: %.7f sec' % self.expperiod)
+
+    def _cmd_nimages(self, arg, conn):
+        if arg is not None:
+            self.nimages = max(1, int(arg))
+        return self._reply(15, 'N images set to: %d' % self.nimages)
+
+    def _cmd_tau(self, arg, conn):
+        if arg is None:
+            if self.tau:
+                return self._reply(15, 'Rate correction is on; tau = %g s, cutoff = %d counts' % (self.tau, self.cutoff))
+            else:
+                return self._reply(15, 'Rate correction is off, cutoff = %d counts' % self.cutoff)
+        try:
+            self.tau = float(arg)
+        except ValueError:
+            return self._reply(15, 'Invalid argument; ' + arg, 'ERR')
+        if self.tau:
+            return self._reply(15, 'Set up rate correction: tau = %g s' % self.tau)
+        else:
+            return self._reply(15, 'Turn off rate correction')
+
+    def _cmd_imgpath(self, arg, conn):
+        if arg is not None:
+            self.imgpath = arg
+        return self._reply(10, self.imgpath.rstrip('/') + '/')
+
+    def _cmd_imgmode(self, arg, conn):
+        if arg is not None:
+            self.imgmode = arg
+        return self._reply(15, 'ImgMode is ' + self.imgmode)
+
+    def _cmd_df(self, arg, conn):
+        try:
+            st = os.statvfs(self.imgpath)
+            df = st.f_bavail * st.f_frsize / 1024
+        except OSError:
+            df = 0
+        return self._reply(5, '%d' % df)
+
+    def _cmd_telemetry(self, arg, conn):
+        text = ('=== Telemetry at %s ===\nImage format: %d(w) x %d(h) pixels\n'
+                'Selected bank: 0\nSelected module: 1\nSelected chip: 0\n') % ((self._now(),) + self.shape[::-1])
+        for i, (t, h) in enumerate(zip(self.temperatures, self.humidities)):
+            text += 'Channel %d: Temperature = %.1fC, Rel. Humidity = %.1f%%\n' % (
+                i, t, h)
+        return self._reply(18, text)
+
+    def _cmd_thread(self, arg, conn):
+        return self._reply(215, ';\n'.join('Channel %d: Temperature = %.1fC, Rel. Humidity = %.1f%%' % (i, t, h)
+                                           for i, (t, h) in enumerate(zip(self.temperatures, self.humidities))))
+
+    def _thresholdsettings(self):
+        return 'Settings: %s gain; threshold: %d eV; vcmp: %.3f V\n Trim file:\n  /home/det/p2_det/config/calibration/p300k0133_E%d_T%d_vrf_m0p20.bin' % (
+            self.gain, self.threshold, self.vcmp, 2 * self.threshold, self.threshold)
+
+    def _cmd_setthreshold(self, arg, conn):
+        if arg is None:
+            return self._reply(15, self._thresholdsettings())
+        args = arg.split()
+        try:
+            threshold = int(args[-1])
+        except ValueError:
+            return self._reply(15, 'Threshold has not been set', 'ERR')
+        if not (2000 <= threshold <= 20000):
+            return self._reply(15, 'Requested threshold (%.1f eV) is out of range' % threshold, 'ERR')
+        if len(args) > 1:
+            self.gain = {'lowg': 'low', 'midg': 'mid', 'highg': 'high', 'uhighg': 'ultrahigh'}.get(
+                args[0].lower(), args[0])
+        self.threshold = threshold
+        self.vcmp = 0.2 + threshold / 1e4
+
+        def finish_trimming():
+            time.sleep(self.trimtime)
+            self.send(conn, self._reply(15, '/tmp/setthreshold.cmd'))
+        t = threading.Thread(target=finish_trimming)
+        t.daemon = True
+        t.start()
+        return None
+
+    def _cmd_camsetup(self, arg, conn):
+        if self._is_exposing():
+            state = 'exposing'
+            timeleft = max(0, self._exposure_end - time.time())
+        else:
+            state = 'idle'
+            timeleft = 0
+        text = ('\n Camera definition:\n\t%s\n Camera name: %s, S/N %s\n Camera state: %s\n'
+                ' Target file: %s\n Time left: %.6f\n Last image: %s\n Master PID is: 0\n'
+                ' Controlling PID is: %d\n Exposure time: %.6f\n Last completed image:\n\t%s\n'
+                ' Shutter is: (nil)\n') % (self.cameradef, self.cameraname, self.cameraSN, state,
+                                           self._targetfile or '(nil)', timeleft, self._lastimage or '(nil)',
+                                           self._pids.get(self._controller, 0), self.exptime,
+                                           self._lastcompleted or '(nil)')
+        return self._reply(2, text)
+
+    def _cmd_exposure(self, arg, conn):
+        if self._is_exposing():
+            return self._reply(15, 'Camera busy, exposure in progress', 'ERR')
+        if arg is None:
+            return self._reply(15, 'No file name given', 'ERR')
+        if not os.path.isabs(arg):
+            arg = os.path.join(self.imgpath, arg)
+        self._stopexposure.clear()
+        self._targetfile = arg
+        starttime = self._now()
+        self._exposure_end = time.time() + self.exptime + \
+            (self.nimages - 1) * self.expperiod
+        self._exposurethread = threading.Thread(target=self._expose, args=(
+            conn, arg, self.exptime, self.expperiod, self.nimages))
+        self._exposurethread.daemon = True
+        self._exposurethread.start()
+        return self._reply(15, 'Starting %.6f second background: %s' % (self.exptime, starttime))
+
+    def _cmd_k(self, arg, conn):
+        self._stopexposure.set()
+        return self._reply(13, 'kill')
+
+    def _cmd_resetcam(self, arg, conn):
+        self._stopexposure.set()
+        return self._reply(15, '')
+
+    def _image_filename(self, firstfile, idx):
+        if not idx:
+            return firstfile
+        m = re.match(r'(?P<begin>.*?)(?P<number>\d+)(?P<end>\.\w+)$', firstfile)
+        if m is None:
+            base, ext = os.path.splitext(firstfile)
+            return '%s_%05d%s' % (base, idx, ext)
+        return '%s%0*d%s' % (m.group('begin'), len(m.group('number')),
+                             int(m.group('number')) + idx, m.group('end'))
+
+    def synthetic_image(self, exptime):
+        """Simulate a scattering pattern: Lorentzian-squared peak around the
+        beam position on a flat background, with Poisson noise and the
+        insensitive module gaps set to -1."""
+        row, col = np.ogrid[0:self.shape[0], 0:self.shape[1]]
+        r2 = (row - self.beampos[0]) ** 2 + (col - self.beampos[1]) ** 2
+        lam = exptime * (self.intensity / (1 + r2 / 400.) ** 2 + 0.5)
+        data = np.random.poisson(lam).astype(np.int32)
+        for g1, g2 in PILATUS300K_GAPS:
+            data[g1:g2, :] = -1
+        return data
+
+    def _expose(self, conn, firstfile, exptime, expperiod, nimages):
+        t0 = time.time()
+        status = 'OK'
+        filename = firstfile
+        for i in range(nimages):
+            filename = self._image_filename(firstfile, i)
+            with self._lock:
+                self._lastimage = filename
+            if self._stopexposure.wait(max(0, t0 + exptime + i * expperiod - time.time())):
+                status = 'ERR'
+                break
+            header = ['Detector: %s, S/N %s' % (self.cameraname, self.cameraSN),
+                      self._now(),
+                      'Pixel_size 172e-6 m x 172e-6 m',
+                      'Silicon sensor, thickness 0.000450 m',
+                      'Exposure_time %.7f s' % exptime,
+                      'Exposure_period %.7f s' % expperiod,
+                      'Tau = %g s' % self.tau,
+                      'Count_cutoff %d counts' % self.cutoff,
+                      'Threshold_setting: %d eV' % self.threshold,
+                      'Gain_setting: %s gain (vrf = -0.200)' % self.gain,
+                      'N_excluded_pixels = 0',
+                      'Excluded_pixels: badpix_mask.tif',
+                      'Flat_field: (nil)',
+                      'Trim_file: p300k0133_E%d_T%d_vrf_m0p20.bin' % (
+                          2 * self.threshold, self.threshold),
+                      'Image_path: ' + os.path.dirname(filename) + '/']
+            try:
+                write_cbf(filename, self.synthetic_image(exptime), header)
+            except IOError as ioe:
+                logger.error('Cannot write image %s: %s' % (filename, ioe))
+                status = 'ERR'
+                break
+            with self._lock:
+                self._lastcompleted = filename
+        with self._lock:
+            self._targetfile = None
+        self.send(conn, self._reply(7, filename, status))
@@ -0,0 +1,153 @@
+import socket
+import threading
+import random
+import select
+import time
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['Simulator']
+
+
+class Simulator(object):
+
+    """Base class of instrument simulators.
+
+    A simulator listens on a local TCP port and serves each connected client
+    in a separate thread, just like ser2net or camserver do. Incoming bytes
+    are collected in a buffer, which split_requests() cuts into requests.
+    Each request is passed to handle(), and the returned reply (if not None)
+    is sent back after a delay of `latency` seconds plus a normally
+    distributed random term with `jitter` standard deviation.
+
+    Subclasses should protect their state with self._lock, since several
+    clients can be served concurrently.
+    """
+    name = 'simulator'
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, jitter=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self._lock = threading.RLock()
+        self._socket = None
+        self._clients = []
+        self._clientslock = threading.Lock()
+        self._stopswitch = threading.Event()
+        self._thread = None
+
+    @property
+    def address(self):
+        if self._socket is None:
+            return (self.host, self.port)
+        return self._socket.getsockname()
+
+    def start(self):
+        """Start listening in a background thread. Returns the (host, port)
+        address of the server, which is useful if port was 0."""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(5)
+        self._stopswitch.clear()
+        self._thread = threading.Thread(
+            target=self._accept_loop, name=self.name + '-accept')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info('Simulator %s listening on %s:%d' %
+                    ((self.name,) + self.address))
+        return self.address
+
+    def stop(self):
+        self._stopswitch.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._clientslock:
+            for c in self._clients:
+                try:
+                    c.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def reply_delay(self):
+        return max(0, random.gauss(self.latency, self.jitter))
+
+    def split_requests(self, buf):
+        """Split the receive buffer into a list of complete requests and the
+        remaining (incomplete) data. Must be overridden."""
+        raise NotImplementedError
+
+    def handle(self, request, conn):
+        """Compute the reply to `request`. Return None for no reply."""
+        raise NotImplementedError
+
+    def send(self, conn, message):
+        """Send a message to a client. Can be called from any thread."""
+        try:
+            conn.sendall(message)
+        except socket.error:
+            logger.debug('Cannot send message to client of simulator %s: ' %
+                         self.name + traceback.format_exc())
+
+    def send_to_all(self, message):
+        with self._clientslock:
+            clients = self._clients[:]
+        for c in clients:
+            self.send(c, message)
+
+    def _accept_loop(self):
+        while not self._stopswitch.is_set():
+            r, w, e = select.select([self._socket], [], [], 0.1)
+            if not r:
+                continue
+            conn, addr = self._socket.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._clientslock:
+                self._clients.append(conn)
+            t = threading.Thread(
+                target=self._serve, args=(conn,), name=self.name + '-client')
+            t.daemon = True
+            t.start()
+
+    def _serve(self, conn):
+        logger.debug('Client connected to simulator %s' % self.name)
+        buf = ''
+        try:
+            while not self._stopswitch.is_set():
+                r, w, e = select.select([conn], [], [], 0.1)
+                if not r:
+                    continue
+                data = conn.recv(4096)
+                if not data:
+                    break
+                requests, buf = self.split_requests(buf + data)
+                for req in requests:
+                    try:
+                        reply = self.handle(req, conn)
+                    except Exception:
+                        logger.error('Error in simulator %s while handling request %s: ' % (
+                            self.name, repr(req)) + traceback.format_exc())
+                        continue
+                    if reply is not None:
+                        time.sleep(self.reply_delay())
+                        self.send(conn, reply)
+        except socket.error:
+            logger.debug('Socket error in simulator %s: ' %
+                         self.name + traceback.format_exc())
+        finally:
+            with self._clientslock:
+                self._clients.remove(conn)
+            conn.close()
+            self.client_disconnected(conn)
+            logger.debug('Client disconnected from simulator %s' % self.name)
+
+    def client_disconnected(self, conn):
+        pass
@@ -0,0 +1,235 @@
+from .simulator import Simulator
+import logging
+import struct
+import random
+import math
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['TMCMSimulator']
+
+TMCL_STATUS_SUCCESS = 100
+TMCL_STATUS_CHECKSUM = 1
+TMCL_STATUS_INVALID_COMMAND = 2
+TMCL_STATUS_WRONG_TYPE = 3
+TMCL_STATUS_INVALID_VALUE = 4
+
+
+class SimulatedAxis(object):
+
+    """A stepper motor axis with a trapezoidal velocity profile.
+
+    Positions are in microsteps, speeds and accelerations are in the raw
+    units of the TMCM modules (see conv_speed_to_phys() and
+    conv_accel_to_phys() in tmcl_motor.py). The motion is computed
+    analytically from the time of the last MVP, ROR, ROL or MST command.
+    """
+
+    def __init__(self, f_clk, left_switch=-2 ** 31, right_switch=2 ** 31 - 1):
+        self.f_clk = f_clk
+        self.left_switch = left_switch
+        self.right_switch = right_switch
+        self.params = {4: 1000,  # Max_speed
+                       5: 100,  # Max_accel
+                       6: 128,  # Max_RMS_current
+                       7: 8,  # Standby_RMS_current
+                       12: 0,  # Right_limit_disable
+                       13: 0,  # Left_limit_disable
+                       138: 0,  # Ramp_mode
+                       140: 6,  # Ustep_resol
+                       153: 7,  # Ramp_div
+                       154: 3,  # Pulse_div
+                       204: 0,  # Freewheeling_delay
+                       }
+        self._t0 = time.time()
+        self._x0 = 0
+        self._direction = 0
+        self._distance = 0
+        self._vmax = 0
+        self._accel = 1
+        self.target = 0
+
+    def speed_to_pps(self, speed):
+        return self.f_clk * speed / (2.0 ** self.params[154] * 2048 * 32)
+
+    def pps_to_speed(self, pps):
+        return pps * 2.0 ** self.params[154] * 2048 * 32 / self.f_clk
+
+    def accel_to_pps2(self, accel):
+        return accel * float(self.f_clk) ** 2 / 2.0 ** (self.params[154] + self.params[153] + 29)
+
+    def _profile(self, t):
+        """Return the distance travelled and the speed (microsteps/sec) at
+        time t after the start of the motion."""
+        a = self._accel
+        vmax = self._vmax
+        D = self._distance
+        if a <= 0 or vmax <= 0 or D <= 0:
+            return 0, 0
+        if D >= vmax ** 2 / a:
+            tacc = vmax / a
+            tconst = (D - vmax ** 2 / a) / vmax
+            vpeak = vmax
+        else:
+            tacc = math.sqrt(D / a)
+            tconst = 0
+            vpeak = a * tacc
+        if t < tacc:
+            return 0.5 * a * t ** 2, a * t
+        elif t < tacc + tconst:
+            return 0.5 * a * tacc ** 2 + vpeak * (t - tacc), vpeak
+        elif t < 2 * tacc + tconst:
+            td = t - tacc - tconst
+            return 0.5 * a * tacc ** 2 + vpeak * tconst + vpeak * td - 0.5 * a * td ** 2, vpeak - a * td
+        else:
+            return D, 0
+
+    def state(self, now=None):
+        """Return the current (position, speed) pair. Speed is signed and in
+        microsteps/sec."""
+        if now is None:
+            now = time.time()
+        s, v = self._profile(now - self._t0)
+        pos = self._x0 + self._direction * s
+        speed = self._direction * v
+        if pos <= self.left_switch and not self.params[13] and self._direction < 0:
+            return self.left_switch, 0
+        if pos >= self.right_switch and not self.params[12] and self._direction > 0:
+            return self.right_switch, 0
+        return int(round(pos)), speed
+
+    def _start(self, target, vmax):
+        pos, speed = self.state()
+        self._t0 = time.time()
+        self._x0 = pos
+        self._direction = cmp(target, pos)
+        self._distance = abs(target - pos)
+        self._vmax = self.speed_to_pps(vmax)
+        self._accel = self.accel_to_pps2(self.params[5])
+
+    def move_to(self, target):
+        self.params[138] = 0
+        self.target = target
+        self._start(target, self.params[4])
+
+    def rotate(self, speed):
+        self.params[138] = 2
+        if speed > 0:
+            self._start(2 ** 31 - 1, abs(speed))
+        elif speed < 0:
+            self._start(-2 ** 31, abs(speed))
+        else:
+            self.stop()
+
+    def stop(self):
+        pos, speed = self.state()
+        self._t0 = time.time()
+        self._x0 = pos
+        self._distance = 0
+        self._direction = 0
+
+    def get(self, typ):
+        pos, speed = self.state()
+        if typ == 0:
+            return self.target
+        elif typ == 1:
+            return pos
+        elif typ == 3:
+            return int(round(abs(self.pps_to_speed(speed))))
+        elif typ == 10:
+            return int(pos >= self.right_switch)
+        elif typ == 11:
+            return int(pos <= self.left_switch)
+        elif typ == 206:
+            if speed:
+                return random.randint(100, 300)
+            return 0
+        return self.params.get(typ, 0)
+
+    def set(self, typ, value):
+        if typ == 0:
+            self.target = value
+            if self.params[138] == 0:
+                self._start(value, self.params[4])
+        elif typ == 1:
+            self.stop()
+            self._x0 = value
+            if self.params[138] == 0:
+                self.target = value
+        elif typ in [3, 10, 11, 206]:
+            raise ValueError('Read-only axis parameter %d' % typ)
+        else:
+            self.params[typ] = value
+
+
+class TMCMSimulator(Simulator):
+
+    """Simulator of a Trinamic TMCM351 or TMCM6110 stepper motor controller,
+    speaking TMCL over TCP (like through ser2net).
+
+    Supported instructions: ROR (1), ROL (2), MST (3), MVP (4), SAP (5),
+    GAP (6), STAP (7) and the firmware version query (136). Motion follows a
+    trapezoidal profile computed from Max_speed, Max_accel, Pulse_div and
+    Ramp_div. Limit switches can be placed with the `limits` argument, a
+    list of (left, right) microstep positions, one for each axis.
+    """
+    name = 'tmcm'
+    _versions = {'TMCM351': 0x015f, 'TMCM6110': 0x17de}
+    _naxes = {'TMCM351': 3, 'TMCM6110': 6}
+
+    def __init__(self, host='127.0.0.1', port=2001, latency=0, jitter=0, hwtype='TMCM351',
+                 firmware=(1, 1), f_clk=16000000, limits=None):
+        Simulator.__init__(self, host, port, latency, jitter)
+        self.hwtype = hwtype
+        self.firmware = firmware
+        if limits is None:
+            limits = [(-2 ** 31, 2 ** 31 - 1)] * self._naxes[hwtype]
+        self.axes = [SimulatedAxis(f_clk, l, r) for l, r in limits]
+
+    def split_requests(self, buf):
+        n = len(buf) // 9 * 9
+        return [buf[i:i + 9] for i in range(0, n, 9)], buf[n:]
+
+    def _reply(self, status, instruction, value=0):
+        reply = struct.pack('>BBBBi', 2, 1, status, instruction, value)
+        return reply + chr(sum(ord(x) for x in reply) % 256)
+
+    def handle(self, request, conn):
+        address, instruction, typ, motor, value, checksum = struct.unpack(
+            '>BBBBiB', request)
+        if sum(ord(x) for x in request[:8]) % 256 != checksum:
+            return self._reply(TMCL_STATUS_CHECKSUM, instruction)
+        with self._lock:
+            if instruction == 136:
+                return self._reply(TMCL_STATUS_SUCCESS, instruction,
+                                   self._versions[self.hwtype] * 0x10000 + self.firmware[0] * 0x100 + self.firmware[1])
+            if instruction not in [1, 2, 3, 4, 5, 6, 7]:
+                return self._reply(TMCL_STATUS_INVALID_COMMAND, instruction)
+            if motor >= len(self.axes):
+                return self._reply(TMCL_STATUS_INVALID_VALUE, instruction)
+            axis = self.axes[motor]
+            if instruction == 1:
+                axis.rotate(value)
+            elif instruction == 2:
+                axis.rotate(-value)
+            elif instruction == 3:
+                axis.stop()
+            elif instruction == 4:
+                if typ == 0:
+                    axis.move_to(value)
+                elif typ == 1:
+                    axis.move_to(axis.target + value)
+                else:
+                    return self._reply(TMCL_STATUS_WRONG_TYPE, instruction)
+            elif instruction == 5:
+                try:
+                    axis.set(typ, value)
+                except ValueError:
+                    return self._reply(TMCL_STATUS_WRONG_TYPE, instruction)
+            elif instruction == 6:
+                value = axis.get(typ)
+            elif instruction == 7:
+                return self._reply(TMCL_STATUS_SUCCESS, instruction)
+            return self._reply(TMCL_STATUS_SUCCESS, instruction, value)
@@ -0,0 +1,76 @@
+from .simulator import Simulator
+import logging
+import random
+import math
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ['VacuumGaugeSimulator']
+
+
+def _checksum(mesg):
+    return chr(sum(ord(x) for x in mesg) % 64 + 64)
+
+
+class VacuumGaugeSimulator(Simulator):
+
+    """Simulator of the TPG-201 vacuum gauge, speaking its serial protocol
+    through TCP (like through ser2net).
+
+    Requests and replies have the form '001' + code + data + checksum + CR.
+    The pressure is pumped down exponentially from `p_start` towards
+    `p_final` with a time constant of `timeconstant` seconds, with a few
+    percent of multiplicative noise.
+    """
+    name = 'vacgauge'
+    version = '010120'
+
+    def __init__(self, host='127.0.0.1', port=2002, latency=0, jitter=0,
+                 p_start=1000., p_final=0.05, timeconstant=60., noise=0.02):
+        Simulator.__init__(self, host, port, latency, jitter)
+        self.p_start = p_start
+        self.p_final = p_final
+        self.timeconstant = timeconstant
+        self.noise = noise
+        self.units = 0
+        self._t0 = time.time()
+
+    def split_requests(self, buf):
+        lines = buf.split('\r')
+        return lines[:-1], lines[-1]
+
+    def pressure(self):
+        p = self.p_final + (self.p_start - self.p_final) * \
+            math.exp(-(time.time() - self._t0) / self.timeconstant)
+        return p * (1 + random.gauss(0, self.noise))
+
+    def _format_pressure(self, p):
+        exponent = int(math.floor(math.log10(p)))
+        mantissa = int(round(p / 10 ** (exponent - 3)))
+        if mantissa >= 10000:
+            mantissa //= 10
+            exponent += 1
+        return '%04d%02d' % (mantissa, exponent - 3 + 23)
+
+    def _reply(self, code, data):
+        mesg = '001' + code + data
+        return mesg + _checksum(mesg) + '\r'
+
+    def handle(self, request, conn):
+        if len(request) < 5 or _checksum(request[:-1]) != request[-1] or not request.startswith('001'):
+            return None
+        code = request[3]
+        data = request[4:-1]
+        with self._lock:
+            if code == 'M':
+                return self._reply(code, self._format_pressure(self.pressure()))
+            elif code == 'T':
+                return self._reply(code, self.version)
+            elif code == 'U':
+                return self._reply(code, '%d' % self.units)
+            elif code == 'u':
+                self.units = int(data)
+                return self._reply(code, data)
+            return None
@@ -5,15 +5,22 @@ import logging
 from gi.repository import GObject
 import Queue
 import threading
+import multiprocessing
+import multiprocessing.queues
+import collections
+import itertools
 import weakref
 from gi.repository import GLib
 import matplotlib.figure
 import matplotlib.backends.backend_agg
 import time
 import traceback
-import numpy as np
 
 from .subsystem import SubSystem, SubSystemError
+from ..reduction.corrections import CorrectionMapCache, correction_key, correction_map, quantize
+from ..reduction.kernel import FusedCorrection
+from ..reduction.profiler import ReductionProfiler, add_diagnostics
+from ..reduction.radavg import radial_average
 from ...utils import objwithgui
 from inspect import ArgSpec
 
@@ -30,6 +37,8 @@ class ExposureFlaggedException(Exception):
 
 
 class DataReductionStep(objwithgui.ObjWithGUI):
+    # if the step changes the intensity and the error matrices
+    changes_data = True
 
     def __init__(self, chain):
         objwithgui.ObjWithGUI.__init__(self)
@@ -51,6 +60,17 @@ class DataReductionStep(objwithgui.ObjWithGUI):
         """
         raise NotImplementedError
 
+    def fuse(self, exposure, kernel, force=False):
+        """Queue the operations of this step on `exposure` into `kernel` (an
+        instance of FusedCorrection) instead of executing them, for the fused
+        mode of the reduction chain. Header updates are done immediately.
+
+        Should return True if the step has been taken care of, False if it
+        has to be executed normally (the queued operations are applied to
+        the exposure before).
+        """
+        return False
+
     def idlefunc(self):
         pass
 
@@ -59,6 +79,54 @@ class DataReductionStep(objwithgui.ObjWithGUI):
         logger.debug('Reducing #%d: %s' % (exposure['FSN'], mesg))
 
 
+def run_steps(steps, exposure, force=False, fused=False, profiler=None, diagnostics=False):
+    """Carry out the data reduction `steps` on `exposure`. In fused mode,
+    the operations of consecutive steps supporting it (see
+    DataReductionStep.fuse()) are applied together. The time and the
+    allocations of the steps and the fused passes are accounted in
+    `profiler` (a ReductionProfiler), if given. The diagnostic statistics
+    (see add_diagnostics()) are added to the history after each step
+    changing the data (or fused pass) only if `diagnostics` is True.
+    Returns False if a step ended the processing."""
+    if profiler is None:
+        profiler = ReductionProfiler()
+    kernel = FusedCorrection()
+
+    def diagnose():
+        if diagnostics:
+            profiler.measure('Diagnostics', add_diagnostics, exposure)
+
+    def flush():
+        if not kernel.is_empty():
+            profiler.measure('Fused pass', kernel.apply, exposure)
+            diagnose()
+    for step in steps:
+        name = step.__class__.__name__
+        if fused:
+            started = profiler.start()
+            if step.fuse(exposure, kernel, force):
+                profiler.stop(name, started)
+                continue
+            # the attempt is accounted to the execution below
+            profiler.stop(name, started, 0)
+        flush()
+        started = profiler.start()
+        proceed = step.execute(exposure, force)
+        profiler.stop(name, started)
+        if not proceed:
+            return False
+        if step.changes_data:
+            diagnose()
+    flush()
+    return True
+
+
+def wants_diagnostics(exposure, every):
+    """If the diagnostic statistics are to be computed for `exposure`: for
+    every `every`-th FSN, never if zero."""
+    return every > 0 and exposure['FSN'] % every == 0
+
+
 class BackgroundSubtraction(DataReductionStep):
     enable = GObject.property(type=bool, default=True, blurb='Enabled')
     title = GObject.property(
@@ -92,6 +160,23 @@ class BackgroundSubtraction(DataReductionStep):
             return False
         else:
             self.message(exposure, 'Title == ' + self.title)
+        self._check_background(exposure)
+        exposure -= self._lastemptybeamexposure
+        self._update_header(exposure)
+        self.message(exposure, 'Background subtraction done.')
+        return True
+
+    def fuse(self, exposure, kernel, force=False):
+        if not self.enable:
+            return True
+        if exposure['Title'] == self.title:
+            return False
+        self._check_background(exposure)
+        kernel.sub(self._lastemptybeamexposure.Intensity, self._lastemptybeamexposure.Error, exposure)
+        self._update_header(exposure)
+        return True
+
+    def _check_background(self, exposure):
         if self._lastemptybeamexposure is None:
             raise DataReductionError('No background exposure seen yet!')
         if ((abs(float(self._lastemptybeamexposure['EnergyCalibrated']) -
@@ -103,14 +188,11 @@ class BackgroundSubtraction(DataReductionStep):
                 (self._lastemptybeamexposure['FSN']) + str(exposure.header))
         self.message(
             exposure, 'Using background: #%(FSN)d, %(Title)s, %(DistCalibrated).2f mm, %(EnergyCalibrated).2f eV.' % self._lastemptybeamexposure)
-        exposure -= self._lastemptybeamexposure
+
+    def _update_header(self, exposure):
         exposure.header.add_history(
             'Subtracted background: #%(FSN)d, %(Title)s, %(DistCalibrated).2f mm, %(EnergyCalibrated).2f eV.' % self._lastemptybeamexposure)
-        exposure.header.add_history('Maximum relative error: %g' % (
-            np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
         exposure['FSNempty'] = self._lastemptybeamexposure['FSN']
-        self.message(exposure, 'Background subtraction done.')
-        return True
 
 
 class AbsoluteCalibration(DataReductionStep):
@@ -178,8 +260,6 @@ class AbsoluteCalibration(DataReductionStep):
             exposure['NormFactorError'] = float(scalefactor.err)
             exposure.header.add_history(
                 'Normalized into absolute intensity units using reference file %s' % self.reference_datafile)
-            exposure.header.add_history('Maximum relative error: %g' % (
-                np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
             f = matplotlib.figure.Figure()
             canvas = matplotlib.backends.backend_agg.FigureCanvasAgg(f)
             ax = f.add_subplot(1, 1, 1)
@@ -196,6 +276,24 @@ class AbsoluteCalibration(DataReductionStep):
             del f
             self._lastgcexposure = exposure
             return True
+        self._check_reference(exposure)
+        exposure *= sastool.misc.ErrorValue(
+            self._lastgcexposure['NormFactor'], self._lastgcexposure['NormFactorError'])
+        self._update_header(exposure)
+        self.message(exposure, 'Scaled into absolute intensity units.')
+        return True
+
+    def fuse(self, exposure, kernel, force=False):
+        if not self.enable:
+            return True
+        if exposure['Title'] == self.title:
+            return False
+        self._check_reference(exposure)
+        kernel.mul(self._lastgcexposure['NormFactor'], self._lastgcexposure['NormFactorError'])
+        self._update_header(exposure)
+        return True
+
+    def _check_reference(self, exposure):
         if self._lastgcexposure is None:
             raise DataReductionError(
                 'No intensity reference exposure seen yet!')
@@ -208,17 +306,13 @@ class AbsoluteCalibration(DataReductionStep):
                 (self._lastgcexposure['FSN']) + str(exposure.header))
         self.message(
             exposure, 'Using intensity reference: #%(FSN)d, %(Title)s, %(DistCalibrated).2f mm, %(EnergyCalibrated).2f eV.' % self._lastgcexposure)
-        exposure *= sastool.misc.ErrorValue(
-            self._lastgcexposure['NormFactor'], self._lastgcexposure['NormFactorError'])
+
+    def _update_header(self, exposure):
         exposure['FSNref1'] = self._lastgcexposure['FSN']
         exposure['NormFactor'] = self._lastgcexposure['NormFactor']
         exposure['NormFactorError'] = self._lastgcexposure['NormFactorError']
         exposure.header.add_history(
             'Used absolute intensity reference for scaling: #%(FSN)d, %(Title)s, %(DistCalibrated).2f mm, %(EnergyCalibrated).2f eV.' % self._lastgcexposure)
-        exposure.header.add_history('Maximum relative error: %g' % (
-            np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
-        self.message(exposure, 'Scaled into absolute intensity units.')
-        return True
 
 
 class CorrectGeometry(DataReductionStep):
@@ -232,43 +326,71 @@ class CorrectGeometry(DataReductionStep):
     angle_dependent_air_absorption_mu0 = GObject.property(
         type=float, default=1 / 88.349, minimum=0,
         blurb='Absorption coefficient of flight path gas at 1000 mbar (1/cm)')
+    transmission_tolerance = GObject.property(
+        type=float, default=0, minimum=0,
+        blurb='Transmission tolerance of the cached self-absorption correction')
+    pressure_tolerance = GObject.property(
+        type=float, default=0.1, minimum=0,
+        blurb='Pressure tolerance of the cached air absorption correction (mbar)')
+    cachesize = GObject.property(
+        type=int, default=16, minimum=1, blurb='Number of correction maps kept in memory')
+    cachedir = GObject.property(
+        type=str, default='', blurb='Folder for the correction maps dropped from the memory')
+    cachedirsize = GObject.property(
+        type=int, default=256, minimum=1, blurb='Number of correction maps kept in the folder')
 
     def __init__(self, chain):
         DataReductionStep.__init__(self, chain)
+        self._OWG_init_lists()
+        self._OWG_entrytypes['cachedir'] = objwithgui.OWG_Param_Type.Folder
+        self._cache = CorrectionMapCache()
 
     def execute(self, exposure, force=False):
+        correction = self._correction(exposure)
+        if correction is not None:
+            exposure *= sastool.ErrorValue(*correction)
+        return True
+
+    def fuse(self, exposure, kernel, force=False):
+        correction = self._correction(exposure)
+        if correction is not None:
+            kernel.mul(*correction)
+        return True
+
+    def _correction(self, exposure):
+        # the combined correction matrix depends only on the geometry (and
+        # the transmission and the pressure), it is cached.
+        transmission = mu = None
+        correction = None
+        if self.angle_dependent_self_absorption:
+            transmission = (quantize(float(exposure['Transm']), self.transmission_tolerance),
+                            quantize(float(exposure['TransmError']), self.transmission_tolerance))
+        if self.angle_dependent_air_absorption and 'Vacuum' in exposure.header:
+            mu = self.angle_dependent_air_absorption_mu0 / \
+                1000.0 * quantize(float(exposure['Vacuum']), self.pressure_tolerance) * 0.1
+        if self.solidangle or (transmission is not None) or (mu is not None):
+            key = correction_key(exposure.header, exposure.shape, self.solidangle, transmission, mu)
+            self._cache.maxsize = self.cachesize
+            self._cache.spilldir = self.cachedir or None
+            self._cache.maxspill = self.cachedirsize
+            correction = self._cache.get(key, lambda: correction_map(
+                exposure.tth, exposure.dtth, exposure['DistCalibrated'],
+                exposure['DistCalibratedError'], self.solidangle, transmission, mu))
         if self.solidangle:
-            exposure *= sastool.ErrorValue(*sastool.utils2d.corrections.solidangle_errorprop(
-                exposure.tth, exposure.dtth, exposure['DistCalibrated'], exposure['DistCalibratedError']))
             exposure.header.add_history('Solid-angle correction done.')
-            exposure.header.add_history('Maximum relative error: %g' % (
-                np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
             self.message(exposure, 'Solid-angle correction done.')
-        if self.angle_dependent_self_absorption:
-            exposure *= sastool.ErrorValue(*sastool.utils2d.corrections.angledependentabsorption_errorprop(
-                exposure.tth, exposure.dtth, exposure['Transm'], exposure['TransmError']))
+        if transmission is not None:
             exposure.header.add_history(
                 'Corrected for angle-dependence of self-absorption.')
-            exposure.header.add_history('Maximum relative error: %g' % (
-                np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
             self.message(
                 exposure, 'Corrected for angle-dependence of self-absorption')
-        if self.angle_dependent_air_absorption:
-            if 'Vacuum' not in exposure.header:
-                exposure.header.add_history(
-                    'Could not carry out angle dependent air absorption correction: Vacuum value not known in header.')
-                exposure.header.add_history('Maximum relative error: %g' % (
-                    np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
-            else:
-                mu = self.angle_dependent_air_absorption_mu0 / \
-                    1000.0 * exposure['Vacuum'] * 0.1
-                exposure *= sastool.ErrorValue(*sastool.utils2d.corrections.angledependentairtransmission_errorprop(
-                    exposure.tth, exposure.dtth, mu, 0, exposure['DistCalibrated'], exposure['DistCalibratedError']))
-                exposure.header.add_history(
-                    'Flight-path air absorption correction done.')
-                exposure.header.add_history('Maximum relative error: %g' % (
-                    np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
-            return True
+        if mu is not None:
+            exposure.header.add_history(
+                'Flight-path air absorption correction done.')
+        elif self.angle_dependent_air_absorption:
+            exposure.header.add_history(
+                'Could not carry out angle dependent air absorption correction: Vacuum value not known in header.')
+        return correction
 
 
 class PreScaling(DataReductionStep):
@@ -289,8 +411,6 @@ class PreScaling(DataReductionStep):
             exposure /= monitor
             exposure.header.add_history(
                 'Normalized by monitor %s' % self.monitorname)
-            exposure.header.add_history('Maximum relative error: %g' % (
-                np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
             self.message(exposure, 'Normalized by monitor %s' %
                          self.monitorname)
         if self.transmission:
@@ -299,11 +419,22 @@ class PreScaling(DataReductionStep):
             exposure /= transm
             exposure.header.add_history(
                 'Normalized by transmission: %s' % transm)
-            exposure.header.add_history('Maximum relative error: %g' % (
-                np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
             self.message(exposure, 'Normalized by transmission.')
         return True
 
+    def fuse(self, exposure, kernel, force=False):
+        if self.monitor:
+            kernel.div(exposure[self.monitorname], exposure[self.monitorname + 'Error'])
+            exposure.header.add_history(
+                'Normalized by monitor %s' % self.monitorname)
+        if self.transmission:
+            transm = sastool.ErrorValue(
+                exposure['Transm'], exposure['TransmError'])
+            kernel.div(transm.val, transm.err)
+            exposure.header.add_history(
+                'Normalized by transmission: %s' % transm)
+        return True
+
 
 class PostScaling(DataReductionStep):
     thickness = GObject.property(
@@ -320,26 +451,36 @@ class PostScaling(DataReductionStep):
             self.message(exposure, 'Divided by thickness: %.4f cm' %
                          exposure['Thickness'])
             exposure.header.add_history('Divided by thickness')
-            exposure.header.add_history('Maximum relative error: %g' % (
-                np.nanmax((exposure.Error / exposure.Intensity)[exposure.mask.mask == 1])))
+        return True
+
+    def fuse(self, exposure, kernel, force=False):
+        if self.thickness:
+            kernel.div(exposure['Thickness'], exposure['ThicknessError'])
+            exposure.header.add_history('Divided by thickness')
         return True
 
 
 class Saving(DataReductionStep):
+    changes_data = False
     save2dcorr = GObject.property(
         type=bool, default=True, blurb='Save corrected 2d images')
     save1d = GObject.property(
-        type=bool, default=True, blurb='Save radial averages (I(q) curves)')
+        type=bool, default=False, blurb='Export radial averages (I(q) curves) to text files')
+    save1dstore = GObject.property(
+        type=bool, default=True, blurb='Save radial averages (I(q) curves) to the curve store')
     pixels_per_qbin = GObject.property(
         type=float, minimum=0, default=1, blurb='Number of pixels in a q-bin')
 
-    def execute(self, exposure, force=False):
+    def execute(self, exposure, force=False, radial=None):
+        """`radial` is the radial average of the exposure, if it has already
+        been made (by a worker process of ParallelReduction)."""
         if self.save2dcorr:
             self.chain.filessubsystem.writereduced(exposure)
             self.message(exposure, 'Saved corrected 2D image.')
-        if self.save1d:
+        if self.save1d or self.save1dstore:
             self.chain.filessubsystem.writeradial(
-                exposure, self.pixels_per_qbin)
+                exposure, self.pixels_per_qbin, self.save1d, self.save1dstore,
+                self.chain.parent.filebegin, radial)
             self.message(exposure, 'Saved radial averaged curve (pixels per q bin: %.2f).' %
                          self.pixels_per_qbin)
         return True
@@ -351,6 +492,7 @@ class ReductionThread(GObject.GObject):
         'message': (GObject.SignalFlags.RUN_FIRST, None, (long, str)),
         'done': (GObject.SignalFlags.RUN_FIRST, None, (long, object,)),
         'idle': (GObject.SignalFlags.RUN_FIRST, None, ()),
+        'profile': (GObject.SignalFlags.RUN_FIRST, None, (long, object,)),
         'endthread': (GObject.SignalFlags.RUN_FIRST, None, ())}
 
     def __init__(self, parent):
@@ -375,15 +517,16 @@ class ReductionThread(GObject.GObject):
                 fsn, force = self.inqueue.get()
             if isinstance(fsn, str) and fsn == 'KILL!':
                 break
+            profiler = ReductionProfiler()
             try:
-                exposure = self.parent.load_exposure(fsn)
+                exposure = profiler.measure('Loading', self.parent.load_exposure, fsn)
                 try:
                     if exposure.header['ErrorFlags']:
                         raise ExposureFlaggedException
                 except KeyError:
                     # 'ErrorFlags' key not in header: this exposure has not been flagged
                     pass
-                exposure = self.execute(exposure, force, None)
+                exposure = self.execute(exposure, force, None, profiler)
             except ExposureFlaggedException:
                 self._threadsafe_emit('message', exposure[
                                       'FSN'], 'Not running data reduction: this exposure is flagged as erroneous.')
@@ -391,20 +534,23 @@ class ReductionThread(GObject.GObject):
                 logger.error(
                     'Error while reducing FSN #%d: ' % fsn + str(traceback.format_exc()))
             self._threadsafe_emit('done', exposure['FSN'], exposure.header)
+            self._threadsafe_emit('profile', fsn, profiler.stats())
         self._threadsafe_emit('endthread')
 
     def _threadsafe_emit(self, signalname, *args):
         GLib.idle_add(lambda sn, arglist: bool(
             self.emit(sn, *arglist)) and False, signalname, args)
 
-    def execute(self, exposure, force=False, endstepclassname=None):
+    def execute(self, exposure, force=False, endstepclassname=None, profiler=None):
         logger.debug('Starting execution of %s. Force: %d. Endstepclassname: %s' %
                      (str(exposure.header), force, str(endstepclassname)))
+        steps = []
         for c in self.chain:
-            if not c.execute(exposure, force):
-                break
+            steps.append(c)
             if c.__class__.__name__ == endstepclassname:
                 break
+        run_steps(steps, exposure, force, self.parent.fused, profiler,
+                  wants_diagnostics(exposure, self.parent.diagnostics))
         logger.debug('Done execution of %s.' % str(exposure.header))
         return exposure
 
@@ -429,18 +575,380 @@ class ReductionThread(GObject.GObject):
         self.inqueue.put_nowait((fsn, force))
 
 
+# the state of a worker process of ParallelReduction: the chain rebuilt
+# from the settings of the last job (see _configure_worker()), the reduced
+# backgrounds, and the queue where the start of each job is announced.
+_worker_settings = None
+_worker_chain = None
+_worker_backgrounds = collections.OrderedDict()
+_worker_started = None
+
+
+def _steps_before_saving(chain):
+    steps = []
+    for step in chain:
+        if isinstance(step, Saving):
+            break
+        steps.append(step)
+    return steps
+
+
+def _load_exposure(loadargs):
+    return sastool.SASExposure(loadargs[0], dirs=loadargs[1])
+
+
+def _find_step(chain, cls):
+    for step in chain:
+        if isinstance(step, cls):
+            return step
+    return None
+
+
+def chain_settings(chain, filessubsystem, fused=False, diagnostics=0):
+    """The settings of the reduction `chain` needed to rebuild it in the
+    worker processes of ParallelReduction: the classes and the properties of
+    the steps up to Saving, and what else the worker needs."""
+    saving = _find_step(chain, Saving)
+    pixels_per_qbin = None
+    if (saving is not None) and (saving.save1d or saving.save1dstore):
+        pixels_per_qbin = saving.pixels_per_qbin
+    return {'steps': [(step.__class__, dict((p.name, step.get_property(p.name)) for p in step.props))
+                      for step in _steps_before_saving(chain)],
+            'eval2dpath': filessubsystem.eval2dpath,
+            'fused': fused, 'diagnostics': diagnostics,
+            'pixels_per_qbin': pixels_per_qbin}
+
+
+class _WorkerFiles(object):
+    # what the steps use of the Files subsystem, in the worker processes.
+
+    def __init__(self, eval2dpath):
+        self.eval2dpath = eval2dpath
+
+
+class _WorkerChain(list):
+    # the steps of a reduction chain rebuilt from chain_settings().
+
+    def __init__(self, settings):
+        list.__init__(self)
+        self.filessubsystem = _WorkerFiles(settings['eval2dpath'])
+        for cls, properties in settings['steps']:
+            step = cls(self)
+            for name, value in properties.iteritems():
+                step.set_property(name, value)
+            self.append(step)
+
+
+def _init_worker(started):
+    # the pool is forked from a process where other threads may have held
+    # the locks of the logging module at that moment.
+    global _worker_started
+    logging._lock = threading.RLock()
+    for lgr in [logging.root] + logging.Logger.manager.loggerDict.values():
+        for handler in getattr(lgr, 'handlers', []):
+            handler.createLock()
+    _worker_started = started
+
+
+def _configure_worker(settings):
+    global _worker_settings, _worker_chain
+    if settings != _worker_settings:
+        _worker_chain = _WorkerChain(settings)
+        _worker_settings = settings
+        _worker_backgrounds.clear()
+
+
+def _worker_background(background, force, profiler):
+    # the background exposure is reduced in each worker where it is needed,
+    # exactly as the serial chain does it: up to the background subtraction
+    # step, where it is stored.
+    if background is None:
+        return None
+    fsn, loadargs = background
+    if fsn not in _worker_backgrounds:
+        exposure = profiler.measure('Loading', _load_exposure, loadargs)
+        run_steps(_steps_before_saving(_worker_chain), exposure, force, _worker_settings['fused'],
+                  profiler, wants_diagnostics(exposure, _worker_settings['diagnostics']))
+        _worker_backgrounds[fsn] = exposure
+        while len(_worker_backgrounds) > 4:
+            _worker_backgrounds.popitem(last=False)
+    return _worker_backgrounds[fsn]
+
+
+def _reduce_in_worker(job):
+    """Reduce an exposure in a worker process of ParallelReduction, with the
+    steps of the chain up to Saving, and make its radial average if it is to
+    be saved. Returns (fsn, header, exposure, radial average, error,
+    profile): exposure is None if the exposure is not to be saved, the
+    radial average is None if not needed, error is the formatted traceback
+    or None, profile is the result of a ReductionProfiler."""
+    batch, settings, fsn, loadargs, background, reference, force = job
+    _worker_started.put((os.getpid(), batch, fsn))
+    header = None
+    profiler = ReductionProfiler()
+    try:
+        _configure_worker(settings)
+        exposure = profiler.measure('Loading', _load_exposure, loadargs)
+        header = exposure.header
+        bgstep = _find_step(_worker_chain, BackgroundSubtraction)
+        if bgstep is not None:
+            bgstep._lastemptybeamexposure = _worker_background(background, force, profiler)
+        abstep = _find_step(_worker_chain, AbsoluteCalibration)
+        if abstep is not None:
+            abstep._lastgcexposure = reference
+        if run_steps(_worker_chain, exposure, force, settings['fused'], profiler,
+                     wants_diagnostics(exposure, settings['diagnostics'])):
+            radial = None
+            if settings['pixels_per_qbin'] is not None:
+                radial = profiler.measure('Radial average', radial_average, exposure, None,
+                                          settings['pixels_per_qbin'])
+            return fsn, header, exposure, radial, None, profiler.stats()
+        elif (bgstep is not None) and (bgstep._lastemptybeamexposure is exposure):
+            # a background: send it back, it is kept after the batch.
+            return fsn, header, exposure, None, None, profiler.stats()
+        return fsn, header, None, None, None, profiler.stats()
+    except Exception:
+        return fsn, header, None, None, traceback.format_exc(), profiler.stats()
+
+
+class ParallelReduction(GObject.GObject):
+
+    """Reduce a batch of exposures in the pool of worker processes of the
+    data reduction subsystem (see SubSystemDataReduction.reduction_pool()).
+
+    The exposures are planned in the order given, as the serial reduction
+    chain would see them: each background measurement (the title of the
+    background subtraction step) is used for the subsequent exposures, the
+    same holds for the intensity references (the title of the absolute
+    calibration step), which are themselves background-subtracted. The
+    exposures independent of each other are reduced in parallel. An
+    exposure after an intensity reference is submitted when the reference
+    is done, with its normalization factor. The results are identical to
+    those of the serial chain.
+
+    The workers rebuild the chain from its settings (see chain_settings())
+    and make the radial averages. Only the writing of the Saving step is
+    done in the calling process, as the results arrive. At most two jobs
+    per worker are submitted at a time. A job whose worker process dies is
+    reported as failed. The signals are the same as those of
+    ReductionThread, emitted from the main loop.
+    """
+    __gtype_name__ = 'SAXSCtrl_ParallelReduction'
+    __gsignals__ = {
+        'message': (GObject.SignalFlags.RUN_FIRST, None, (long, str)),
+        'done': (GObject.SignalFlags.RUN_FIRST, None, (long, object,)),
+        'idle': (GObject.SignalFlags.RUN_FIRST, None, ()),
+        'profile': (GObject.SignalFlags.RUN_FIRST, None, (long, object,)),
+        'endthread': (GObject.SignalFlags.RUN_FIRST, None, ())}
+    _batches = itertools.count()
+
+    def __init__(self, parent, chain, fsns, force=False, nworkers=None, fused=False, diagnostics=0):
+        GObject.GObject.__init__(self)
+        self.parent = parent
+        self.chain = chain
+        self.fused = fused
+        self.diagnostics = diagnostics
+        self.fsns = list(fsns)
+        self.force = force
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        self.nworkers = nworkers
+        self._batch = next(self._batches)
+        self._pool = None
+        self._started = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def is_running(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def start(self):
+        """Get the worker processes and start scheduling. Call this from
+        the main thread."""
+        self._settings = chain_settings(
+            self.chain, self.parent.credo().subsystems['Files'], self.fused, self.diagnostics)
+        self._pool, self._started = self.parent.reduction_pool(self.nworkers)
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _threadsafe_emit(self, signalname, *args):
+        GLib.idle_add(lambda sn, arglist: bool(
+            self.emit(sn, *arglist)) and False, signalname, args)
+
+    def plan(self):
+        """Work out the dependencies of the exposures. Returns a list of
+        (fsn, header, kind, background FSN, reference FSN), where kind is
+        'missing', 'flagged', 'background', 'reference' or 'sample', and the
+        FSNs of the background and the reference are None if not in this
+        batch."""
+        bgstep = _find_step(self.chain, BackgroundSubtraction)
+        abstep = _find_step(self.chain, AbsoluteCalibration)
+        bgtitle = [None, bgstep.title][bgstep.enable]
+        reftitle = [None, abstep.title][abstep.enable]
+        lastbg = lastref = None
+        plan = []
+        for fsn in self.fsns:
+            try:
+                header = self.parent.load_header(fsn)
+            except IOError:
+                logger.error('Error while reducing FSN #%d: ' % fsn + traceback.format_exc())
+                plan.append((fsn, None, 'missing', None, None))
+                continue
+            if header.get('ErrorFlags', None):
+                plan.append((fsn, header, 'flagged', None, None))
+            elif header['Title'] == bgtitle:
+                plan.append((fsn, header, 'background', None, None))
+                lastbg = fsn
+            elif header['Title'] == reftitle:
+                plan.append((fsn, header, 'reference', lastbg, None))
+                lastref = fsn
+            else:
+                plan.append((fsn, header, 'sample', lastbg, lastref))
+        return plan
+
+    def _lost_jobs(self, running):
+        # the FSNs of the jobs whose worker process died. The pool removes
+        # the dead workers from its list and forks new ones.
+        alive = set(p.pid for p in self._pool._pool)
+        lost = [fsn for pid, fsn in running.iteritems() if pid not in alive]
+        for pid in [pid for pid in running if pid not in alive]:
+            del running[pid]
+        return lost
+
+    def run(self):
+        bgstep = _find_step(self.chain, BackgroundSubtraction)
+        abstep = _find_step(self.chain, AbsoluteCalibration)
+        saving = _find_step(self.chain, Saving)
+        results = Queue.Queue()
+        try:
+            plan = self.plan()
+            headers = dict((fsn, header) for fsn, header, kind, bg, ref in plan)
+            kinds = dict((fsn, kind) for fsn, header, kind, bg, ref in plan)
+            loadargs = dict((fsn, self.parent.exposure_loadargs(fsn))
+                            for fsn, header, kind, bg, ref in plan if kind not in ['missing', 'flagged'])
+            # the last background and reference are kept for the serial chain
+            lastbg = ([None] + [fsn for fsn, header, kind, bg, ref in plan if kind == 'background'])[-1]
+            lastref = ([None] + [fsn for fsn, header, kind, bg, ref in plan if kind == 'reference'])[-1]
+            # the background known by the serial chain is reduced again by
+            # the workers needing it.
+            initialbg = bgstep._lastemptybeamexposure
+            if initialbg is not None:
+                initialbg = (initialbg['FSN'], self.parent.exposure_loadargs(initialbg['FSN']))
+            initialref = abstep._lastgcexposure
+            if initialref is not None:
+                initialref = initialref.header
+            ready = collections.deque()
+            waiting = {}
+            pending = 0
+            for fsn, header, kind, bg, ref in plan:
+                if kind == 'missing':
+                    self._threadsafe_emit('done', fsn, header)
+                    continue
+                elif kind == 'flagged':
+                    self._threadsafe_emit(
+                        'message', fsn, 'Not running data reduction: this exposure is flagged as erroneous.')
+                    self._threadsafe_emit('done', fsn, header)
+                    continue
+                job = [self._batch, self._settings, fsn, loadargs[fsn], initialbg, initialref, self.force]
+                if bg is not None:
+                    job[4] = (bg, loadargs[bg])
+                if ref is not None:
+                    waiting.setdefault(ref, []).append(job)
+                else:
+                    ready.append(job)
+                pending += 1
+            submitted = set()
+            running = {}
+            while pending and not self._stopped.is_set():
+                while ready and len(submitted) < 2 * self.nworkers:
+                    job = ready.popleft()
+                    submitted.add(job[2])
+                    self._pool.apply_async(_reduce_in_worker, (tuple(job),), callback=results.put)
+                while not self._started.empty():
+                    pid, batch, fsn = self._started.get()
+                    if batch == self._batch and fsn in submitted:
+                        running[pid] = fsn
+                try:
+                    fsn, header, exposure, radial, error, profile = results.get(timeout=0.5)
+                except Queue.Empty:
+                    for fsn in self._lost_jobs(running):
+                        results.put((fsn, None, None, None,
+                                     'The worker process reducing it has died.', []))
+                    continue
+                if fsn not in submitted:
+                    # already reported as lost
+                    continue
+                submitted.discard(fsn)
+                for pid in [pid for pid in running if running[pid] == fsn]:
+                    del running[pid]
+                pending -= 1
+                if header is None:
+                    header = headers[fsn]
+                if error is not None:
+                    logger.error('Error while reducing FSN #%d: ' % fsn + error)
+                for job in waiting.pop(fsn, []):
+                    if error is not None:
+                        logger.error('Not reducing FSN #%d: the reduction of its intensity '
+                                     'reference (FSN #%d) failed.' % (job[2], fsn))
+                        self._threadsafe_emit('done', job[2], headers[job[2]])
+                        pending -= 1
+                        continue
+                    job[5] = header
+                    ready.append(job)
+                if (exposure is not None) and (kinds[fsn] == 'background'):
+                    if fsn == lastbg:
+                        bgstep._lastemptybeamexposure = exposure
+                elif exposure is not None:
+                    profiler = ReductionProfiler()
+                    profiler.merge(profile)
+                    try:
+                        profiler.measure('Saving', saving.execute, exposure, self.force, radial)
+                    except Exception:
+                        logger.error('Error while saving FSN #%d: ' % fsn + traceback.format_exc())
+                    if fsn == lastref:
+                        abstep._lastgcexposure = exposure
+                    profile = profiler.stats()
+                self._threadsafe_emit('done', fsn, header)
+                self._threadsafe_emit('profile', fsn, profile)
+        except Exception:
+            logger.error('Error in the parallel data reduction: ' + traceback.format_exc())
+        finally:
+            # the pool is kept: the jobs still queued there when stopped are
+            # finished by the workers, their results are discarded.
+            self._pool = None
+            self._threadsafe_emit('idle')
+            self._threadsafe_emit('endthread')
+
+    def stop(self):
+        """Abandon the exposures not yet reduced."""
+        self._stopped.set()
+
+
 class SubSystemDataReduction(SubSystem):
     __gsignals__ = {
         'message': (GObject.SignalFlags.RUN_FIRST, None, (long, str)),
         'done': (GObject.SignalFlags.RUN_FIRST, None, (long, object)),
         'idle': (GObject.SignalFlags.RUN_FIRST, None, ()),
+        'profile': (GObject.SignalFlags.RUN_FIRST, None, (long, object)),
         'notify': 'override'}
     filebegin = GObject.property(
         type=str, nick='IO::File_begin', blurb='Filename prefix', default='crd')
     ndigits = GObject.property(
         type=int, nick='IO::Number_digits', blurb='Number of digits in FSN', default=5, minimum=1)
+    nworkers = GObject.property(
+        type=int, nick='Parallel::Workers', blurb='Number of processes for batch reduction',
+        default=multiprocessing.cpu_count(), minimum=1)
+    fused = GObject.property(
+        type=bool, nick='Reduction::Fused', blurb='Apply the corrections of the steps in one pass',
+        default=True)
+    diagnostics = GObject.property(
+        type=int, nick='Reduction::Diagnostics',
+        blurb='Add diagnostic statistics to the history of every N-th exposure (0: never)',
+        default=0, minimum=0)
     __propvalues__ = None
     _reduction_thread = None
+    _batch = None
 
     def __init__(self, credo, offline=True):
         SubSystem.__init__(self, credo, offline)
@@ -453,7 +961,19 @@ class SubSystemDataReduction(SubSystem):
             objwithgui.OWG_Hint_Type.OrderPriority: 0}
         self._OWG_hints['ndigits'] = {
             objwithgui.OWG_Hint_Type.OrderPriority: 1}
+        self._OWG_hints['nworkers'] = {
+            objwithgui.OWG_Hint_Type.OrderPriority: 2}
+        self._OWG_hints['fused'] = {
+            objwithgui.OWG_Hint_Type.OrderPriority: 3}
+        self._OWG_hints['diagnostics'] = {
+            objwithgui.OWG_Hint_Type.OrderPriority: 4}
+        self.profiler = ReductionProfiler()
+        self._pool = None
+        self._poolsize = None
         self._restart_reductionthread()
+        # the pool of the batch reductions is forked once, as early as
+        # possible (see reduction_pool()).
+        self.reduction_pool(self.nworkers)
 
     def __del__(self):
         try:
@@ -475,7 +995,8 @@ class SubSystemDataReduction(SubSystem):
             self._reduction_thread.connect('endthread', self._on_endthread),
             self._reduction_thread.connect('idle', self._on_idle),
             self._reduction_thread.connect('message', self._on_message),
-            self._reduction_thread.connect('done', self._on_done)]
+            self._reduction_thread.connect('done', self._on_done),
+            self._reduction_thread.connect('profile', self._on_profile)]
         self._OWG_parts = self._reduction_thread.chain
         self.add_step(PreScaling)
         self.add_step(BackgroundSubtraction)
@@ -485,13 +1006,32 @@ class SubSystemDataReduction(SubSystem):
         self.add_step(Saving)
         self.loadstate(self.credo().getstatefile())
 
-    def load_exposure(self, fsn):
+    def exposure_loadargs(self, fsn):
+        """The file name and the directories to load the exposure `fsn` from
+        with sastool.SASExposure()."""
         ssf = self.credo().subsystems['Files']
-        return sastool.SASExposure(ssf.get_exposureformat(self.filebegin, self.ndigits) % fsn, dirs=ssf.rawloadpath)
+        dirs = ssf.rawloadpath
+        if ssf.locate(self.filebegin, fsn, 'cbf', dirs) is None:
+            # the exposure may have been packed into an archive
+            for f in ssf.extract_archived(self.filebegin, fsn, ['param_override', 'param', 'images']):
+                if os.path.dirname(f) not in dirs:
+                    dirs.append(os.path.dirname(f))
+        return ssf.get_exposureformat(self.filebegin, self.ndigits) % fsn, dirs
+
+    def load_exposure(self, fsn):
+        filename, dirs = self.exposure_loadargs(fsn)
+        return sastool.SASExposure(filename, dirs=dirs)
 
     def load_header(self, fsn):
         ssf = self.credo().subsystems['Files']
-        return sastool.SASHeader(ssf.get_headerformat(self.filebegin, self.ndigits) % fsn, dirs=ssf.rawloadpath)
+        path = ssf.locate(self.filebegin, fsn, 'param', ssf.rawloadpath)
+        if path is None:
+            archived = ssf.extract_archived(
+                self.filebegin, fsn, ['param_override', 'param'])
+            if not archived:
+                raise IOError('Cannot find header file for FSN #%d' % fsn)
+            path = archived[0]
+        return sastool.SASHeader(path)
 
     def add_step(self, step):
         self._reduction_thread.add_step(step)
@@ -501,6 +1041,60 @@ class SubSystemDataReduction(SubSystem):
             self._restart_reductionthread()
         self._reduction_thread.reduce(fsn, force)
 
+    def reduction_pool(self, nworkers):
+        """The pool of `nworkers` worker processes of ParallelReduction and
+        the queue where the workers announce the start of their jobs. The
+        pool is kept for the subsequent batches, it is only forked again if
+        the number of workers changes."""
+        if self._poolsize != nworkers:
+            self._close_pool()
+            # written without a feeder thread, which would die with the
+            # worker before sending.
+            self._started = multiprocessing.queues.SimpleQueue()
+            self._pool = multiprocessing.Pool(nworkers, _init_worker, (self._started,))
+            self._poolsize = nworkers
+        return self._pool, self._started
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._poolsize = None
+
+    def destroy(self):
+        if self._batch is not None:
+            self._batch.stop()
+        self._close_pool()
+
+    def reduce_batch(self, fsns, force=False, nworkers=None):
+        """Reduce the exposures `fsns` in parallel, in `nworkers` processes
+        (default: the 'nworkers' property). See ParallelReduction. The
+        'message' and 'done' signals are emitted as with reduce(), 'idle' when
+        the whole batch is done."""
+        if self._batch is not None:
+            raise DataReductionError('A batch reduction is already running.')
+        if self._reduction_thread is None:
+            self._restart_reductionthread()
+        if nworkers is None:
+            nworkers = self.nworkers
+        self._batch = ParallelReduction(self, self._reduction_thread.chain, fsns, force, nworkers,
+                                        self.fused, self.diagnostics)
+        self._batch_connections = [
+            self._batch.connect('endthread', self._on_batch_end),
+            self._batch.connect('idle', self._on_idle),
+            self._batch.connect('message', self._on_message),
+            self._batch.connect('done', self._on_done),
+            self._batch.connect('profile', self._on_profile)]
+        self._batch.start()
+
+    def _on_batch_end(self, batch):
+        for c in self._batch_connections:
+            batch.disconnect(c)
+        self._batch_connections = []
+        self._batch = None
+        logger.info('Data reduction profile:\n' + self.profiler.summary())
+
     def _on_endthread(self, thread):
         for c in self._thread_connections:
             self._reduction_thread.disconnect(c)
@@ -517,9 +1111,23 @@ class SubSystemDataReduction(SubSystem):
     def _on_done(self, thread, fsn, exposure):
         self.emit('done', fsn, exposure)
 
+    def _on_profile(self, thread, fsn, stats):
+        self.profiler.merge(stats)
+        self.emit('profile', fsn, stats)
+
+    def profile_summary(self):
+        """The time and the allocations of the parts of the data reduction
+        since the last reset_profile(), as a text table."""
+        return self.profiler.summary()
+
+    def reset_profile(self):
+        self.profiler.reset()
+
     def __del__(self):
         if self._reduction_thread is not None:
             self._reduction_thread.kill()
 
     def stop(self):
         self._reduction_thread.stop()
+        if self._batch is not None:
+            self._batch.stop()
@@ -1,6 +1,7 @@
 import logging
 import os
 import ConfigParser
+import threading
 import traceback
 from .subsystem import SubSystem, SubSystemError
 from ..instruments.pilatus import Pilatus
@@ -37,11 +38,15 @@ class SubSystemEquipments(SubSystem):
                       'haakephoenix': HaakePhoenix,
                       }
     _motor_drivers = ['tmcm351_a', 'tmcm6110', 'tmcm351_b']
+    snapshot_interval = GObject.property(
+        type=float, minimum=0.05, default=0.5, blurb='Refresh interval of the instrument state snapshot (sec)')
 
     def __init__(self, credo, offline=True):
         SubSystem.__init__(self, credo, offline)
         if not self.configfile:
             self.configfile = 'equipments.conf'
+        self._snapshot_thread = None
+        self._snapshot_stop = threading.Event()
         self._list = dict([(n, self.__equipments__[n](
             name=n, offline=self.offline)) for n in self.__equipments__])
         self._equipment_connections = {}
@@ -134,6 +139,7 @@ class SubSystemEquipments(SubSystem):
         except IndexError:
             raise NotImplementedError('Invalid equipment.')
         self.emit('equipment-connection', equipment, True, equipmentinstance)
+        self._start_snapshot_thread()
         return False
 
     def _equipment_disconnect(self, equipmentinstance, status):
@@ -162,6 +168,7 @@ class SubSystemEquipments(SubSystem):
                 self.disconnect_equipment(eq)
 
     def destroy(self):
+        self._stop_snapshot_thread()
         self.disconnect_from_all()
 
     def get_current_parameters(self):
@@ -171,6 +178,59 @@ class SubSystemEquipments(SubSystem):
                 dic.update(eq.get_current_parameters())
         return dic
 
+    def get_snapshot(self):
+        """Return the current parameters of all connected equipments, as
+        known from the state snapshot, without communicating with them. The
+        parameters of the equipments which keep them cached (e.g. the motor
+        positions) are taken directly. The second return value is the list
+        of the stale fields (for equipments without a snapshot yet, their
+        name)."""
+        dic = {}
+        stale = []
+        for name, eq in self._list.iteritems():
+            if not eq.connected():
+                continue
+            if eq._current_parameters_cached:
+                dic.update(eq.get_current_parameters())
+                continue
+            if eq.snapshot.updated is None:
+                stale.append(name)
+                continue
+            values, stalefields = eq.snapshot.get()
+            dic.update(values)
+            stale.extend(stalefields)
+        return dic, stale
+
+    def _start_snapshot_thread(self):
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        self._snapshot_stop.clear()
+        self._snapshot_thread = threading.Thread(
+            target=self._snapshot_worker, args=(self._snapshot_stop,))
+        self._snapshot_thread.daemon = True
+        self._snapshot_thread.start()
+
+    def _stop_snapshot_thread(self):
+        if self._snapshot_thread is not None:
+            self._snapshot_stop.set()
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+
+    def _snapshot_worker(self, stopswitch):
+        # refresh the fields which would become stale before the next round,
+        # so that the snapshot is always usable for exposure headers.
+        while not stopswitch.wait(self.snapshot_interval):
+            for eq in self._list.values():
+                if stopswitch.is_set():
+                    break
+                if not eq.connected():
+                    continue
+                try:
+                    eq.refresh_snapshot(2 * self.snapshot_interval)
+                except Exception:
+                    logger.warning('Error while refreshing the state snapshot of equipment %s: %s' % (
+                        eq._get_classname(), traceback.format_exc()))
+
     def savestate(self, configparser, sectionprefix=''):
         if self.offline:
             logger.warning('Not saving equipments state: we are off-line')
@@ -1,16 +1,21 @@
 # coding: utf-8
 import multiprocessing
 import multiprocessing.queues
+import multiprocessing.sharedctypes
 import sastool
 import datetime
-import dateutil.tz
-import dateutil.parser
 from ..instruments.pilatus import PilatusError
+from ..io.filewatcher import FileArrivalWatcher
+from ..io.framebuffer import FrameRingBuffer
+from ..io.cbf import CBFReader, CBFError
+from ..io.sharding import shard_path
+from ..io.nexuswriter import NeXusWriter
+from ..io.asyncwriter import write_atomic
 import logging
 import os
 import time
+import threading
 from ...utils import objwithgui
-import h5py
 import numpy as np
 import scipy
 import traceback
@@ -37,21 +42,164 @@ class ExposureMessageType(object):
     End = 'end'
     Failure = 'failure'
     Image = 'image'
+    Timing = 'timing'
+
+
+class ExposureWorkerPool(object):
+
+    """A pool of long-lived processes collecting the images of exposure series.
+
+    The worker processes are started once and receive small job descriptors
+    through their job queues: the parameters common to a series (file name
+    formats, header template etc.) are broadcast to all workers when the
+    series starts, then the frames are dealt out round-robin as (series, FSN,
+    expected arrival time, wait time, frame buffer slot) tuples. The mask
+    matrix is passed through shared memory.
+
+    Each frame is handled by calling `processor(fsn, arrival, waittime, slot,
+    info, maskmatrix, stopswitch)` in the worker, which returns a dict of
+    timings and the frame buffer slot holding the frame (None if the frame is
+    not in the buffer). Messages to the main process are put into `outqueue`
+    as (series, message type, data) tuples.
+    """
+
+    def __init__(self, processor, outqueue, nworkers=2, masksize=619 * 487):
+        self._processor = processor
+        self.outqueue = outqueue
+        self.nworkers = nworkers
+        self.stopswitch = multiprocessing.Event()
+        self._cancelled = multiprocessing.Value('l', -1)
+        # orders new_series() and cancel(): a stop must not be cleared by a
+        # series starting at the same time.
+        self._serieslock = threading.Lock()
+        self._mask = multiprocessing.sharedctypes.RawArray('B', masksize)
+        self._jobqueues = []
+        self._workers = []
+        self._series = 0
+        self._nextworker = 0
+
+    def is_running(self):
+        return bool(self._workers) and all(w.is_alive() for w in self._workers)
+
+    def start(self):
+        if self.is_running():
+            return
+        self.shutdown()
+        self._jobqueues = [multiprocessing.queues.SimpleQueue()
+                           for i in range(self.nworkers)]
+        for q in self._jobqueues:
+            self._workers.append(
+                multiprocessing.Process(target=self._worker, args=(q,)))
+            self._workers[-1].daemon = True
+            self._workers[-1].start()
+        self._nextworker = 0
+        logger.debug('Started %d exposure worker processes.' %
+                     len(self._workers))
+
+    def shutdown(self):
+        if not self._workers:
+            return
+        self.cancel()
+        for q in self._jobqueues:
+            q.put(None)
+        for w in self._workers:
+            w.join()
+        self._workers = []
+        self._jobqueues = []
+
+    def new_series(self, info, maskmatrix=None):
+        """Start a new series: `info` is a dict of the parameters common to
+        all frames. Returns the series identifier."""
+        if maskmatrix is not None and maskmatrix.size > len(self._mask):
+            # the shared array has to exist before the workers are forked.
+            self.shutdown()
+            self._mask = multiprocessing.sharedctypes.RawArray(
+                'B', maskmatrix.size)
+        self.start()
+        info = info.copy()
+        if maskmatrix is not None:
+            np.frombuffer(self._mask, dtype=np.uint8)[
+                :maskmatrix.size] = maskmatrix.flatten()
+            info['maskshape'] = maskmatrix.shape
+        else:
+            info['maskshape'] = None
+        with self._serieslock:
+            self._series += 1
+            self.stopswitch.clear()
+            for q in self._jobqueues:
+                q.put(('series', self._series, info))
+            return self._series
+
+    def submit(self, fsn, arrival, waittime, slot=None):
+        with self._serieslock:
+            series = self._series
+        self._jobqueues[self._nextworker].put(
+            ('frame', series, fsn, arrival, waittime, slot))
+        self._nextworker = (self._nextworker + 1) % len(self._jobqueues)
+
+    def cancel(self):
+        """Abandon the frames of the current series. Each worker acknowledges
+        with an End message."""
+        with self._serieslock:
+            self._cancelled.value = self._series
+            self.stopswitch.set()
+            for q in self._jobqueues:
+                q.put(('cancel', self._series))
+
+    def _worker(self, jobqueue):
+        info = maskmatrix = None
+        while True:
+            job = jobqueue.get()
+            if job is None:
+                break
+            kind, series = job[:2]
+            if kind == 'series':
+                info = job[2]
+                if info['maskshape'] is not None:
+                    maskmatrix = np.frombuffer(self._mask, dtype=np.uint8)[
+                        :np.prod(info['maskshape'])].reshape(info['maskshape']).copy()
+                else:
+                    maskmatrix = None
+            elif kind == 'cancel':
+                self.outqueue.put((series, ExposureMessageType.End, False))
+            elif series > self._cancelled.value:
+                fsn, arrival, waittime, slot = job[2:]
+                try:
+                    timings, slot = self._processor(
+                        fsn, arrival, waittime, slot, info, maskmatrix, self.stopswitch)
+                except StopSwitchException:
+                    self.outqueue.put((series, ExposureMessageType.End, False))
+                except Exception:
+                    logger.error('Error while processing FSN #%d: %s' %
+                                 (fsn, traceback.format_exc()))
+                    self.outqueue.put(
+                        (series, ExposureMessageType.Failure, traceback.format_exc()))
+                    self.outqueue.put((series, ExposureMessageType.End, False))
+                else:
+                    self.outqueue.put(
+                        (series, ExposureMessageType.Timing, (fsn, timings)))
+                    self.outqueue.put(
+                        (series, ExposureMessageType.Image, (fsn, slot)))
 
 
 class SubSystemExposure(SubSystem):
     __gsignals__ = {'exposure-image': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
                     'exposure-fail': (GObject.SignalFlags.RUN_FIRST, None, (str,)),
                     'exposure-end': (GObject.SignalFlags.RUN_FIRST, None, (bool,)),
+                    # emitted with the FSN and a dict of stage name -> (start
+                    # time, end time) pairs, for profiling.
+                    'exposure-timing': (GObject.SignalFlags.RUN_FIRST, None, (int, object)),
                     'notify': 'override', }
     exptime = GObject.property(
         type=float, minimum=0, default=1, blurb='Exposure time (sec)')
     dwelltime = GObject.property(
         type=float, minimum=0.003, default=0.003, blurb='Dwell time between exposures (sec)')
     nimages = GObject.property(
-        type=int, minimum=1, default=1, blurb='Number of images to take (sec)', maximum=20)
+        type=int, minimum=1, default=1, blurb='Number of images to take (sec)')
     operate_shutter = GObject.property(
         type=bool, default=True, blurb='Open/close shutter')
+    nworkers = GObject.property(
+        type=int, minimum=1, default=2, blurb='Number of image collector processes')
     cbf_file_timeout = GObject.property(
         type=float, default=3, blurb='Timeout for cbf files')
     timecriticalmode = GObject.property(
@@ -67,10 +215,18 @@ class SubSystemExposure(SubSystem):
         self._OWG_hints[
             'default-mask'] = {objwithgui.OWG_Hint_Type.OrderPriority: None}
         self._OWG_entrytypes['default-mask'] = objwithgui.OWG_Param_Type.File
+        self._queue = multiprocessing.queues.Queue()
+        # the frame buffer and the queue of the NeXus writer must exist
+        # before the workers are forked.
+        self._framebuffer = FrameRingBuffer()
+        self._nexuswriter = NeXusWriter()
+        self._nextslot = 0
+        self._pool = ExposureWorkerPool(
+            self._process_frame, self._queue, self.nworkers)
+        self._series = None
+        self._checker = None
         for k in kwargs:
             self.set_property(k, kwargs[k])
-        self._stopswitch = multiprocessing.Event()
-        self._queue = multiprocessing.queues.Queue()
         self._default_mask = None
 
     def do_notify(self, param):
@@ -88,6 +244,11 @@ class SubSystemExposure(SubSystem):
                 else:
                     logger.debug(
                         'Loaded default mask from file: ' + self.default_mask)
+        elif param.name == 'nworkers':
+            if self._pool.nworkers != self.nworkers:
+                # the pool is restarted at the next exposure.
+                self._pool.shutdown()
+                self._pool.nworkers = self.nworkers
         else:
             logger.debug('Other parameter modified: ' + param.name)
 
@@ -101,18 +262,11 @@ class SubSystemExposure(SubSystem):
             logger.warning(
                 'PilatusError while killing exposure: ' + traceback.format_exc())
         if stop_processing_results:
-            self._stopswitch.set()
+            self._pool.cancel()
 
-    def _kill_subprocesses(self):
-        try:
-            self._stopswitch.set()
-            for s in self._subprocesses:
-                s.join()
-                self._subprocesses.remove(s)
-            del self._subprocesses
-        except AttributeError as ae:
-            logger.warning(
-                'AttributeError in _kill_subprocesses: ' + traceback.format_exc())
+    def destroy(self):
+        self._pool.shutdown()
+        self._nexuswriter.shutdown()
 
     def start(self, header_template=None, mask=None, write_nexus=False):
         logger.debug('Exposure subsystem: starting exposure.')
@@ -121,10 +275,14 @@ class SubSystemExposure(SubSystem):
         sample = self.credo().subsystems['Samples'].get()
         if not pilatus.is_idle():
             raise SubSystemExposureError('Detector is busy.')
-        self._kill_subprocesses()
+        if self._series is not None:
+            # abandon the images of the previous series, if any.
+            self._pool.cancel()
         if mask is None:
             mask = self._default_mask
         fsn = self.credo().subsystems['Files'].get_next_fsn()
+        timings = {}
+        t0 = time.time()
         if header_template is None:
             header_template = {}
         else:
@@ -145,8 +303,21 @@ class SubSystemExposure(SubSystem):
         header_template['PixelSize'] = self.credo().pixelsize / 1000.
         header_template['Wavelength'] = self.credo().wavelength
         header_template['Owner'] = self.credo().username
-        header_template['GeniX_HT'] = genix.get_ht()
-        header_template['GeniX_Current'] = genix.get_current()
+        if self.timecriticalmode:
+            # no communication with the instruments: take their parameters
+            # from the state snapshot.
+            parameters, stale = self.credo().subsystems[
+                'Equipments'].get_snapshot()
+            if stale:
+                logger.warning('Stale instrument parameters in the header of FSN %d: %s' % (
+                    fsn, ', '.join(sorted(stale))))
+            header_template['GeniX_HT'] = parameters.get('HT')
+            header_template['GeniX_Current'] = parameters.get('Current')
+        else:
+            parameters = self.credo().subsystems[
+                'Equipments'].get_current_parameters()
+            header_template['GeniX_HT'] = genix.get_ht()
+            header_template['GeniX_Current'] = genix.get_current()
         header_template['MeasTime'] = self.exptime
         header_template['FSN'] = fsn
         header_template['Project'] = self.credo().projectname
@@ -154,75 +325,139 @@ class SubSystemExposure(SubSystem):
         header_template['Monitor'] = header_template['MeasTime']
         header_template['MonitorError'] = 0
         header_template['StartDate'] = datetime.datetime.now()
-        header_template.update(
-            self.credo().subsystems['Equipments'].get_current_parameters())
+        header_template.update(parameters)
         if mask is not None:
             header_template['maskid'] = mask.maskid
+            maskmatrix = mask.mask
+        else:
+            maskmatrix = None
+        timings['header_assembly'] = (t0, time.time())
         logger.debug('Header prepared.')
-        GLib.idle_add(self._check_if_exposure_finished)
         logger.debug('Starting exposure of %s. Files will be named like: %s' % (
             str(sample), self.credo().subsystems['Files'].get_fileformat() % fsn))
-        self._stopswitch.clear()
-        pilatus.prepare_exposure(self.exptime, self.nimages, self.dwelltime)
-        self._subprocesses = []
+        filessubsystem = self.credo().subsystems['Files']
+        self._exposureformat = filessubsystem.get_exposureformat()
+        self._series_mask = mask
+        # camserver writes all images of the series in the directory of the
+        # first one. The shard directories of the headers are created here,
+        # the worker processes only compute the paths.
+        cbfname = filessubsystem.get_writepath(
+            'images', self._exposureformat % fsn)
         for idx in range(self.nimages):
-            if write_nexus:
-                self.credo().subsystems[
-                    'Files'].create_nexus_template(fsn + idx)
+            filessubsystem.get_writepath(
+                'param', filessubsystem.get_headerformat() % (fsn + idx))
+        self._series = self._pool.new_series(
+            {'imagespath': os.path.dirname(cbfname),
+             'parampath': filessubsystem.parampath,
+             'nexuspath': filessubsystem.nexuspath,
+             'shardsize': filessubsystem.shardsize,
+             'exposureformat': self._exposureformat,
+             'headerformat': filessubsystem.get_headerformat(),
+             'nexusformat': filessubsystem.get_nexusformat(),
+             'cbf_file_timeout': self.cbf_file_timeout,
+             'header_template': header_template,
+             'write_nexus': write_nexus}, maskmatrix)
+        self._images_expected = self.nimages
+        self._images_received = 0
+        if self._checker is None:
+            self._checker = GLib.idle_add(self._check_if_exposure_finished)
+        t0 = time.time()
+        pilatus.prepare_exposure(self.exptime, self.nimages, self.dwelltime)
+        timings['detector_prepare'] = (t0, time.time())
+        t0 = time.time()
+        if write_nexus:
+            self._nexuswriter.start()
+            for idx in range(self.nimages):
+                filessubsystem.create_nexus_template(
+                    fsn + idx, writer=self._nexuswriter)
                 logger.debug(
-                    'Created NeXus template file for FSN #%d' % (fsn + idx))
-            self._subprocesses.append(multiprocessing.Process(
-                target=self._thread_worker, args=(
-                    self.credo().subsystems['Files'].imagespath,
-                    self.credo().subsystems['Files'].parampath,
-                    self.credo().subsystems['Files'].nexuspath,
-                    self.credo().subsystems['Files'].filebegin,
-                    self.credo().subsystems['Files'].ndigits,
-                    self._stopswitch, self._queue, self.exptime +
-                    (self.exptime + self.dwelltime) * idx, fsn + idx,
-                    self.cbf_file_timeout, header_template.copy(
-                    ), mask.mask, write_nexus,
-                    idx == self.nimages - 1)))
-            self._subprocesses[-1].daemon = True
+                    'Queued NeXus file for FSN #%d' % (fsn + idx))
+            timings['nexus_template'] = (t0, time.time())
         if ((self.operate_shutter and genix.shutter_state() == False) and
                 (header_template['Title'] != self.dark_sample_name)):
+            t0 = time.time()
             genix.shutter_open()
+            timings['shutter_open'] = (t0, time.time())
         self._pilatus_idle_handler = pilatus.connect(
-            'idle', self._pilatus_idle, genix)
+            'idle', self._pilatus_idle, genix, fsn)
         self.credo().subsystems['Files'].increment_next_fsn()
+        t0 = time.time()
         pilatus.execute_exposure(
-            self.credo().subsystems['Files'].get_exposureformat() % fsn)
-        for s in self._subprocesses:
-            s.start()
+            os.path.relpath(cbfname, filessubsystem.imagespath))
+        timings['detector_start'] = (t0, time.time())
+        for idx in range(self.nimages):
+            waittime = self.exptime + (self.exptime + self.dwelltime) * idx
+            self._pool.submit(
+                fsn + idx, t0 + waittime, waittime, self._nextslot)
+            self._nextslot = (self._nextslot + 1) % self._framebuffer.nslots
+        self.emit('exposure-timing', fsn, timings)
         return fsn
 
-    def _pilatus_idle(self, pilatus, genix):
+    def _pilatus_idle(self, pilatus, genix, fsn):
         # we get this signal when the exposure is finished.
         pilatus.disconnect(self._pilatus_idle_handler)
         del self._pilatus_idle_handler
         if self.operate_shutter:
+            t0 = time.time()
             genix.shutter_close()
+            self.emit('exposure-timing', fsn,
+                      {'shutter_close': (t0, time.time())})
 
     def _check_if_exposure_finished(self):
         try:
-            id, data = self._queue.get_nowait()
+            series, id, data = self._queue.get_nowait()
         except multiprocessing.queues.Empty:
             return True
+        if series != self._series:
+            # left over from an earlier, abandoned series.
+            if id == ExposureMessageType.Image and data[1] is not None:
+                self._framebuffer.release(data[1], data[0])
+            return True
         if id == ExposureMessageType.Failure:
             self.emit('exposure-fail', data)
             return True
         elif id == ExposureMessageType.End:
+            self._series = self._checker = None
             self.emit('exposure-end', data)
             return False
+        elif id == ExposureMessageType.Timing:
+            self.emit('exposure-timing', *data)
+            return True
         elif id == ExposureMessageType.Image:
-            ex = sastool.SASExposure(self.credo().subsystems['Files'].get_exposureformat(
-            ) % data, dirs=self.credo().subsystems['Files'].rawloadpath)
-            self.emit('exposure-image', ex)
+            fsn, slot = data
+            filessubsystem = self.credo().subsystems['Files']
+            if slot is None:
+                ex = sastool.SASExposure(self._exposureformat % fsn,
+                                         dirs=filessubsystem.rawloadpath)
+                filessubsystem.catalog_header(ex.header, self._exposureformat)
+                self.emit('exposure-image', ex)
+            else:
+                try:
+                    ex = self._get_exposure_from_framebuffer(fsn, slot)
+                    filessubsystem.catalog_header(
+                        ex.header, self._exposureformat)
+                    self.emit('exposure-image', ex)
+                finally:
+                    self._framebuffer.release(slot, fsn)
             del ex
-            return True
+            self._images_received += 1
+            if self._images_received < self._images_expected:
+                return True
+            self._series = self._checker = None
+            self.emit('exposure-end', True)
+            return False
         else:
             raise NotImplementedError('Invalid exposure message type')
 
+    def _get_exposure_from_framebuffer(self, fsn, slot):
+        # the exposure refers to the frame buffer, i.e. it is only valid
+        # during the emission of exposure-image. Handlers wishing to keep it
+        # must make a copy.
+        intensity, error, header = self._framebuffer.read(slot, fsn)
+        if self._series_mask is None:
+            return sastool.classes.SASExposure(intensity, error, header)
+        return sastool.classes.SASExposure(intensity, error, header, self._series_mask)
+
     def do_exposure_fail(self, message):
         # this signal is emitted whenever the cbf file collector thread encounters a serious error.
         # In this case the thread is already dead, so we have to kill the
@@ -238,132 +473,103 @@ class SubSystemExposure(SubSystem):
         # this is the last signal emitted during an exposure. The _check_if_exposure_finished() idle handler
         # has already deregistered itself.
         logger.debug('Exposure ended.')
-        self._kill_subprocesses()
 
     def do_exposure_image(self, fsn):
         pass
 
-    def update_nexusfile(self, nexusfile, data, header, waittime):
-        with h5py.File(nexusfile, 'r+') as f:
-            starttime = dateutil.parser.parse(
-                f['entry/monitor/start_time'].value)
-            f['entry/monitor/start_time'][()] = (starttime + datetime.timedelta(
-                waittime - f['entry/monitor/count_time'].value)).isoformat()
-            f['entry/monitor/end_time'] = datetime.datetime.now(
-                dateutil.tz.tzlocal()).isoformat()
-            f['entry/end_time'] = f['entry/monitor/end_time']
-            f['entry/duration'] = (dateutil.parser.parse(f['entry/end_time'].value) -
-                                   dateutil.parser.parse(f['entry/start_time'].value)).total_seconds()
-            f['entry/duration'].attrs['units'] = 's'
-            f['entry/instrument/detector'].create_dataset(
-                'data', data=data, compression='gzip')
-            f['entry/instrument/detector']['data'].attrs['signal'] = 1
-            f['entry/instrument/detector']['data'].attrs[
-                'axes'] = 'x_pixel_offset:y_pixel_offset'
-            f['entry/instrument/detector']['data'].attrs['units'] = 'counts'
-            f['entry/instrument/detector']['data'].attrs['long_name'] = 'Detector counts'
-            f['entry/instrument/detector']['data'].attrs['check_sum'] = data.sum()
-            err = data.copy()
-            idx = err > 0
-            err[idx] = err[idx]**0.5
-            err[-idx] = np.nan
-            f['entry/instrument/detector'].create_dataset(
-                'data_error', data=err, compression='gzip')
-            f['entry/instrument/detector']['data_error'].attrs['units'] = 'counts'
-            f['entry/instrument/detector']['data'].attrs[
-                'long_name'] = 'Standard deviation of detector counts'
-            f['entry/instrument/detector']['data'].attrs[
-                'check_sum'] = np.nansum(err)
-            f['entry/instrument/detector'].create_dataset(
-                'x_pixel_offset', data=np.arange(data.shape[1]))
-            f['entry/instrument/detector/x_pixel_offset'].attrs['primary'] = 1
-            f['entry/instrument/detector/x_pixel_offset'].attrs[
-                'long_name'] = 'Horizontal pixel coordinate (column index)'
-            f['entry/instrument/detector'].create_dataset(
-                'y_pixel_offset', data=np.arange(data.shape[0]))
-            f['entry/instrument/detector/y_pixel_offset'].attrs['primary'] = 1
-            f['entry/instrument/detector/y_pixel_offset'].attrs[
-                'long_name'] = 'Vertical pixel coordinate (row index)'
-            f['entry/data/data'] = f['entry/instrument/detector/data']
-            f['entry/data/errors'] = f['entry/instrument/detector/data_error']
-            f['entry/data/x_pixel_offset'] = f['entry/instrument/detector/x_pixel_offset']
-            f['entry/data/y_pixel_offset'] = f['entry/instrument/detector/y_pixel_offset']
-
-    def _thread_worker(self, imagespath, parampath, nexuspath, filebegin, ndigits, stopswitch, outqueue, waittime, fsn, cbf_file_timeout, header_template, maskmatrix, write_nexus, this_is_the_last=False):
-        """Wait for the availability of scattering image files (especially when doing multiple exposures).
-        If a new file is available, try to load and process it (using _process_exposure), and resume waiting.
-
-        The thread can be stopped in three ways:
-
-        1) by setting stopswitch: this by itself does not stop the exposure procedure in Pilatus.
-        2) if _process_exposure() returns False.
-        3) by an exception
+    def do_exposure_timing(self, fsn, timings):
+        logger.debug('Exposure timing for FSN #%d: ' % fsn + ', '.join(
+            '%s: %.4f sec' % (stage, timings[stage][1] - timings[stage][0]) for stage in sorted(timings)))
 
-        """
-        cbfdata = cbfheader = None
+    def _get_watcher(self, path):
+        # called in the worker processes only: every process needs its own.
+        # Only the one of the current directory is kept: with the sharded
+        # layout, the images directory changes with the FSN bucket.
+        watcher = getattr(self, '_watcher', None)
+        if (watcher is None) or (watcher.path != path):
+            if watcher is not None:
+                watcher.close()
+            watcher = self._watcher = FileArrivalWatcher(path)
+        return watcher
+
+    def _read_cbf(self, filename):
+        # called in the worker processes only. The image is decoded into the
+        # same array for each frame, which remains valid until the next call.
         try:
-            logger.debug(
-                'Exposure subprocess for FSN #%d started, waiting for %.2f seconds' % (fsn, waittime))
-            is_userbreak = stopswitch.wait(waittime)
-            header_template['FSN'] = fsn
-            if is_userbreak:
-                raise StopSwitchException
+            reader = self._cbfreader
+        except AttributeError:
+            reader = self._cbfreader = CBFReader()
+            self._cbfbuffer = np.empty(
+                self._framebuffer.maxpixels, np.double)
+        try:
+            return reader.read(filename, self._cbfbuffer)
+        except CBFError:
+            # larger than usual, let the reader allocate it.
+            return reader.read(filename)
 
-            t0 = time.time()
-            os.stat(imagespath)  # a work-around for NFS
-            while (time.time() - t0) < cbf_file_timeout:
-                try:
-                    cbfdata, cbfheader = sastool.io.twodim.readcbf(os.path.join(imagespath,
-                                                                                self.credo().subsystems['Files'].get_exposureformat() % fsn), load_header=True, load_data=True, for_nexus=True)
-                    break
-                except IOError:
-                    logger.debug('Waiting for image...')
-                    if stopswitch.wait(0.01):
-                        # break signaled.
-                        raise StopSwitchException
-                # continue with the next try.
-            if cbfdata is None:
-                # timeout.
-                raise SubSystemExposureError(
-                    'Timeout on waiting for CBF file.')
-            # create the exposure object
-            logger.debug('Creating exposure')
-            header = sastool.classes.SASHeader(header_template)
-            # do some fine adjustments on the header template:
-            # a) include the CBF header written by camserver.
-            logger.debug('updating header')
-            header.update(cbfheader)
-            # d) set the end date to the current time.
-            header['EndDate'] = datetime.datetime.now()
-            # and save the header to the parampath.
-            logger.debug('Writing header')
-            headername = os.path.join(parampath, self.credo().subsystems[
-                                      'Files'].get_headerformat(filebegin, ndigits) % fsn)
-            header.write(headername)
-            logger.debug('Header %s written.' % (headername))
-            if write_nexus:
-                nexusname = os.path.join(nexuspath, self.credo().subsystems[
-                                         'Files'].get_nexusformat(filebegin, ndigits) % fsn)
-                self.update_nexusfile(
-                    nexusname, cbfdata, header, waittime=waittime)
-            outqueue.put((ExposureMessageType.Image, fsn))
-            logger.debug('Process_exposure took %f seconds.' %
-                         (time.time() - t0))
-            del cbfdata
-        except StopSwitchException:
-            # an user break occurred
-            outqueue.put((ExposureMessageType.End, False))
-            return
+    def _process_frame(self, fsn, arrival, waittime, slot, info, maskmatrix, stopswitch):
+        """Wait for the scattering image file of `fsn`, expected at `arrival`,
+        then load it, write its header (and NeXus file) and put the frame in
+        `slot` of the frame buffer. Runs in the worker processes of the pool,
+        so it must not rely on the state of the other subsystems: everything
+        needed is in `info`. Returns a dict of timings and the slot (None if
+        the frame could not be put in the frame buffer).
 
-        except Exception, exc:
-            # catch all exceptions and put an error state in the output queue,
-            # then re-raise.
-            outqueue.put((ExposureMessageType.Failure, traceback.format_exc()))
-            outqueue.put((ExposureMessageType.End, False))
-            raise
-        else:
-            if this_is_the_last:
-                outqueue.put((ExposureMessageType.End, True))
-        finally:
-            del cbfdata
-        logger.debug('Exposure subprocess for FSN #%d ended.')
+        Raises StopSwitchException if `stopswitch` is set while waiting.
+        """
+        timings = {}
+        logger.debug('Processing FSN #%d, expected in %.2f seconds' %
+                     (fsn, arrival - time.time()))
+        watcher = self._get_watcher(info['imagespath'])
+        header_template = info['header_template'].copy()
+        header_template['FSN'] = fsn
+        t0 = time.time()
+        arrived = watcher.wait_for(info['exposureformat'] % fsn,
+                                   arrival - t0 + info['cbf_file_timeout'], stopswitch)
+        if arrived is None:
+            if stopswitch.is_set():
+                raise StopSwitchException
+            raise SubSystemExposureError('Timeout on waiting for CBF file.')
+        cbfname, arrivaltime = arrived
+        timings['cbf_wait'] = (t0, time.time())
+        cbfdata, cbfheader = self._read_cbf(cbfname)
+        timings['arrival_to_decode'] = (arrivaltime, time.time())
+        cbfmtime = os.stat(cbfname).st_mtime
+        timings['cbf_file'] = (cbfmtime, cbfmtime)
+        # create the exposure object
+        logger.debug('Creating exposure')
+        header = sastool.classes.SASHeader(header_template)
+        # do some fine adjustments on the header template:
+        # a) include the CBF header written by camserver.
+        logger.debug('updating header')
+        header.update(cbfheader)
+        # d) set the end date to the current time.
+        header['EndDate'] = datetime.datetime.now()
+        # and save the header to the parampath.
+        logger.debug('Writing header')
+        t1 = time.time()
+        headername = shard_path(
+            info['parampath'], info['headerformat'] % fsn, info['shardsize'])
+        write_atomic(headername, header.write)
+        logger.debug('Header %s written.' % (headername))
+        timings['header_write'] = (t1, time.time())
+        if info['write_nexus']:
+            t1 = time.time()
+            nexusname = shard_path(
+                info['nexuspath'], info['nexusformat'] % fsn, info['shardsize'])
+            self._nexuswriter.write_frame(
+                nexusname, np.flipud(cbfdata), arrival)
+            timings['nexus_write'] = (t1, time.time())
+        if slot is not None:
+            t1 = time.time()
+            header['FileName'] = cbfname
+            if not self._framebuffer.write(slot, cbfdata, header, tag=fsn, stopswitch=stopswitch):
+                if stopswitch.is_set():
+                    raise StopSwitchException
+                logger.warning(
+                    'FSN #%d does not fit in the frame buffer.' % fsn)
+                slot = None
+            timings['framebuffer_write'] = (t1, time.time())
+        logger.debug('Processing FSN #%d took %f seconds.' %
+                     (fsn, time.time() - t0))
+        return timings, slot
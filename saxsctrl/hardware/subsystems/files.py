@@ -8,13 +8,28 @@ import h5py
 import datetime
 import dateutil.tz
 import pkg_resources
-from ..instruments import InstrumentError
+from ..io.fsnindex import FSNIndex
+from ..io.headercatalog import HeaderCatalog
+from ..io.sharding import shard_path, make_shard_dir, find_shards, shard_base
+from ..io.scancontainer import ScanContainer
+from ..io.nexuswriter import write_nexus_static, write_nexus_dynamic
+from ..io.asyncwriter import AsyncFileWriter
+from ..io.specindex import SpecScanStore
+from ..io.archive import ArchiveIndex, ArchiveError, extract
+from ..io.curvestore import CurveStore
+from ..reduction.radavg import radial_average
 import scipy.constants
 import time
+import sqlite3
+import threading
+import Queue
 import traceback
+import tempfile
+import shutil
 
 from gi.repository import GObject
 from gi.repository import Gio
+from gi.repository import GLib
 
 __all__ = ['SubSystemFiles']
 
@@ -23,6 +38,9 @@ logger.setLevel(logging.DEBUG)
 
 DEFAULT_FILEPREFIXES = ['crd', 'tst', 'scn', 'tra']
 
+# subfolders where the files can be distributed in <prefix>/<bucket> shards
+SHARDED_SUBDIRS = ['images', 'param', 'param_override', 'eval2d', 'eval1d', 'nexus']
+
 HC = scipy.constants.codata.value(
     'Planck constant in eV s') * scipy.constants.codata.value('speed of light in vacuum') * 1e9  # nm*eV
 
@@ -35,6 +53,12 @@ class SubSystemFiles(SubSystem):
                     # emitted whenever the first fsn from the current format
                     # changes.
                     'new-firstfsn': (GObject.SignalFlags.RUN_FIRST, None, (int, str)),
+                    # emitted when files queued for asynchronous writing
+                    # have been written. Argument: list of file names.
+                    'write-done': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
+                    # emitted when asynchronous writing of files failed.
+                    # Arguments: list of file names, error message.
+                    'write-failed': (GObject.SignalFlags.RUN_FIRST, None, (object, str)),
                     'notify': 'override',
                     }
     filebegin = GObject.property(
@@ -44,23 +68,57 @@ class SubSystemFiles(SubSystem):
     rootpath = ''
     scanfilename = GObject.property(
         type=str, default='credoscan.spec', blurb='Scan file')
+    shardsize = GObject.property(
+        type=int, default=0, minimum=0, blurb='Number of FSNs in a data subfolder (0: flat layout)')
+    asyncwrite = GObject.property(
+        type=bool, default=True, blurb='Write headers and reduced data in the background')
+    fsyncwrite = GObject.property(
+        type=bool, default=True, blurb='Flush files written in the background to the disk')
 
     def __init__(self, credo, offline=True, createdirsifnotpresent=False):
+        self._pathcache = {}
+        self._pathcache_root = None
+        self._locator = {}
+        self._nexus_static = None
+        self._nexus_newtemplate = ''
+        self._nexus_templateversion = 0
+        self._version = None
+        self._writer = AsyncFileWriter()
         self.rootpath = os.getcwd()
         SubSystem.__init__(self, credo, offline)
         self.monitors = []
+        self._fsnindex = None
+        self._archiveindex = None
+        self._archivecache = None
+        self._archivelock = threading.Lock()
+        self._curvestore = None
+        self._catalog = None
+        self._catalog_queue = Queue.Queue()
+        self._catalog_thread = None
+        self._catalog_stop = threading.Event()
         self.create_subdirs(createdirsifnotpresent)
         self._setup(self.rootpath)
         self.scanfile = None
         self.scanfilename = 'credoscan.spec'
         self._lastevents = []
 
+    def destroy(self):
+        self._writer.shutdown()
+        self._close_archives()
+
     def __del__(self):
+        self._writer.shutdown()
         self._disconnect_monitors()
+        self._stop_catalog()
+        self._close_archives()
+        if self._fsnindex is not None:
+            self._fsnindex.close()
 
     def do_notify(self, prop):
         if prop.name in ['filebegin', 'ndigits']:
             self.emit('changed')
+        if prop.name in ['fsyncwrite']:
+            self._writer.fsync = self.fsyncwrite
         if prop.name in ['scanfilename']:
             if not os.path.isabs(self.scanfilename):
                 self.scanfilename = os.path.join(
@@ -73,7 +131,7 @@ class SubSystemFiles(SubSystem):
             self.scanfile.finalize()
             del self.scanfile
         logger.debug('Reloading scan file from ' + self.scanfilename + '')
-        self.scanfile = sastool.classes.SASScanStore(
+        self.scanfile = SpecScanStore(
             self.scanfilename, 'CREDO spec file', [])
         logger.debug('Scan file reloaded: ' + str(self.scanfile))
         return self.scanfile
@@ -92,25 +150,226 @@ class SubSystemFiles(SubSystem):
                 rootpath, self.rootpath))
             self.rootpath = rootpath
         self.monitors = []
-        for folder in self._watchpath():
-            dirmonitor = Gio.file_new_for_path(folder).monitor_directory(
-                Gio.FileMonitorFlags.NONE, None)
-            self.monitors.append(
-                (dirmonitor, dirmonitor.connect('changed', self._on_monitor_event)))
-            logger.debug(
-                'SubSystemFiles._setup(): Added directory monitor for path %s' % folder)
+        self.invalidate_path_cache()
+        self._open_fsnindex()
+        self._open_archiveindex()
+        self._curvestore = None
+        folders = []
+        for folder in self._watchpath() + self._indexwatchpath() + [os.path.expanduser(self.rootpath), self.maskpath]:
+            if folder not in folders:
+                folders.append(folder)
+        for folder in folders:
+            self._add_monitor(folder)
         self._nextfsn_cache = {}
         self._firstfsn_cache = {}
         for f in self._search_formats():
             self.get_next_fsn(self.get_format_re(f, self.ndigits, False))
             self.get_first_fsn(self.get_format_re(f, self.ndigits, False))
+        self._open_catalog()
+
+    def _add_monitor(self, folder):
+        dirmonitor = Gio.file_new_for_path(folder).monitor_directory(
+            Gio.FileMonitorFlags.NONE, None)
+        self.monitors.append(
+            (dirmonitor, dirmonitor.connect('changed', self._on_monitor_event)))
+        logger.debug(
+            'SubSystemFiles: Added directory monitor for path %s' % folder)
 
     def _watchpath(self):
-        return [self._get_subpath(subdir) for subdir in ['images', 'param', 'eval2d', 'eval1d']]
+        return self._get_loadpath(['images', 'param', 'eval2d', 'eval1d'], False)
+
+    def _indexwatchpath(self):
+        # watched only for keeping the FSN index and the file locator current
+        return self._get_loadpath(['param_override', 'nexus'], False) + self._get_loadpath([], True)
+
+    def _open_fsnindex(self):
+        if self._fsnindex is not None:
+            self._fsnindex.close()
+            self._fsnindex = None
+        # the directories are only listed if changed since the last run.
+        try:
+            self._fsnindex = FSNIndex(
+                os.path.join(self.configpath, 'fsnindex.sqlite'))
+            self._fsnindex.sync(self.exposureloadpath)
+        except (sqlite3.Error, OSError):
+            logger.error('Cannot open FSN index, falling back to listing the directories: ' +
+                         traceback.format_exc())
+            if self._fsnindex is not None:
+                self._fsnindex.close()
+            self._fsnindex = None
+
+    def _open_archiveindex(self):
+        self._close_archives()
+        if not os.path.isdir(self.archivepath):
+            return
+        try:
+            self._archiveindex = ArchiveIndex(
+                os.path.join(self.configpath, 'archiveindex.sqlite'))
+            self._archiveindex.sync(self.archivepath)
+        except (sqlite3.Error, OSError):
+            logger.error('Cannot open the index of the archives: ' +
+                         traceback.format_exc())
+            self._close_archives()
+
+    def _close_archives(self):
+        if self._archiveindex is not None:
+            self._archiveindex.close()
+            self._archiveindex = None
+        if self._archivecache is not None:
+            shutil.rmtree(self._archivecache, ignore_errors=True)
+            self._archivecache = None
+
+    def extract_archived(self, prefix, fsn, subdirs):
+        """Extract the files with `prefix` and `fsn` from `subdirs` (e.g.
+        ['param', 'images']) of the archives (see saxsctrl.hardware.io.archive)
+        to a temporary directory. The mask files stored in the archive are
+        extracted as well. Returns the full paths of the extracted files, in
+        the order of `subdirs`, followed by the mask files."""
+        if self._archiveindex is None:
+            return []
+        found = self._archiveindex.find(prefix, fsn)
+        paths = []
+        masks = []
+        with self._archivelock:
+            if self._archivecache is None:
+                self._archivecache = tempfile.mkdtemp(prefix='saxsctrl_archive_')
+            for subdir in subdirs:
+                for archive, s, name in found:
+                    if s != subdir:
+                        continue
+                    path = os.path.join(self._archivecache, subdir, name)
+                    try:
+                        if not os.path.exists(path):
+                            extract(archive, subdir, name, os.path.dirname(path))
+                        paths.append(path)
+                        masks.extend(m for m in self._extract_masks(archive) if m not in masks)
+                    except (IOError, KeyError, ArchiveError):
+                        logger.error('Cannot extract %s from archive %s: %s' % (
+                            name, archive, traceback.format_exc()))
+        return paths + masks
+
+    def _extract_masks(self, archive):
+        maskdir = os.path.join(self._archivecache, 'mask')
+        with h5py.File(archive, 'r') as f:
+            names = list(f.get('masks', {}))
+        for name in names:
+            if not os.path.exists(os.path.join(maskdir, name)):
+                extract(archive, 'masks', name, maskdir)
+        return [os.path.join(maskdir, name) for name in names]
+
+    def _open_catalog(self):
+        self._stop_catalog()
+        try:
+            self._catalog = HeaderCatalog(
+                os.path.join(self.configpath, 'headercatalog.sqlite'))
+        except sqlite3.Error:
+            logger.error('Cannot open header catalog: ' +
+                         traceback.format_exc())
+            self._catalog = None
+            return
+        self._catalog_queue = Queue.Queue()
+        self._catalog_stop.clear()
+        self._catalog_thread = threading.Thread(
+            target=self._catalog_worker, args=(self._catalog, self._catalog_queue, self._catalog_stop))
+        self._catalog_thread.daemon = True
+        self._catalog_thread.start()
+        if self._fsnindex is not None:
+            # headers written while the catalog did not exist or we were not
+            # running are added in the background.
+            for prefix in self._fsnindex.prefixes():
+                self._catalog_queue.put(
+                    ('import', prefix, self._fsnindex.files(prefix)))
+
+    def _stop_catalog(self):
+        if self._catalog_thread is not None:
+            self._catalog_stop.set()
+            self._catalog_queue.put(None)
+            self._catalog_thread.join()
+            self._catalog_thread = None
+        if self._catalog is not None:
+            self._catalog.close()
+            self._catalog = None
+
+    def _catalog_worker(self, catalog, queue, stopswitch):
+        rawdirs = [self.param_overridepath, self.parampath]
+        reduceddir = self.eval2dpath
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            try:
+                if job[0] == 'update':
+                    catalog.update(*job[1:])
+                    continue
+                prefix, files = job[1:]
+                missing = sorted(set(files) - catalog.fsns(prefix))
+                records = {True: [], False: []}
+                for fsn in missing:
+                    if stopswitch.is_set():
+                        return
+                    params = [f for f in files[fsn] if f.endswith('.param')]
+                    reduced = [f for f in params if shard_base(os.path.dirname(f)) == reduceddir]
+                    raw = sorted([f for f in params if shard_base(os.path.dirname(f)) in rawdirs],
+                                 key=lambda f: rawdirs.index(shard_base(os.path.dirname(f))))
+                    if not (reduced or raw):
+                        continue
+                    try:
+                        header = sastool.classes.SASHeader((reduced + raw)[0])
+                    except (IOError, ValueError):
+                        logger.warning('Cannot load header for the catalog: ' +
+                                       traceback.format_exc())
+                        continue
+                    records[bool(reduced)].append(HeaderCatalog.record(header))
+                    if len(records[bool(reduced)]) >= 100:
+                        catalog.update(prefix, records[bool(reduced)], bool(reduced))
+                        records[bool(reduced)] = []
+                for reduced in records:
+                    catalog.update(prefix, records[reduced], reduced)
+                if missing:
+                    logger.debug('Header catalog: imported %d headers with prefix %s' % (
+                        len(missing), prefix))
+            except sqlite3.Error:
+                logger.error('Error while updating the header catalog: ' +
+                             traceback.format_exc())
+
+    def catalog_header(self, header, fileformat=None, reduced=False):
+        """Add the header to the header catalog, or update it there.
+        `fileformat` (e.g. 'crd_%05d.param') gives the file name prefix. The
+        catalog is updated in a background thread."""
+        if self._catalog is None:
+            return
+        if fileformat is None:
+            fileformat = self.get_headerformat()
+        m = FSNIndex.filename_re.match(fileformat % header['FSN'])
+        if m is None:
+            return
+        self._catalog_queue.put(
+            ('update', m.group('prefix'), [HeaderCatalog.record(header)], reduced))
+
+    def query_catalog(self, prefix=None, fsnmin=None, fsnmax=None, title=None, reduced=None, limit=None, offset=0):
+        """Return the matching entries of the header catalog (see
+        HeaderCatalog.query()), or None if the catalog is not available."""
+        if self._catalog is None:
+            return None
+        if prefix is None:
+            prefix = self.filebegin
+        return self._catalog.query(prefix, fsnmin, fsnmax, title, reduced, limit, offset)
+
+    def _regex_prefix(self, regex, index=True):
+        # the file name prefix of a non-strict format regex, which can be
+        # looked up in the FSN index (or in the archive index if `index` is
+        # False). None for all other regexes.
+        m = re.match(r'^([a-zA-Z0-9]+)_\(\?P<fsn>\\d\+\)$', regex.pattern)
+        if (m is None) or ([self._archiveindex, self._fsnindex][index] is None):
+            return None
+        return m.group(1)
 
     def _search_formats(self):
         regex = re.compile('(?P<begin>[a-zA-Z0-9]+)_(?P<fsn>\d+)')
         formats = set(DEFAULT_FILEPREFIXES)
+        if self._fsnindex is not None:
+            formats.update(self._fsnindex.prefixes())
+            return list(sorted(formats))
         for pth in self.exposureloadpath:
             formats.update({m.groupdict()['begin'] for m in [
                            regex.match(f) for f in os.listdir(pth)] if (m is not None)})
@@ -131,7 +390,25 @@ class SubSystemFiles(SubSystem):
             logger.debug('SubSystemFiles._on_monitor_event() starting: filename: ' +
                          filename.get_path() + ', otherfilename: None, event: ' +
                          str(event))
-
+        dirname = os.path.dirname(filename.get_path())
+        if dirname in (os.path.expanduser(self.rootpath), self.maskpath):
+            # a subdirectory or a symlink to it may have been created,
+            # removed or replaced.
+            if event in (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED,
+                         Gio.FileMonitorEvent.MOVED):
+                self.invalidate_path_cache()
+            if dirname != self.maskpath:
+                return
+        if (event in (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED) and
+                filename.get_basename()):
+            self._locate_forget(filename.get_basename())
+            if self._fsnindex is not None:
+                if event == Gio.FileMonitorEvent.CREATED:
+                    self._fsnindex.add(dirname, filename.get_basename())
+                else:
+                    self._fsnindex.remove(dirname, filename.get_basename())
+        if dirname not in self._watchpath():
+            return
         if (event in (Gio.FileMonitorEvent.CHANGED, Gio.FileMonitorEvent.CREATED)):
             basename = filename.get_basename()
             if basename:
@@ -179,11 +456,20 @@ class SubSystemFiles(SubSystem):
         logger.debug(
             'SubSystemFiles: finding lowest fsn for files matching pattern %s' % regex.pattern)
         minfsns = []
-        for pth in self.exposureloadpath:
-            fsns = [int(m.group(1)) for m in [regex.match(f)
-                                              for f in os.listdir(pth)] if m is not None]
-            if fsns:
-                minfsns.append(min(fsns))
+        prefix = self._regex_prefix(regex)
+        if prefix is not None:
+            if self._fsnindex.min_fsn(prefix) is not None:
+                minfsns.append(self._fsnindex.min_fsn(prefix))
+        else:
+            for pth in self.exposureloadpath:
+                fsns = [int(m.group(1)) for m in [regex.match(f)
+                                                  for f in os.listdir(pth)] if m is not None]
+                if fsns:
+                    minfsns.append(min(fsns))
+        # the FSNs of archived (and possibly removed) files are taken as well.
+        prefix = self._regex_prefix(regex, False)
+        if (prefix is not None) and (self._archiveindex.min_fsn(prefix) is not None):
+            minfsns.append(self._archiveindex.min_fsn(prefix))
         if minfsns:
             self._firstfsn_cache[regex] = min(minfsns)
         else:
@@ -202,16 +488,42 @@ class SubSystemFiles(SubSystem):
         logger.debug(
             'SubSystemFiles: finding highest fsn for files matching pattern %s' % regex.pattern)
         maxfsns = [0]
-        for pth in self.exposureloadpath:
-            fsns = [int(m.group(1)) for m in [regex.match(f)
-                                              for f in os.listdir(pth)] if m is not None]
-            if fsns:
-                maxfsns.append(max(fsns))
+        prefix = self._regex_prefix(regex)
+        if prefix is not None:
+            if self._fsnindex.max_fsn(prefix) is not None:
+                maxfsns.append(self._fsnindex.max_fsn(prefix))
+        else:
+            for pth in self.exposureloadpath:
+                fsns = [int(m.group(1)) for m in [regex.match(f)
+                                                  for f in os.listdir(pth)] if m is not None]
+                if fsns:
+                    maxfsns.append(max(fsns))
+        prefix = self._regex_prefix(regex, False)
+        if (prefix is not None) and (self._archiveindex.max_fsn(prefix) is not None):
+            maxfsns.append(self._archiveindex.max_fsn(prefix))
         self._nextfsn_cache[regex] = max(maxfsns) + 1
         if currentpattern:
             self.emit('new-nextfsn', self._nextfsn_cache[regex], regex.pattern)
         return self._nextfsn_cache[regex]
 
+    def is_fsn_taken(self, fsn, regex=None):
+        """Check if there is a file with the given FSN in the exposure load
+        path or in the archives."""
+        if regex is None:
+            regex = self.get_fileformat_re()
+        prefix = self._regex_prefix(regex, False)
+        if (prefix is not None) and self._archiveindex.is_taken(prefix, fsn):
+            return True
+        prefix = self._regex_prefix(regex)
+        if prefix is not None:
+            return self._fsnindex.is_taken(prefix, fsn)
+        for pth in self.exposureloadpath:
+            for f in os.listdir(pth):
+                m = regex.match(f)
+                if (m is not None) and int(m.group(1)) == fsn:
+                    return True
+        return False
+
     def increment_next_fsn(self, regex=None):
         if regex is None:
             regex = self.get_fileformat_re()
@@ -220,7 +532,20 @@ class SubSystemFiles(SubSystem):
             self.emit('new-nextfsn', self._nextfsn_cache[regex], regex.pattern)
         return self._nextfsn_cache[regex]
 
+    def invalidate_path_cache(self):
+        """Forget the resolved subdirectory paths and the file locations.
+        Called when the root path or its subdirectories change."""
+        self._pathcache = {}
+        self._pathcache_root = self.rootpath
+        self._locator = {}
+
     def _get_subpath(self, subdir):
+        if self._pathcache_root != self.rootpath:
+            self.invalidate_path_cache()
+        try:
+            return self._pathcache[subdir]
+        except KeyError:
+            pass
         pth = os.path.join(os.path.expanduser(self.rootpath), subdir)
         while os.path.islink(pth):
             pth = os.readlink(pth)
@@ -229,47 +554,128 @@ class SubSystemFiles(SubSystem):
                 os.mkdir(pth)  # an OSError is raised if no permission.
             else:
                 raise OSError('%s exists and is not a directory!' % pth)
+        self._pathcache[subdir] = pth
         return pth
 
-    @property
-    def configpath(self):
-        return self._get_subpath('config')
+    def _get_shards(self, subdir):
+        key = 'shards:' + subdir
+        if key not in self._pathcache:
+            self._pathcache[key] = find_shards(self._get_subpath(subdir))
+        return self._pathcache[key]
 
-    @property
-    def exposureloadpath(self):
+    def _get_loadpath(self, subdirs, masks=True):
+        # the shard directories of each subfolder follow the subfolder itself
+        if self._pathcache_root != self.rootpath:
+            self.invalidate_path_cache()
+        key = (tuple(subdirs), masks)
+        try:
+            return list(self._pathcache[key])
+        except KeyError:
+            pass
         ret = []
-        for p in ['eval2d', 'eval1d', 'param_override', 'param', 'images', 'nexus']:
+        for p in subdirs:
             try:
                 ret.append(self._get_subpath(p))
             except OSError:
                 logger.warning(
                     'Subpath %s cannot be found, not including it to exposureloadpath!' % p)
-        ret.extend(sastool.misc.find_subdirs(self._get_subpath('mask'), None))
-        return ret
+                continue
+            if p in SHARDED_SUBDIRS:
+                ret.extend(self._get_shards(p))
+        if masks:
+            if 'masksubdirs' not in self._pathcache:
+                self._pathcache['masksubdirs'] = sastool.misc.find_subdirs(
+                    self._get_subpath('mask'), None)
+            ret.extend(self._pathcache['masksubdirs'])
+        self._pathcache[key] = ret
+        return list(ret)
+
+    def get_writepath(self, subdir, filename):
+        """Return the full path where a new file named `filename` is to be
+        written in `subdir` (e.g. 'param'), according to the current shard
+        size. A missing shard directory is created and added to the load
+        paths and the directory monitors."""
+        path = self._get_subpath(subdir)
+        if subdir not in SHARDED_SUBDIRS:
+            return os.path.join(path, filename)
+        fullpath = shard_path(path, filename, self.shardsize)
+        shard = os.path.dirname(fullpath)
+        if shard != path and shard not in self._get_shards(subdir):
+            if make_shard_dir(shard):
+                logger.info('Created new shard directory ' + shard)
+            self._get_shards(subdir).append(shard)
+            for key in [k for k in self._pathcache if isinstance(k, tuple)]:
+                self._pathcache.pop(key, None)
+            # we can be called from the data reduction thread, but the
+            # monitors must be created in the main loop.
+            GLib.idle_add(self._register_shard, shard)
+        return fullpath
+
+    def _register_shard(self, shard):
+        self._add_monitor(shard)
+        if self._fsnindex is not None:
+            # files written before the monitor was set up.
+            self._fsnindex.rescan(shard)
+        return False
+
+    @property
+    def configpath(self):
+        return self._get_subpath('config')
+
+    @property
+    def exposureloadpath(self):
+        return self._get_loadpath(['eval2d', 'eval1d', 'param_override', 'param', 'images', 'nexus'])
 
     @property
     def rawloadpath(self):
-        ret = []
-        for p in ['param_override', 'param', 'images', 'nexus']:
-            try:
-                ret.append(self._get_subpath(p))
-            except OSError:
-                logger.warning(
-                    'Subpath %s cannot be found, not including it to exposureloadpath!' % p)
-        ret.extend(sastool.misc.find_subdirs(self._get_subpath('mask'), None))
-        return ret
+        return self._get_loadpath(['param_override', 'param', 'images', 'nexus'])
 
     @property
     def reducedloadpath(self):
-        ret = []
-        for p in ['eval2d', 'eval1d']:
-            try:
-                ret.append(self._get_subpath(p))
-            except OSError:
-                logger.warning(
-                    'Subpath %s cannot be found, not including it to exposureloadpath!' % p)
-        ret.extend(sastool.misc.find_subdirs(self._get_subpath('mask'), None))
-        return ret
+        return self._get_loadpath(['eval2d', 'eval1d'])
+
+    def _locate_forget(self, basename):
+        m = FSNIndex.filename_re.match(basename)
+        if m is not None:
+            self._locator.pop((m.group('prefix'), int(m.group('fsn')),
+                               os.path.splitext(basename)[1].lstrip('.')), None)
+
+    def locate(self, prefix, fsn, kind, dirs=None):
+        """Return the full path of the file with `prefix`, `fsn` and
+        extension `kind` (e.g. 'cbf', 'param'), or None if there is no such
+        file. If more directories contain such a file, the first one in the
+        order of `dirs` (default: exposureloadpath) is returned. The results
+        are cached until the directory monitors report a change."""
+        if dirs is None:
+            dirs = self.exposureloadpath
+        key = (prefix, fsn, kind)
+        try:
+            return self._locator[key][tuple(dirs)]
+        except KeyError:
+            pass
+        if self._fsnindex is not None:
+            candidates = dict((os.path.dirname(f), f) for f in self._fsnindex.find(prefix, fsn)
+                              if os.path.splitext(f)[1] == '.' + kind)
+            found = [candidates[d] for d in dirs if d in candidates]
+            if not found:
+                # the file may be newer than the last monitor event handled
+                name = '%s_%0*d.%s' % (prefix, self.ndigits, fsn, kind)
+                found = [os.path.join(d, name) for d in dirs
+                         if os.path.exists(os.path.join(d, name))]
+                for f in found:
+                    self._fsnindex.add(os.path.dirname(f), name)
+        else:
+            found = []
+            for d in dirs:
+                for f in os.listdir(d):
+                    m = FSNIndex.filename_re.match(f)
+                    if ((m is not None) and m.group('prefix') == prefix and
+                            int(m.group('fsn')) == fsn and f.endswith('.' + kind)):
+                        found.append(os.path.join(d, f))
+        if not found:
+            return None
+        self._locator.setdefault(key, {})[tuple(dirs)] = found[0]
+        return found[0]
 
     @property
     def moviepath(self):
@@ -283,6 +689,11 @@ class SubSystemFiles(SubSystem):
     def param_overridepath(self):
         return self._get_subpath('param_override')
 
+    @property
+    def archivepath(self):
+        # not created if missing: it is made by the archiver tool.
+        return os.path.join(os.path.expanduser(self.rootpath), 'archive')
+
     @property
     def maskpath(self):
         return self._get_subpath('mask')
@@ -347,34 +758,88 @@ class SubSystemFiles(SubSystem):
         else:
             return re.compile(filebegin + '_' + '(?P<fsn>\d+)')
 
+    def _write(self, files, callback=None):
+        """Write the files given as (filename, writer) pairs, where writer
+        is a callable writing a file to the name it is called with. If
+        `asyncwrite` is True, the files are written in the background, and
+        'write-done' or 'write-failed' is emitted when finished. `callback`
+        is then called with the list of file names and the error (None on
+        success) from the writer thread."""
+        if not self.asyncwrite:
+            for filename, writer in files:
+                writer(filename)
+            if callback is not None:
+                callback([f for f, w in files], None)
+            return
+        def finished(filenames, error):
+            if callback is not None:
+                callback(filenames, error)
+            GLib.idle_add(self._on_write_finished, filenames, error)
+        self._writer.start()
+        self._writer.submit(files, finished)
+
+    def _on_write_finished(self, filenames, error):
+        if error is None:
+            self.emit('write-done', filenames)
+        else:
+            self.emit('write-failed', filenames, error)
+        return False
+
+    def flush(self):
+        """Wait until the files queued for writing are written."""
+        self._writer.flush()
+
     def writeheader(self, header, raw=True, override=False, headerformat=None):
         if headerformat is None:
             headerformat = self.get_headerformat()
         if raw and override:
-            path = self.param_overridepath
+            subdir = 'param_override'
         elif raw:
-            path = self.parampath
+            subdir = 'param'
         else:
-            path = self.eval2dpath
-        header.write(os.path.join(path, headerformat % header['FSN']))
+            subdir = 'eval2d'
+        header = header.copy()
+
+        def written(filenames, error):
+            if error is None:
+                self.catalog_header(header, headerformat, not raw)
+        self._write(
+            [(self.get_writepath(subdir, headerformat % header['FSN']), header.write)], written)
 
     def writereduced(self, exposure):
-        exposure.write(
-            os.path.join(self.eval2dpath, self.get_eval2dformat() % exposure['FSN']))
-        exposure.header.write(
-            os.path.join(self.eval2dpath, self.get_evalheaderformat() % exposure['FSN']))
-
-    def writeradial(self, exposure, pixels_per_qbin=None):
-        if pixels_per_qbin is None:
-            rad = exposure.radial_average()
-        else:
-            qrange = exposure.get_qrange()
-            pixrange = exposure.get_pixrange()
-            Npix = (pixrange.max() - pixrange.min())
-            Nq = int(Npix / float(pixels_per_qbin))
-            rad = exposure.radial_average(
-                np.linspace(qrange.min(), qrange.max(), Nq))
-        rad.save(os.path.join(self.eval1dpath, 'crd_%d.txt' % exposure['FSN']))
+        if self.asyncwrite:
+            # the exposure may be changed after we return
+            exposure = sastool.classes.SASExposure(exposure)
+        evalheaderformat = self.get_evalheaderformat()
+
+        def written(filenames, error):
+            if error is None:
+                self.catalog_header(exposure.header, evalheaderformat, True)
+        self._write(
+            [(self.get_writepath('eval2d', self.get_eval2dformat() % exposure['FSN']), exposure.write),
+             (self.get_writepath('eval2d', evalheaderformat % exposure['FSN']), exposure.header.write)],
+            written)
+
+    @property
+    def curvestore(self):
+        """The consolidated store of the radial averages (eval1d/curves.h5)."""
+        if self._curvestore is None:
+            self._curvestore = CurveStore(os.path.join(self.eval1dpath, 'curves.h5'))
+        return self._curvestore
+
+    def writeradial(self, exposure, pixels_per_qbin=None, text=True, store=True, prefix=None, rad=None):
+        """Radially average the exposure (unless the radial average is given
+        as `rad`), then append the curve to the curve store under `prefix`
+        (default: the current file prefix) if `store` is True, and/or export
+        it to eval1d/crd_<FSN>.txt if `text` is True."""
+        if prefix is None:
+            prefix = self.filebegin
+        if rad is None:
+            rad = radial_average(exposure, pixels_per_qbin=pixels_per_qbin)
+        if store:
+            self.curvestore.append(prefix, rad, exposure.header)
+        if text:
+            self._write([(self.get_writepath('eval1d', 'crd_%d.txt' % exposure['FSN']), rad.save)])
 
     def create_subdirs(self, do_create=False):
         for subdir in ['config', 'eval1d', 'eval2d', 'mask', 'movie', 'param', 'param_override', 'png', 'processing', 'scan', 'sequences', 'user', 'log', 'nexus']:
@@ -397,14 +862,148 @@ class SubSystemFiles(SubSystem):
                     raise SubSystemError(
                         'Cannot create subdirectory, please run program with the "createdirs" command-line option!')
 
-    def create_nexus_template(self, fsn, filebegin=None, ndigits=None, nscan=None):
+    def create_nexus_template(self, fsn, filebegin=None, ndigits=None, nscan=None, writer=None):
+        """Create the NeXus file of an exposure, before it starts. If a
+        NeXusWriter is given as `writer`, the file is written by it, as a
+        copy of the static template (see get_nexus_template()), and only the
+        dynamic state of the instrument is collected here."""
         if filebegin is None:
             filebegin = self.filebegin
         if ndigits is None:
             ndigits = self.ndigits
-        return self._create_nexus_template_file(os.path.join(self.nexuspath, self.get_nexusformat(filebegin, ndigits) % fsn), fsn, nscan)
+        filename = self.get_writepath(
+            'nexus', self.get_nexusformat(filebegin, ndigits) % fsn)
+        if writer is None:
+            return self._create_nexus_template_file(filename, fsn, nscan)
+        writer.create(filename, self.get_nexus_template(writer),
+                      self._nexus_dynamic_state(fsn, nscan))
+        return filename
 
-    def _create_nexus_template_file(self, filename, fsn=None, nscan=None):
+    def create_scan_container(self, scannumber, npoints, scalars, shape=None):
+        """Create a single NeXus file for all `npoints` frames of scan
+        `scannumber`, and return it as a ScanContainer with the per-frame
+        scalars `scalars`. The file is named like the NeXus files of single
+        exposures, with the prefix 'scan'. The frame shape defaults to that
+        of the current mask."""
+        if shape is None:
+            mask = self._nexus_mask()
+            if mask is None:
+                raise ValueError('Cannot determine the image shape: no mask loaded.')
+            shape = mask.shape
+        filename = self.get_writepath(
+            'nexus', self.get_nexusformat('scan', self.ndigits) % scannumber)
+        self._create_nexus_template_file(filename, scannumber, npoints, 'latest')
+        return ScanContainer(filename, shape, scalars)
+
+    def _nexus_static_state(self):
+        # everything in the NeXus files which only changes with the setup.
+        credo = self.credo()
+        coll = credo.subsystems['Collimation']
+        sse = credo.subsystems['Exposure']
+        static = dict((name, getattr(coll, name)) for name in
+                      ['l0', 'l1', 'l2', 'ls', 'lbs', 'dbs', 'aperture1', 'aperture2', 'aperture3'])
+        static.update(dict((name, getattr(credo, name)) for name in
+                           ['projectid', 'projectname', 'username', 'proposername', 'dist',
+                            'wavelength', 'wavelength_spread', 'beamposx', 'beamposy']))
+        static['energy'] = HC / credo.wavelength
+        static['maskfile'] = sse.default_mask
+        if sse.get_mask() is not None:
+            static['maskid'] = sse.get_mask().maskid
+        if self._version is None:
+            self._version = pkg_resources.get_distribution('saxsctrl').version
+        static['version'] = self._version
+        return static
+
+    def _nexus_mask(self):
+        mask = self.credo().subsystems['Exposure'].get_mask()
+        if mask is None:
+            return None
+        return mask.mask
+
+    def get_nexus_template(self, writer):
+        """Return the name of the static NeXus template file, rebuilding it
+        if the setup changed since it has been written. The new template is
+        put in place by the NeXusWriter `writer`, after the files queued
+        before have been copied from the old one."""
+        static = self._nexus_static_state()
+        template = os.path.join(self.configpath, 'nexus_template.nx5')
+        if (static != self._nexus_static or not
+                (os.path.exists(template) or os.path.exists(self._nexus_newtemplate))):
+            t0 = time.time()
+            self._nexus_templateversion += 1
+            self._nexus_newtemplate = '%s.%d' % (template, self._nexus_templateversion)
+            with h5py.File(self._nexus_newtemplate, 'w') as f:
+                write_nexus_static(f, static, self._nexus_mask())
+            writer.replace_template(self._nexus_newtemplate, template)
+            self._nexus_static = static
+            logger.debug('Rebuilt NeXus template file in %.2f seconds' %
+                         (time.time() - t0))
+        return template
+
+    def _cached_equipment_state(self, equipment, propertynames):
+        # the last known values, without communicating with the equipment.
+        try:
+            eq = self.credo().subsystems['Equipments'].get(equipment)
+        except SubSystemError:
+            return None
+        if not eq.connected():
+            return None
+        return dict((name, eq.get_cached_property(name)) for name in propertynames)
+
+    def _nexus_dynamic_state(self, fsn=None, nscan=None):
+        # the state of the instrument at the start of the exposure, from
+        # cached values only.
+        credo = self.credo()
+        state = {'fsn': fsn, 'nscan': nscan,
+                 'exptime': credo.subsystems['Exposure'].exptime,
+                 'start_time': datetime.datetime.now(dateutil.tz.tzlocal()).isoformat(),
+                 'sample': None, 'temperature': None, 'motors': [],
+                 'ht': None, 'current': None, 'pressure': None, 'vacuumgauge': None}
+        sam = credo.subsystems['Samples'].get()
+        if sam is not None:
+            state['sample'] = {
+                'name': sam.title, 'type': sam.category, 'situation': sam.situation,
+                'description': sam.description, 'preparedby': sam.preparedby,
+                'preparation_date': sam.preparetime.isoformat(),
+                'thickness': float(sam.thickness),
+                'thickness_error': getattr(sam.thickness, 'err', None),
+                'distance': float(sam.distminus),
+                'distance_error': getattr(sam.distminus, 'err', None),
+                'transmission': float(sam.transmission),
+                'transmission_error': getattr(sam.transmission, 'err', None)}
+            haakephoenix = self._cached_equipment_state(
+                'haakephoenix', ['temperature'])
+            if haakephoenix is not None:
+                state['temperature'] = haakephoenix['temperature']
+        coll = credo.subsystems['Collimation']
+        roles = {'sample_x': credo.subsystems['Samples'].motor_samplex,
+                 'sample_y': credo.subsystems['Samples'].motor_sampley,
+                 'beamstop_x': coll.motor_beamstopx, 'beamstop_y': coll.motor_beamstopy,
+                 'ph1_x': coll.motor_ph1x, 'ph1_y': coll.motor_ph1y,
+                 'ph2_x': coll.motor_ph2x, 'ph2_y': coll.motor_ph2y,
+                 'ph3_x': coll.motor_ph3x, 'ph3_y': coll.motor_ph3y}
+        state['beamstop_in'] = (coll.beamstop_in_ymin, coll.beamstop_in_ymax)
+        for motor in credo.subsystems['Motors']:
+            state['motors'].append({
+                'name': motor.name, 'alias': motor.alias,
+                'value': motor.get_parameter('Current_position', raw=False),
+                'raw_value': motor.get_parameter('Current_position', raw=True),
+                'soft_left': motor.get_parameter('soft_left', raw=False),
+                'soft_right': motor.get_parameter('soft_right', raw=False),
+                'role': ([r for r in roles if motor == roles[r]] + [None])[0]})
+        genix = self._cached_equipment_state('genix', ['ht', 'current'])
+        if genix is not None:
+            state.update(genix)
+        vacgauge = self._cached_equipment_state('vacgauge', ['pressure'])
+        if vacgauge is not None:
+            state['pressure'] = vacgauge['pressure']
+            state['vacuumgauge'] = credo.subsystems['Equipments'].get('vacgauge').get_version()
+        state['pilatus'] = self._cached_equipment_state(
+            'pilatus', ['camerasn', 'vcmp', 'tau', 'gain', 'threshold', 'cutoff'] +
+            ['humidity%d' % i for i in range(3)] + ['temperature%d' % i for i in range(3)])
+        return state
+
+    def _create_nexus_template_file(self, filename, fsn=None, nscan=None, libver=None):
         """Creates a NeXus file, just before an exposure. All subsystems are
         considered set-up and ready for the start.
 
@@ -419,347 +1018,14 @@ class SubSystemFiles(SubSystem):
                 this is the number of expected scan points. The NeXus file will
                 have the scheme of a scan file. `fsn` will be in this case the scan
                 number.
+            libver: None or string
+                the HDF5 library version bounds (see h5py.File). Must be
+                'latest' if the file is to be written in SWMR mode.
         """
         t0 = time.time()
-        with h5py.File(filename, 'w') as f:
-            f.attrs['NX_class'] = 'NXroot'
-            f.attrs['creator'] = 'SAXSCtrl@CREDO'
-            f.attrs['file_name'] = filename
-            f.attrs['file_time'] = datetime.datetime.now(
-                dateutil.tz.tzlocal()).isoformat()
-            f.attrs['HDF5_version'] = h5py.version.hdf5_version
-            f.attrs['default'] = 'entry'
-            f.attrs['NeXus_version'] = '4.4.0'
-            entry = f.create_group('entry')
-            entry.attrs['NX_class'] = 'NXentry'
-            entry.attrs['default'] = 'data'
-            entry['title'] = os.path.splitext(os.path.split(filename)[-1])
-            entry['entry_identifier'] = os.path.splitext(
-                os.path.split(filename)[-1])[0]
-            entry['experiment_identifier'] = self.credo().projectid
-            entry['experiment_description'] = self.credo().projectname
-            if nscan is None:
-                entry['definition'] = 'NXsas'
-                entry['definition'].attrs['version'] = '1.0b'
-                entry['definition'].attrs[
-                    'URL'] = 'https://github.com/nexusformat/definitions/blob/master/applications/NXsas.nxdl.xml'
-                entry['collection_time'] = self.credo().subsystems[
-                    'Exposure'].exptime
-                entry['collection_time'].attrs['units'] = 's'
-            else:
-                entry['definition'] = 'CREDOscan'
-                entry['collection_time'] = self.credo().subsystems[
-                    'Exposure'].exptime * nscan
-            entry['run_cycle'] = str(datetime.date.today().year)
-            entry['program_name'] = 'SAXSCtrl'
-            entry['program_name'].attrs[
-                'version'] = pkg_resources.get_distribution('saxsctrl').version
-            entry['revision'] = '0'
-            operator = entry.create_group('operator')
-            operator.attrs['NX_class'] = 'NXuser'
-            operator['name'] = self.credo().username
-            operator['role'] = 'local_contact'
-
-            proposer = entry.create_group('proposer')
-            proposer.attrs['NX_class'] = 'NXuser'
-            proposer['name'] = self.credo().proposername
-            proposer['role'] = 'proposer'
-
-            sam = self.credo().subsystems['Samples'].get()
-            if sam is not None:
-                samplefrom = entry.create_group('sample_from')
-                samplefrom.attrs['NX_class'] = 'NXuser'
-                samplefrom['name'] = sam.preparedby
-                samplefrom['role'] = 'sample_preparator'
-
-                sample = entry.create_group('sample')
-                sample.attrs['NX_class'] = 'NXsample'
-                sample['name'] = sam.title
-                sample['type'] = sam.category
-                sample['situation'] = sam.situation
-                sample['description'] = sam.description
-                sample['preparation_date'] = sam.preparetime.isoformat()
-                sample['thickness'] = float(sam.thickness)
-                sample['thickness'].attrs['units'] = 'cm'
-                try:
-                    sample['thickness_error'] = sam.thickness.err
-                    sample['thickness_error'].attrs['units'] = 'cm'
-                except AttributeError:
-                    pass
-                sample['short_title'] = sample['name']
-                sample['prepared_by'] = samplefrom
-                sample['distance'] = float(sam.distminus)
-                sample['distance'].attrs['units'] = 'mm'
-                try:
-                    sample['distance_error'] = sam.distminus.err
-                    sample['distance_error'].attrs['units'] = 'mm'
-                except AttributeError:
-                    pass
-                sample.create_group('transmission')
-                sample['transmission'].attrs['NX_class'] = 'NXdata'
-                sample['transmission']['data'] = float(sam.transmission)
-                try:
-                    sample['transmission']['errors'] = sam.transmission.err
-                    sample['transmission']['data'].attrs[
-                        'uncertainties'] = 'errors'
-                except AttributeError:
-                    pass
-                try:
-                    haakephoenix = self.credo().subsystems['Equipments'].get(
-                        'haakephoenix')
-                    if haakephoenix.connected():
-                        sample['temperature'] = haakephoenix.temperature
-                        sample['temperature'].attrs['units'] = 'degC'
-                except InstrumentError as ie:
-                    logger.warn(
-                        'Cannot contact Haake Phoenix circulator while saving NeXus file: ', traceback.format_exc())
-            monitor = entry.create_group('monitor')
-            monitor.attrs['NX_class'] = 'NXmonitor'
-            monitor['mode'] = 'timer'
-            monitor['preset'] = self.credo().subsystems[
-                'Exposure'].exptime
-            monitor['preset'].attrs['units'] = 's'
-            monitor['nominal'] = self.credo().subsystems[
-                'Exposure'].exptime
-            monitor['nominal'].attrs['units'] = 's'
-            monitor['type'] = 'timer'
-            monitor['count_time'] = self.credo().subsystems['Exposure'].exptime
-            monitor['count_time'].attrs['units'] = 's'
-            instrument = entry.create_group('instrument')
-            instrument.attrs['NX_class'] = 'NXinstrument'
-            instrument['name'] = 'Creative Research Equipment for DiffractiOn'
-            instrument['name'].attrs['short_name'] = 'CREDO'
-            instrument['URL'] = 'http://credo.ttk.mta.hu'
-            l0 = self.credo().subsystems['Collimation'].l0
-            l1 = self.credo().subsystems['Collimation'].l1
-            l2 = self.credo().subsystems['Collimation'].l2
-            ls = self.credo().subsystems['Collimation'].ls
-            lbs = self.credo().subsystems['Collimation'].lbs
-            dbs = self.credo().subsystems['Collimation'].dbs
-            sd = self.credo().dist
-            beamstop = instrument.create_group('beam_stop')
-            beamstop.attrs['NX_class'] = 'NXbeam_stop'
-            beamstop['description'] = 'circular'
-            beamstop['size'] = dbs
-            beamstop['size'].attrs['units'] = 'mm'
-            beamstop['distance_to_detector'] = lbs
-            beamstop['distance_to_detector'].attrs['units'] = 'mm'
-            coll = instrument.create_group('collimator')
-            coll.attrs['NX_class'] = 'NXcollimator'
-            for idx, description, dist in [(1, 'Entrance', -(l1 + l2 + ls)),
-                                           (2, 'Beam defining', (-(l2 + ls))),
-                                           (3, 'Guard', (-ls))]:
-                ph = coll.create_group('aperture_%d' % idx)
-                ph.attrs['NX_class'] = 'NXaperture'
-                ph['material'] = 'Pt-Ir'
-                ph['description'] = description + ' pinhole'
-                geo = ph.create_group('geometry')
-                geo.attrs['NX_class'] = 'NXgeometry'
-                geo['component_index'] = idx - 4
-                shape = geo.create_group('shape')
-                shape.attrs['NX_class'] = 'NXshape'
-                shape['shape'] = 'nxcylinder'
-                shape.create_dataset('size', data=np.array(
-                    [[getattr(self.credo().subsystems['Collimation'], 'aperture%d' % idx) * 1e-3, 0.2, 0, 0, 1.]]))
-                shape['size'].attrs['units'] = 'mm'
-                trans = geo.create_group('translation')
-                trans.attrs['NX_class'] = 'NXtranslation'
-
-                trans.create_dataset(
-                    'distances', data=np.array([[0, 0, dist]]))
-                trans['distances'].attrs['units'] = 'mm'
-
-            motors = instrument.create_group('motors')
-            motors.attrs['NX_class'] = 'NXcollection'
-            for m in self.credo().subsystems['Motors']:
-                motor = self.credo().subsystems['Motors'].get(m)
-                mot = motors.create_group(motor.name)
-                mot.attrs['NX_class'] = 'NXpositioner'
-                mot['name'] = motor.name
-                mot['description'] = motor.alias
-                mot['value'] = motor.get_parameter(
-                    'Current_position', raw=False)
-                mot['value'].attrs['units'] = 'mm'
-                mot['raw_value'] = motor.get_parameter(
-                    'Current_position', raw=True)
-                mot['raw_value'].attrs['units'] = ''
-                mot['soft_limit_min'] = motor.get_parameter(
-                    'soft_left', raw=False)
-                mot['soft_limit_min'].attrs['units'] = 'mm'
-                mot['soft_limit_max'] = motor.get_parameter(
-                    'soft_right', raw=False)
-                mot['soft_limit_max'].attrs['units'] = 'mm'
-                if motor == self.credo().subsystems['Samples'].motor_samplex:
-                    sample['positioner_x'] = mot
-                    sample['x_translation'] = mot['value']
-                elif motor == self.credo().subsystems['Samples'].motor_sampley:
-                    sample['positioner_y'] = mot
-                    sample['y_translation'] = mot['value']
-                elif motor == self.credo().subsystems['Collimation'].motor_beamstopx:
-                    beamstop['positioner_x'] = mot
-                    beamstop['x'] = mot['value']
-                elif motor == self.credo().subsystems['Collimation'].motor_beamstopy:
-                    beamstop['positioner_y'] = mot
-                    beamstop['y'] = mot['value']
-                    beamstop['status'] = ['out', 'in'][
-                        (mot['value'] < self.credo().subsystems['Collimation'].beamstop_in_ymax) and
-                        (mot['value'] > self.credo().subsystems['Collimation'].beamstop_in_min)]
-                elif motor == self.credo().subsystems['Collimation'].motor_ph1x:
-                    coll['aperture_1']['positioner_x'] = mot
-                    coll['aperture_1']['x'] = mot['value']
-                elif motor == self.credo().subsystems['Collimation'].motor_ph1y:
-                    coll['aperture_1']['positioner_y'] = mot
-                    coll['aperture_1']['y'] = mot['value']
-                elif motor == self.credo().subsystems['Collimation'].motor_ph2x:
-                    coll['aperture_2']['positioner_x'] = mot
-                    coll['aperture_2']['x'] = mot['value']
-                elif motor == self.credo().subsystems['Collimation'].motor_ph2y:
-                    coll['aperture_2']['positioner_y'] = mot
-                    coll['aperture_2']['y'] = mot['value']
-                elif motor == self.credo().subsystems['Collimation'].motor_ph3x:
-                    coll['aperture_3']['positioner_x'] = mot
-                    coll['aperture_3']['x'] = mot['value']
-                elif motor == self.credo().subsystems['Collimation'].motor_ph3y:
-                    coll['aperture_3']['positioner_y'] = mot
-                    coll['aperture_3']['y'] = mot['value']
-            monochromator = instrument.create_group('monochromator')
-            monochromator.attrs['NX_class'] = 'NXmonochromator'
-            monochromator['wavelength'] = self.credo().wavelength
-            monochromator['wavelength'].attrs['units'] = 'nm'
-            monochromator['wavelength_error'] = self.credo().wavelength *\
-                self.credo().wavelength_spread
-            monochromator['wavelength_error'].attrs['units'] = 'nm'
-            monochromator['energy'] = HC / self.credo().wavelength
-            monochromator['energy'].attrs['units'] = 'eV'
-            monochromator['energy_error'] = monochromator[
-                'energy'].value * self.credo().wavelength_spread
-            monochromator['energy_error'].attrs['units'] = 'eV'
-            source = instrument.create_group('source')
-            source.attrs['NX_class'] = 'NXsource'
-            source['distance'] = -ls - l2 - l1 - l0
-            source['name'] = 'Xenocs GeniX3D Cu ULD'
-            source['name'].attrs['short_name'] = 'GeniX'
-            source['type'] = 'Fixed Tube X-ray'
-            source['probe'] = 'x-ray'
-            try:
-                genix = self.credo().subsystems['Equipments'].get('genix')
-                ht = genix.ht
-                curr = genix.current
-                source['power'] = ht * curr
-                source['power'].attrs['units'] = 'W'
-                source['energy'] = ht * 1000
-                source['energy'].attrs['units'] = 'eV'
-                source['current'] = curr * 1e-3
-                source['current'].attrs['units'] = 'A'
-            except InstrumentError:
-                logger.warn(
-                    'Could not contact GeniX for saving NeXus file: ' + traceback.format_exc())
-            source['target_material'] = 'Cu'
-            sensors = instrument.create_group('sensors')
-            sensors.attrs['NX_class'] = 'NXcollection'
-            try:
-                vacgauge = self.credo().subsystems['Equipments'].get(
-                    'vacgauge')
-                p = vacgauge.pressure
-                vacuum = sensors.create_group('vacuum')
-                vacuum.attrs['NX_class'] = 'NXsensor'
-                vacuum['value'] = p
-                vacuum['value'].attrs['units'] = 'mbar'
-                vacuum['model'] = vacgauge.get_version()
-                vacuum['name'] = 'Pirani Vacuum Gauge'
-                vacuum['short_name'] = 'vacgauge'
-                vacuum['attached_to'] = 'flight path'
-                vacuum['measurement'] = 'pressure'
-                vacuum['type'] = 'Pirani'
-                vacuum['run_control'] = False
-            except InstrumentError:
-                logger.warn(
-                    'Cannot contact vacuum gauge on saving NeXus file: ' + traceback.format_exc())
-            detector = instrument.create_group('detector')
-            detector.attrs['NX_class'] = 'NXdetector'
-            detector['distance'] = sd
-            detector['distance'].attrs['units'] = 'mm'
-            detector['polar_angle'] = 0
-            detector['polar_angle'].attrs['units'] = 'rad'
-            detector['azimuthal_angle'] = 0
-            detector['azimuthal_angle'].attrs['units'] = 'rad'
-            detector['local_name'] = 'pilatus300k'
-            detector['x_pixel_size'] = 0.172
-            detector['x_pixel_size'].attrs['units'] = 'mm'
-            detector['y_pixel_size'] = 0.172
-            detector['y_pixel_size'].attrs['units'] = 'mm'
-            detector['type'] = 'CMOS'
-            detector['layout'] = 'area'
-            detector['count_time'] = self.credo().subsystems[
-                'Exposure'].exptime
-            detector['count_time'].attrs['units'] = 's'
-            if fsn is not None:
-                detector['sequence_number'] = fsn
-            detector['beam_center_x'] = self.credo().beamposy * \
-                detector['x_pixel_size'].value
-            detector['beam_center_x'].attrs['units'] = 'mm'
-            detector['beam_center_y'] = self.credo().beamposx * \
-                detector['y_pixel_size'].value
-            detector['beam_center_y'].attrs['units'] = 'mm'
-            detector['acquisition_mode'] = 'summed'
-            detector['angular_calibration_applied'] = False
-            detector['flatfield_applied'] = True
-            detector.create_dataset('pixel_mask', data=(
-                self.credo().subsystems['Exposure'].get_mask().mask == 0) << 6)
-            detector['pixel_mask'].attrs[
-                'file_name'] = self.credo().subsystems['Exposure'].default_mask
-            detector['countrate_correction_applied'] = True
-            detector['bit_depth_readout'] = 20
-            detector['detector_readout_time'] = 2.3
-            detector['detector_readout_time'].attrs['units'] = 'ms'
-            detector['sensor_material'] = 'Si'
-            detector['sensor_thickness'] = 450e-3
-            detector['sensor_thickness'].attrs['units'] = 'mm'
-            try:
-                pilatus = self.credo().subsystems['Equipments'].get('pilatus')
-                detector[
-                    'description'] = 'Dectris Pilatus-300k SN: %s' % pilatus.camerasn
-                detector['comparator_voltage'] = pilatus.vcmp
-                detector['comparator_voltage'].attrs['units'] = 'V'
-                detector['dead_time'] = pilatus.tau * 1e9
-                detector['dead_time'].attrs['units'] = 'ns'
-                detector['gain_setting'] = pilatus.gain
-                detector['threshold_energy'] = pilatus.threshold
-                detector['threshold_energy'].attrs['units'] = 'eV'
-                detector['saturation_value'] = pilatus.cutoff
-                for i, attached_to in zip(range(3), ['power board', 'base plate', 'sensor']):
-                    hum = sensors.create_group('detector_humidity%d' % i)
-                    hum.attrs['NX_class'] = 'NXsensor'
-                    hum['value'] = getattr(pilatus, 'humidity%d' % i)
-                    hum['value'].attrs['units'] = '%'
-                    hum['model'] = 'Pilatus-300k'
-                    hum['name'] = 'Humidity sensor, channel #%d' % (12 + i)
-                    hum['short_name'] = 'Humidity #%d' % i
-                    hum['attached_to'] = 'Detector power board'
-                    hum['measurement'] = 'humidity'
-                    hum['type'] = 'combined temperature and humidity sensor'
-                    hum['run_control'] = False
-                    temp = sensors.create_group('detector_temperature%d' % i)
-                    temp.attrs['NX_class'] = 'NXsensor'
-                    temp['value'] = getattr(pilatus, 'temperature%d' % i)
-                    temp['value'].attrs['units'] = 'deg_C'
-                    temp['model'] = 'Pilatus-300k'
-                    temp['name'] = 'Temperature sensor, channel #%d' % (12 + i)
-                    temp['short_name'] = 'Temperature #%d' % i
-                    temp['attached_to'] = 'Detector ' + attached_to
-                    temp['measurement'] = 'temperature'
-                    temp['type'] = 'combined temperature and humidity sensor'
-                    temp['run_control'] = False
-
-            except InstrumentError:
-                logger.warn(
-                    'Cannot contact pilatus for data retrieval on saving NeXus file: ' + traceback.format_exc())
-            data = entry.create_group('data')
-            data.attrs['NX_class'] = 'NXdata'
-
-            monitor['start_time'] = datetime.datetime.now(
-                dateutil.tz.tzlocal()).isoformat()
-            entry['start_time'] = monitor['start_time']
+        with h5py.File(filename, 'w', libver=libver) as f:
+            write_nexus_static(f, self._nexus_static_state(), self._nexus_mask())
+            write_nexus_dynamic(f, filename, self._nexus_dynamic_state(fsn, nscan))
         logger.debug('Created NeXus template file %s in %.2f seconds' %
                      (filename, time.time() - t0))
         return
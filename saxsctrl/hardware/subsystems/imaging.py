@@ -4,7 +4,7 @@ from gi.repository import Notify
 
 from .subsystem import SubSystem, SubSystemError
 # import all defined scan devices
-from .scan import ScanDevice, ScanDeviceError
+from .scan import ScanDevice, ScanDeviceError, create_container, write_to_container
 from ..instruments.genix import GenixError
 import logging
 import sastool
@@ -42,9 +42,12 @@ class SubSystemImaging(SubSystem):
     autoreturn = GObject.property(type=bool, default=True, blurb='Auto-return')
     comment = GObject.property(
         type=str, default='--please fill--', blurb='Comment')
+    container = GObject.property(
+        type=bool, default=False, blurb='Write all images into one HDF5 file')
     _current_step = None
     _original_shuttermode = None
     currentscan = None
+    _container = None
     _header_template = None
     _mask = None
     _ex_conn = None
@@ -123,6 +126,9 @@ class SubSystemImaging(SubSystem):
             command, (self.nstep1, self.nstep2), self.credo().subsystems['Files'].scanfile)
 
         logger.info('Starting scan #%d: %s' % (self.currentscan.fsn, command))
+        if self.container:
+            self._container = create_container(
+                self.credo(), self.currentscan, self.nstep1 * self.nstep2)
 
         self.credo().subsystems['Exposure'].exptime = self.countingtime
         if self.scandevice1.name() == 'Time' or self.scandevice2.name() == 'Time':
@@ -183,6 +189,14 @@ class SubSystemImaging(SubSystem):
                          0], self.scandevice2.name(): where[1], 'FSN': ex['FSN']})
         cols = self.currentscan.columns()
         self.currentscan.append(tuple(vdreadout[c] for c in cols))
+        if self._container is not None:
+            try:
+                write_to_container(self._container, self.credo(), ex, vdreadout)
+            except (IOError, ValueError, KeyError, RuntimeError):
+                logger.error('Cannot write FSN #%d to the HDF5 container, closing it: %s' % (
+                    ex['FSN'], traceback.format_exc()))
+                self._container.close()
+                self._container = None
         self.emit('imaging-report', self.currentscan)
 
     def _do_next_step(self):
@@ -253,6 +267,9 @@ class SubSystemImaging(SubSystem):
         self._firsttime = None
         self._where = None
         self.currentscan.stop_record_mode()
+        if self._container is not None:
+            self._container.close()
+            self._container = None
         if self.credo().subsystems['Exposure'].operate_shutter != self._original_shuttermode:
             self.credo().subsystems[
                 'Exposure'].operate_shutter = self._original_shuttermode
@@ -10,6 +10,7 @@ import weakref
 import time
 import logging
 import sastool
+import numpy as np
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 import traceback
@@ -25,6 +26,28 @@ class ScanDeviceError(SubSystemError):
     pass
 
 
+def create_container(credo, scan, npoints):
+    """Create the HDF5 container for the images of `scan`, with the scan
+    columns, the monitor and the motor positions as per-frame scalars.
+    Returns None on failure."""
+    try:
+        return credo.subsystems['Files'].create_scan_container(
+            scan.fsn, npoints, list(scan.columns()) + ['Monitor'] +
+            ['motors/' + m.alias for m in credo.subsystems['Motors'].get_motors()])
+    except (IOError, ValueError, KeyError, RuntimeError):
+        logger.error('Cannot create HDF5 container for scan #%d: %s' % (
+            scan.fsn, traceback.format_exc()))
+        return None
+
+
+def write_to_container(container, credo, ex, readout):
+    scalars = dict(readout)
+    scalars['Monitor'] = ex['Monitor']
+    for m in credo.subsystems['Motors'].get_motors():
+        scalars['motors/' + m.alias] = m.get_parameter('Current_position')
+    container.append(np.flipud(ex.Intensity), np.flipud(ex.Error), scalars)
+
+
 class ScanDevice(GObject.GObject):
 
     def __init__(self, credo):
@@ -211,9 +234,12 @@ class SubSystemScan(SubSystem):
     autoreturn = GObject.property(type=bool, default=True, blurb='Auto-return')
     comment = GObject.property(
         type=str, default='--please fill--', blurb='Comment')
+    container = GObject.property(
+        type=bool, default=False, blurb='Write all images into one HDF5 file')
     _current_step = None
     _original_shuttermode = None
     currentscan = None
+    _container = None
     _header_template = None
     _mask = None
     _ex_conn = None
@@ -281,6 +307,9 @@ class SubSystemScan(SubSystem):
             command, self.nstep, self.credo().subsystems['Files'].scanfile)
 
         logger.info('Starting scan #%d: %s' % (self.currentscan.fsn, command))
+        if self.container:
+            self._container = create_container(
+                self.credo(), self.currentscan, self.nstep)
 
         self.credo().subsystems['Exposure'].exptime = self.countingtime
         if self.scandevice.name() == 'Time':
@@ -355,6 +384,14 @@ class SubSystemScan(SubSystem):
         vdreadout.update({self.scandevice.name(): where, 'FSN': ex['FSN']})
         cols = self.currentscan.columns()
         self.currentscan.append(tuple(vdreadout[c] for c in cols))
+        if self._container is not None:
+            try:
+                write_to_container(self._container, self.credo(), ex, vdreadout)
+            except (IOError, ValueError, KeyError, RuntimeError):
+                logger.error('Cannot write FSN #%d to the HDF5 container, closing it: %s' % (
+                    ex['FSN'], traceback.format_exc()))
+                self._container.close()
+                self._container = None
         self.emit('scan-report', self.currentscan)
 
     def _do_next_step(self):
@@ -426,6 +463,9 @@ class SubSystemScan(SubSystem):
         self._firsttime = None
         self._where = None
         self.currentscan.stop_record_mode()
+        if self._container is not None:
+            self._container.close()
+            self._container = None
         if self.credo().subsystems['Exposure'].operate_shutter != self._original_shuttermode:
             self.credo().subsystems[
                 'Exposure'].operate_shutter = self._original_shuttermode
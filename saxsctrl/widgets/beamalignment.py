@@ -13,7 +13,7 @@ logger.setLevel(logging.INFO)
 
 
 class BeamAlignment(ToolDialog):
-    _images_pending = []
+    _results_pending = []
     def __init__(self, credo, title='Beam alignment'):
         ToolDialog.__init__(self, credo, title, buttons=('Execute', Gtk.ResponseType.OK, 'Close', Gtk.ResponseType.CLOSE))
         self._conns = []
@@ -146,7 +146,7 @@ class BeamAlignment(ToolDialog):
         if respid == Gtk.ResponseType.OK:
             if self.beamposframe.get_sensitive():
                 self.credo.subsystems['Samples'].set(None)
-                self._images_pending = []
+                self._results_pending = []
                 self.expframe.execute({'Comment':self.comment_entry.get_text()}, write_nexus=False)
             else:
                 self.expframe.kill()
@@ -164,55 +164,56 @@ class BeamAlignment(ToolDialog):
         for w in [self.beamposframe, self.entrygrid, self.get_widget_for_response(Gtk.ResponseType.CLOSE)]:
             w.set_sensitive(True)
         self.get_widget_for_response(Gtk.ResponseType.OK).set_label('Execute')
-        logger.debug('last image received, analyzing images.')
-        pri = self.get_beamarea()
-
-        if self.threshold_checkbutton.get_active():
-            threshold = self.threshold_entry.get_value()
-        else:
-            threshold = None
-        beampos = []
-        if (pri[0] - pri[1]) * (pri[2] - pri[3]) != 0:
-            mask1 = sastool.classes.SASMask(self._images_pending[0].shape)
-            mask1.edit_rectangle(pri[0], pri[2], pri[1], pri[3], whattodo='unmask')
-        for ex in self._images_pending:
-            if (pri[0] - pri[1]) * (pri[2] - pri[3]) != 0:
-                ex.mask &= mask1
-            try:
-                if threshold is not None:
-                    beampos.append(ex.find_beam_semitransparent(pri, threshold))
-                else:
-                    beampos.append(ex.barycenter())
-            except Exception, err:
-                logger.error('Beam finding error: ' + str(err))
-        bcx = [b[0] for b in beampos]
-        bcy = [b[1] for b in beampos]
-        Imax = [ex.max() for ex in self._images_pending]
-        Isum = [ex.sum() for ex in self._images_pending]
-        Imean = [ex.mean() for ex in self._images_pending]
-        Istd = [ex.std() for ex in self._images_pending]
-        sigma = [ex.sigma() for ex in self._images_pending]
-        sigmax = [s[0] for s in sigma]
-        sigmay = [s[1] for s in sigma]
-        sigmatot = [(s[0] ** 2 + s[1] ** 2) ** 0.5 for s in sigma]
+        logger.debug('last image received, summarizing results.')
+        results = self._results_pending
+        bcx = [r['beampos'][0] for r in results if r['beampos'] is not None]
+        bcy = [r['beampos'][1] for r in results if r['beampos'] is not None]
+        Imax = [r['max'] for r in results]
+        Isum = [r['sum'] for r in results]
+        Imean = [r['mean'] for r in results]
+        Istd = [r['std'] for r in results]
+        sigmax = [r['sigma'][0] for r in results]
+        sigmay = [r['sigma'][1] for r in results]
+        sigmatot = [(r['sigma'][0] ** 2 + r['sigma'][1] ** 2) ** 0.5 for r in results]
         for name, entity in [('X Pos', bcx), ('Y Pos', bcy), ('X RMS', sigmax), ('Y RMS', sigmay), ('Total RMS', sigmatot), ('Max intensity', Imax),
                             ('Mean intensity', Imean), ('RMS intensity', Istd), ('Total intensity', Isum)]:
             self.resultlabels[name]['mean'].set_text(str(np.mean(entity)))
             self.resultlabels[name]['rms'].set_text(str(np.std(entity)))
             self.resultlabels[name]['num'].set_text(str(len(entity)))
         logger.debug('BeamX: %f; BeamY: %f; Imax: %f; Isum: %f; Imean: %f; Istd: %f' % (np.mean(bcx), np.mean(bcy), np.mean(Imax), np.mean(Isum), np.mean(Imean), np.mean(Istd)))
-        self._images_pending = []
+        self._results_pending = []
         gc.collect()
 
     def _on_image(self, expframe, imgdata):
-        pri = (self.pri_top_entry.get_value(),
-               self.pri_bottom_entry.get_value(),
-               self.pri_left_entry.get_value(),
-               self.pri_right_entry.get_value())
+        # imgdata refers to the frame buffer of the Exposure subsystem, thus
+        # it is analyzed right now and only copied if it has to be plotted.
+        # The input widgets are insensitive during the exposure.
+        pri = self.get_beamarea()
         logger.debug('image received.')
-        self._images_pending.append(imgdata)
+        if self.threshold_checkbutton.get_active():
+            threshold = self.threshold_entry.get_value()
+        else:
+            threshold = None
+        if (pri[0] - pri[1]) * (pri[2] - pri[3]) != 0:
+            mask1 = sastool.classes.SASMask(imgdata.shape)
+            mask1.edit_rectangle(pri[0], pri[2], pri[1], pri[3], whattodo='unmask')
+            if imgdata.mask is None:
+                imgdata.mask = mask1
+            else:
+                imgdata.mask = imgdata.mask & mask1
+        try:
+            if threshold is not None:
+                beampos = imgdata.find_beam_semitransparent(pri, threshold)
+            else:
+                beampos = imgdata.barycenter()
+        except Exception, err:
+            logger.error('Beam finding error: ' + str(err))
+            beampos = None
+        self._results_pending.append({'beampos': beampos, 'max': imgdata.max(), 'sum': imgdata.sum(),
+                                      'mean': imgdata.mean(), 'std': imgdata.std(), 'sigma': imgdata.sigma()})
         if self.plot_checkbutton.get_active():
             logger.debug('plotting received image')
+            imgdata = sastool.classes.SASExposure(imgdata)
             if self.reuse_checkbutton.get_active():
                 win = sasgui.plot2dsasimage.PlotSASImageWindow.get_current_plot()
                 win.set_exposure(imgdata)
@@ -220,7 +220,7 @@ class CenteringDialog(ToolDialog):
         ex = self.plot2d.get_exposure()
         basename = os.path.basename(ex['FileName']).rsplit('.', 1)[0]
         ex.header.write(
-            os.path.join(self.credo.subsystems['Files'].eval2dpath, basename + '.param'))
+            self.credo.subsystems['Files'].get_writepath('eval2d', basename + '.param'))
 
     def do_response(self, respid):
         if respid == 1:  # execute
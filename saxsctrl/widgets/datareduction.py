@@ -9,6 +9,9 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# number of catalog entries loaded at once
+PAGESIZE = 500
+
 
 class DataReduction(ToolDialog):
 
@@ -181,6 +184,22 @@ class DataReduction(ToolDialog):
     def reload_list(self, callback=None):
         self._headerlist.clear()
         ssdr = self.credo.subsystems['DataReduction']
+        offset = 0
+        while True:
+            headers = self.credo.subsystems['Files'].query_catalog(
+                ssdr.filebegin, self._startfsn_spin.get_value_as_int(), self._endfsn_spin.get_value_as_int(),
+                limit=PAGESIZE, offset=offset)
+            if headers is None:
+                break
+            for h in headers:
+                self._headerlist.append(
+                    [h, False, 0, '', '', '', '', '', '', '', '', 0])
+            if len(headers) < PAGESIZE:
+                self.refresh_view()
+                return
+            offset += len(headers)
+            if callback is not None:
+                callback()
         for fsn in range(self._startfsn_spin.get_value_as_int(),
                          self._endfsn_spin.get_value_as_int() + 1):
             try:
@@ -244,8 +263,10 @@ class DataReduction(ToolDialog):
                 self._todo_number = len(selected)
                 self._done_number = 0
                 self._resultsprogress.set_fraction(0)
-                for sel in selected:
-                    self.credo.subsystems['DataReduction'].reduce(sel)
+                if len(selected) > 1:
+                    self.credo.subsystems['DataReduction'].reduce_batch(selected)
+                else:
+                    self.credo.subsystems['DataReduction'].reduce(selected[0])
 #                for path in self._headerview.get_selection().get_selected_rows()[1]:
 #                    self._headerlist[path][1] = True
                 self.get_widget_for_response(
@@ -5,6 +5,7 @@ import sastool
 import os
 from .exposureselector import ExposureSelector
 from .widgets import ToolDialog
+from ..hardware.reduction.radavg import radial_average
 import logging
 
 _errorflags = [('Wrong distance', 'BADDIST'), ('Wrong sample',
@@ -64,6 +65,10 @@ class DataViewer(ToolDialog):
         b.connect('clicked', self._editmask)
         grid.attach(b, 2, row, 1, 1)
         row += 1
+        b = Gtk.Button(label='Plot all curves of this sample')
+        b.connect('clicked', self._plot_sample_curves)
+        grid.attach(b, 0, row, 3, 1)
+        row += 1
 
         hb = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
         vb.pack_start(hb, False, False, 0)
@@ -111,6 +116,18 @@ class DataViewer(ToolDialog):
                                                    headerformat=headerformat)
         self._exposure_open(self._exposureselector, exposure)
 
+    def _plot_sample_curves(self, button):
+        exposure = self.plot2d.get_exposure()
+        if exposure is None:
+            return
+        store = self.credo.subsystems['Files'].curvestore
+        prefix = self._exposureselector.get_fileprefix()
+        curves = store.read(prefix, store.select(prefix, exposure['Title']))
+        for fsn in sorted(curves):
+            self.plot1d.add_curve_with_errorbar(
+                sastool.classes.SASCurve(curves[fsn]['q'], curves[fsn]['Intensity'], curves[fsn]['Error']),
+                label='#%d: %s' % (fsn, exposure['Title']))
+
     def on_data_reduction_finished(self, ssdr, fsn, header, button, fsn_to_wait_for):
         if fsn != fsn_to_wait_for:
             return False
@@ -119,7 +136,7 @@ class DataViewer(ToolDialog):
         button.set_sensitive(True)
         exposure = ssdr.load_exposure(fsn)
         self.plot1d.add_curve_with_errorbar(
-            exposure.radial_average(), label='Reduced: ' + str(exposure.header))
+            radial_average(exposure), label='Reduced: ' + str(exposure.header))
         self.plot2d.set_exposure(exposure)
         return False
 
@@ -143,6 +160,8 @@ class DataViewer(ToolDialog):
         self._exposureselector.set_sensitive(False)
         self._dr_connid = ssdr.connect(
             'done', self.on_data_reduction_finished, button, self.plot2d.get_exposure()['FSN'])
+        # the error flags may still be being written to param_override.
+        self.credo.subsystems['Files'].flush()
         ssdr.reduce(self.plot2d.get_exposure()['FSN'])
 
     def _exposure_open(self, eselector, ex):
@@ -161,7 +180,7 @@ class DataViewer(ToolDialog):
         self._labels['owner'].set_label(ex['Owner'])
         self.plot2d.set_exposure(ex)
         try:
-            rad = ex.radial_average()
+            rad = radial_average(ex)
         except sastool.classes.SASExposureException as see:
             self.plot1d.gca().text(0.5, 0.5, 'Cannot do radial average:\n' + str(see),
                                    ha='center', va='center', transform=self.plot1d.gca().transAxes)
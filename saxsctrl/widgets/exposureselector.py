@@ -2,8 +2,11 @@ from gi.repository import Gtk
 from gi.repository import GLib
 from gi.repository import GObject
 from .spec_filechoosers import MaskEntryWithButton
+from ..hardware.io.headercatalog import title_pattern
 import sastool
 DEFAULT_PREFIX = 'crd'
+# number of catalog entries loaded at once
+PAGESIZE = 500
 
 
 
@@ -38,7 +41,16 @@ class ExposureBrowserDialog(Gtk.Dialog):
         self._checkbutton_with_entry(self.fsn_end_cb, self.fsn_end_entry)
         row += 1
 
-        self.liststore = Gtk.ListStore(GObject.TYPE_PYOBJECT,  # the SASHeader instance
+        self.title_cb = Gtk.CheckButton('Title contains:'); self.title_cb.set_halign(Gtk.Align.START); self.title_cb.set_valign(Gtk.Align.CENTER)
+        tab.attach(self.title_cb, 0, 1, row, row + 1, Gtk.AttachOptions.FILL, Gtk.AttachOptions.FILL)
+        self.title_entry = Gtk.Entry()
+        tab.attach(self.title_entry, 1, 2, row, row + 1)
+        self.title_cb.connect('toggled', self._checkbutton_with_entry, self.title_entry)
+        self.title_entry.connect('activate', self.reload)
+        self._checkbutton_with_entry(self.title_cb, self.title_entry)
+        row += 1
+
+        self.liststore = Gtk.ListStore(GObject.TYPE_PYOBJECT,  # the SASHeader instance or catalog entry
                                        GObject.TYPE_INT,  # FSN
                                        GObject.TYPE_STRING,  # Title
                                        GObject.TYPE_STRING,  # Owner
@@ -104,10 +116,28 @@ class ExposureBrowserDialog(Gtk.Dialog):
             maxfsn = self.credo.subsystems['Files'].get_next_fsn(self.credo.subsystems['Files'].get_format_re(self.fileprefix, self.ndigits)) - 1
         if minfsn is None or maxfsn is None:
             return
-        headers = sastool.classes.SASHeader(self.credo.subsystems['Files'].get_headerformat(self.fileprefix, self.ndigits), range(minfsn, maxfsn + 1), dirs=datadirs, error_on_not_found=False)
+        if self.title_cb.get_active():
+            title = title_pattern(self.title_entry.get_text())
+        else:
+            title = None
         self.liststore.clear()
-        for h in headers:
-            self.liststore.append((h, 0, '', '', 0.0, 0.0))
+        offset = 0
+        while True:
+            headers = self.credo.subsystems['Files'].query_catalog(self.fileprefix, minfsn, maxfsn, title,
+                                                                   limit=PAGESIZE, offset=offset)
+            if headers is None:
+                break
+            for h in headers:
+                self.liststore.append((h, 0, '', '', 0.0, 0.0))
+            if len(headers) < PAGESIZE:
+                break
+            offset += len(headers)
+        if headers is None:
+            headers = sastool.classes.SASHeader(self.credo.subsystems['Files'].get_headerformat(self.fileprefix, self.ndigits), range(minfsn, maxfsn + 1), dirs=datadirs, error_on_not_found=False)
+            if title is not None:
+                headers = [h for h in headers if self.title_entry.get_text().lower() in str(h['Title']).lower()]
+            for h in headers:
+                self.liststore.append((h, 0, '', '', 0.0, 0.0))
         self.populate_liststore()
         self.treeview.get_selection().select_iter(self.liststore.get_iter_first())
     def _response(self, dialog, respid):
@@ -376,7 +376,7 @@ class ScanGraph(ToolDialog):
         if self._show2d_check.get_active() and ('FSN' in self.scan.columns()):
             ssf = self.credo.subsystems['Files']
             exposure = sastool.classes.SASExposure(ssf.get_exposureformat('scn') % self.scan['FSN'][self._cursor_at], dirs=[
-                                                   ssf.scanpath, ssf.imagespath, ssf.parampath] + sastool.misc.find_subdirs(ssf.maskpath))
+                                                   ssf.scanpath] + ssf.rawloadpath)
             pltwin = sasgui.PlotSASImageWindow.get_current_plot()
             pltwin.set_exposure(exposure)
             if not pltwin.is_visible():
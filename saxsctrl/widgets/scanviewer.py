@@ -2,6 +2,7 @@ from gi.repository import Gtk
 from gi.repository import GObject
 from gi.repository import Pango
 import sastool
+from ..hardware.io.specindex import SpecScanStore
 from .moviemaker import MovieMaker
 from . import scangraph
 from sasgui.fileentry import FileEntryWithButton
@@ -11,6 +12,7 @@ import datetime
 class ScanViewer(ToolDialog):
     def __init__(self, credo, title='Scan viewer'):
         ToolDialog.__init__(self, credo, title)
+        self.spec = None
         vb = self.get_content_area()
         self.entrygrid = Gtk.Grid()
         vb.pack_start(self.entrygrid, False, True, 0)
@@ -107,9 +109,15 @@ class ScanViewer(ToolDialog):
         return True
     def reload_list(self):
         self.scan_liststore.clear()
-        self.spec = sastool.classes.SASScanStore(self.scanfile_entry.get_filename())
-        for scan in [s for s in self.spec if len(s)]:
-            self.scan_liststore.append((scan.fsn, scan.columns()[0], scan.comment, scan.command, len(scan), datetime.datetime.fromtimestamp(scan.timestamp).strftime('%F %R')))
+        if self.spec is not None:
+            self.spec.finalize()
+        self.spec = SpecScanStore(self.scanfile_entry.get_filename())
+        for scan in [s for s in self.spec.list_scans() if s['npoints']]:
+            if scan['timestamp'] is None:
+                date = ''
+            else:
+                date = datetime.datetime.fromtimestamp(scan['timestamp']).strftime('%F %R')
+            self.scan_liststore.append((scan['number'], scan['columns'][0], scan['comment'], scan['command'], scan['npoints'], date))
 
     def _plot(self):
         model, paths = self.scan_treeview.get_selection().get_selected_rows()
@@ -2,10 +2,12 @@
 from gi.repository import Gtk
 from gi.repository import GLib
 import logging
+import sastool
 from .nextfsn_monitor import NextFSNMonitor
 from .samplesetup import SampleSelector
 from .widgets import ToolDialog
 from .exposure import ExposureFrame
+from ..hardware.reduction.radavg import radial_average
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -115,7 +117,9 @@ class SingleExposure(ToolDialog):
             w.set_sensitive(True)
     def _on_image(self, expframe, exposure):
         logger.debug('Image received.')
-        GLib.idle_add(self.plot_image, exposure)
+        # the exposure refers to the frame buffer of the Exposure subsystem,
+        # which is reused after this handler returns.
+        GLib.idle_add(self.plot_image, sastool.classes.SASExposure(exposure))
 
     def plot_image(self, exposure):
         logger.debug('Plotting image.')
@@ -128,7 +132,10 @@ class SingleExposure(ToolDialog):
             win.show_all()
             win.present()
         if self.plot1D_checkbutton.get_active():
-            rad = exposure.radial_average(pixel=not self.q_or_pixel_checkbutton.get_active())
+            if self.q_or_pixel_checkbutton.get_active():
+                rad = radial_average(exposure)
+            else:
+                rad = exposure.radial_average(pixel=True)
             if self.reuse2D_checkbutton.get_active():
                 win = sasgui.plot1dsascurve.PlotSASCurveWindow.get_current_plot()
             else: